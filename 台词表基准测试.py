@@ -0,0 +1,525 @@
+"""台词表辅助脚本的性能基准 (不依赖Excel, 可在Linux上运行)
+
+    python 台词表基准测试.py io --rows 3000 --latency 0.0002
+    python 台词表基准测试.py s1 --rows 5000 --sample 100
+    python 台词表基准测试.py align --rows 1000
+    python 台词表基准测试.py text --rows 50000
+    python 台词表基准测试.py dedupe --rows 100000
+    python 台词表基准测试.py delta --rows 2000 --edits 15
+    python 台词表基准测试.py suite --rows 2000 --out 结果.json
+
+io: 在内存假工作表上跑完整的清洗/标点流水线, 对比逐单元格读写与数据区整块读写的调用次数和耗时,
+    latency模拟每次COM调用的往返耗时
+s1: 合成新旧剧本, 对比Stage 1索引检索与逐条扫描; 逐条扫描太慢, 只在前sample条新台词上运行并按比例外推,
+    同时核对两者在这些台词上的匹配结果是否一致
+align: 合成新旧剧本, 分别用heuristic(S1/S2/S3)和align(序列对齐)两种模式复制说话人, 对比耗时和说话人准确率
+text: 清洗阶段的逐行文本判断(合并键/删除原因)和句末标点处理, 对比原先每行现编正则/逐个endswith的写法
+    与预编译正则/查表的写法, 核对两者结果一致并输出每行耗时
+dedupe: 重复台词合并的黄金对照: 默认设置(无折叠)下DuplicateMerger的分组必须与原先按合并键文本分组的写法完全相同,
+    另用只有几个取值的假哈希制造大量冲突再核对一遍; 输出各种折叠的分组统计和每行耗时,
+    以及近似重复合并(MinHash/LSH)的分组统计, 并核对精确重复组都完整包含在近似合并后的组里、每组各行与首行的相似度都达到阈值,
+    另用A~B、B~C而A、C不够相似的链式台词核对A、C不会经B并成一组
+delta: 说话人增量复制的对照: 生成新旧台词表并整表处理一次作为上次输出, 新表改几行后分别整表处理和增量处理,
+    核对两份输出逐格(值和填充色)相同, 并输出两者耗时和沿用的行数。align模式必须完全相同; heuristic的S2/S3贪心依赖整表顺序,
+    重新匹配的那几段可能与整表处理选到不同的旧台词, 只报告不同的格数和准确率
+suite: 生成一对新旧台词表xlsx (行数、说话人数、重复率、多句合并行、英文噪声行、表头位置可调), 用openpyxl引擎
+    跑完整的_proc_file, 记录各阶段耗时、峰值内存和说话人准确率 (A列为真值ID), 结果输出为JSON便于回归对比
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+from openpyxl import Workbook, load_workbook
+
+import 台词表辅助脚本
+from 台词表辅助脚本 import (ExcelBatchProcessor, MemorySheet, DialogueTable, DuplicateMerger, MinHashLSH, np, opencc, classify_row, strip_end_punct,
+                       PARAGRAPH_END_PUNCTS, TRAILING_PUNCTUATIONS)
+
+SPEAKERS = ['张三', '李四', '王五', '赵六', '旁白']
+PHRASES = ['你今天去哪里了', '我去了学校上课', '然后呢你做了什么', '我们一起吃饭吧', '好的没问题', '这件事情很重要',
+           '你说什么', '我不知道啊', '因为天气不好所以没去', '但是他还是来了', '快点走吧', '谁在外面']
+NOISE = ['hi', 'OK', '...', '', 'uh']
+WORDS = ['我们', '你们', '今天', '明天', '真的', '不是', '什么', '怎么', '知道', '觉得', '这个', '那个', '已经', '还是',
+         '一起', '回家', '学校', '公司', '朋友', '妈妈', '爸爸', '老师', '事情', '时候', '可以', '应该', '喜欢', '害怕',
+         '等等', '快点', '看看', '听说', '其实', '就是', '因为', '所以', '但是', '如果', '没有', '为什么', '不要', '一定']
+
+
+def make_cells(rows, seed=1, start_row=5):
+    """生成台词表数据区: E列备注, F列说话人, G列台词(含重复行与英文噪声行)"""
+    rnd = random.Random(seed)
+    cells = {(start_row - 1, 7): '台词', (start_row - 1, 6): '说话人'}
+    for i in range(rows):
+        r = start_row + i
+        text = rnd.choice(NOISE) if rnd.random() < 0.1 else rnd.choice(PHRASES) + rnd.choice(['。', '？', '！', '', ''])
+        cells[(r, 5)] = f"备注{i}"
+        cells[(r, 6)] = rnd.choice(SPEAKERS)
+        if text: cells[(r, 7)] = text
+    return cells
+
+
+def make_script(lines, seed=1):
+    """合成剧本: [(说话人, 台词)], 台词由常用词随机拼接, 约2%为重复台词"""
+    rnd = random.Random(seed)
+    script = []
+    for _ in range(lines):
+        if script and rnd.random() < 0.02: script.append(rnd.choice(script)); continue
+        text = ''.join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 8))) + rnd.choice(['。', '？', '！', '，', ''])
+        script.append((rnd.choice(SPEAKERS), text))
+    return script
+
+
+def perturb_script(script, seed=2):
+    """由旧剧本生成新版本: 少量删行、插行、改字和改标点, 返回[(真实说话人, 台词)]"""
+    rnd = random.Random(seed)
+    new = []
+    for speaker, text in script:
+        roll = rnd.random()
+        if roll < 0.03: continue
+        if roll < 0.06: new.append((rnd.choice(SPEAKERS), ''.join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 6)))))
+        if roll < 0.12 and len(text) > 2:
+            i = rnd.randrange(len(text) - 1); text = text[:i] + rnd.choice('的了呢吧啊') + text[i + 1:]
+        elif roll < 0.16: text = text.rstrip('。？！，') + rnd.choice(['。', '？', ''])
+        new.append((speaker, text))
+    return new
+
+
+def make_data_lists(old_script, new_script, start_row=5):
+    """构造_copy_speakers内部使用的新旧台词表(DialogueTable)"""
+    old_list, new_list = DialogueTable(), DialogueTable()
+    for i, (spk, text) in enumerate(old_script): old_list.append(start_row + i, text, speaker=spk)
+    for i, (_, text) in enumerate(new_script): new_list.append(start_row + i, text)
+    old_list.compute_features(); new_list.compute_features()
+    return old_list, new_list
+
+
+def speaker_names(count):
+    return (SPEAKERS + [f"角色{i}" for i in range(1, count + 1)])[:count] if count > len(SPEAKERS) else SPEAKERS[:count]
+
+
+def make_sheet_pair(args):
+    """生成(旧表行, 新表行, 真值)。行为(ID, 说话人, 台词); 真值为 ID -> 说话人。
+    旧表按merge_rate出现多句台词, 新表中拆成连续几行; 新表再做少量改字/删行/插行, 按dup_rate插入紧邻重复行,
+    按noise_rate插入应被清洗掉的英文噪声行 (ID以N开头)"""
+    rnd = random.Random(args.seed)
+    speakers = speaker_names(args.speakers)
+    old_rows, new_rows, truth = [], [], {}
+    sentence = lambda: ''.join(rnd.choice(WORDS) for _ in range(rnd.randint(2, 7)))
+    for i in range(args.rows):
+        lid, speaker = f"L{i:05d}", rnd.choice(speakers)
+        if rnd.random() < args.merge_rate:
+            parts = [sentence() + rnd.choice('。！？') for _ in range(rnd.randint(2, 3))]
+            old_rows.append((lid, speaker, ''.join(parts)))
+            for k, part in enumerate(parts):
+                new_rows.append((f"{lid}-{k}", part)); truth[f"{lid}-{k}"] = speaker
+            continue
+        text = sentence() + rnd.choice(['。', '？', '！', '，', ''])
+        old_rows.append((lid, speaker, text))
+        roll = rnd.random()
+        if roll < 0.03: continue # 新版删掉的台词
+        if roll < 0.06: # 新版新增的台词, 旧表中没有对应行
+            nid = f"{lid}+"; new_rows.append((nid, sentence() + '。')); truth[nid] = rnd.choice(speakers)
+        if roll < 0.12 and len(text) > 2:
+            pos = rnd.randrange(len(text) - 1); text = text[:pos] + rnd.choice('的了呢吧啊') + text[pos + 1:]
+        new_rows.append((lid, text)); truth[lid] = speaker
+        if rnd.random() < args.dup_rate: new_rows.append((lid, text)) # 紧邻重复, 合并后只保留一行
+        if rnd.random() < args.noise_rate: new_rows.append((f"N{i:05d}", rnd.choice(['OK', 'uh...', 'hi', 'Mm?', '...'])))
+    return old_rows, new_rows, truth
+
+
+def write_sheet(path, rows, header_row, with_speaker):
+    """写一张台词表: A列ID, E列备注, F列说话人, G列台词; header_row>0时该行为表头, 否则数据从第5行开始"""
+    wb = Workbook(); ws = wb.active; ws.title = '台词管理'
+    if header_row >= 3 or header_row == 0: ws.cell(2, 7, "本集译名是测试剧集。这是一段用于基准测试的简介。")
+    if header_row: ws.cell(header_row, 1, 'ID'); ws.cell(header_row, 6, '说话人'); ws.cell(header_row, 7, '台词')
+    start = header_row + 1 if header_row else 5
+    for i, row in enumerate(rows):
+        r = start + i
+        ws.cell(r, 1, row[0]); ws.cell(r, 5, f"备注{i}")
+        if with_speaker: ws.cell(r, 6, row[1])
+        ws.cell(r, 7, row[-1])
+    wb.save(path)
+
+
+def score_output(path, truth, header_row):
+    """按A列ID对照真值统计说话人准确率, 以及残留的噪声行和重复行"""
+    ws = load_workbook(path, read_only=True).active
+    start = header_row + 1 if header_row else 5
+    rows = [(r[0], r[5]) for r in ws.iter_rows(min_row=start, max_col=6, values_only=True) if r[0]]
+    scored = [(truth[rid], spk) for rid, spk in rows if rid in truth]
+    correct = sum(1 for want, got in scored if got and str(got).strip() == want)
+    ids = [rid for rid, _ in rows]
+    return {'rows_out': len(rows), 'scored': len(scored), 'filled': sum(1 for _, got in scored if got), 'correct': correct,
+            'accuracy': round(correct / max(1, len(scored)), 4),
+            'noise_left': sum(1 for rid in ids if str(rid).startswith('N')),
+            'duplicates_left': len(ids) - len(set(ids))}
+
+
+def run_suite_once(new_path, old_path, out_dir, matcher, engine):
+    app = ExcelBatchProcessor()
+    app.config.update({'engine': engine, 'speaker_matcher': matcher, 'output_folder': out_dir, 'log_level': 'ERROR'})
+    app.old_queue = [old_path]; app.running = True
+    start = time.perf_counter()
+    output = app._proc_file(new_path)
+    return time.perf_counter() - start, output, dict(app.stage_times)
+
+
+def run_stage1(old_script, new_script, use_index, vector=False):
+    app = ExcelBatchProcessor()
+    app.config.update({'s1_use_index': use_index, 's1_vector_prerank': vector, 'log_level': 'ERROR'})
+    app.running = True
+    old_list, new_list = make_data_lists(old_script, new_script)
+    start = time.perf_counter()
+    matched = app._stage1_exact_match(MemorySheet(), new_list, old_list, 6)
+    elapsed = time.perf_counter() - start
+    pairs = {item['row']: item['speaker_after_match'] for item in new_list if item['matched']}
+    return elapsed, matched, pairs
+
+
+def run_pipeline(sheet, bulk):
+    """用假工作表替换打开/保存步骤, 走完整的_proc_file流水线"""
+    app = ExcelBatchProcessor()
+    app.config.update({'engine': 'com', 'com_bulk_io': bulk, 'copy_intro': False, 'copy_speakers': False, 'log_level': 'ERROR'})
+    app._open_book = lambda path: ("内存工作簿", sheet)
+    app._save_book = lambda wb, path: None
+    app._close_book = lambda wb: None
+    app.running = True
+    start = time.perf_counter()
+    app._proc_file("基准.xlsx")
+    return time.perf_counter() - start
+
+
+def run_copy_speakers(old_path, new_script, matcher):
+    """在内存新表上跑完整的_copy_speakers, 返回(耗时, 新表F列)"""
+    app = ExcelBatchProcessor()
+    app.config.update({'speaker_matcher': matcher, 'log_level': 'ERROR'})
+    app.running = True
+    sheet = MemorySheet({(5 + i, 7): text for i, (_, text) in enumerate(new_script) if text})
+    start = time.perf_counter()
+    app._copy_speakers(sheet, old_path, 5)
+    return time.perf_counter() - start, [sheet.get(5 + i, 6) for i in range(len(new_script))]
+
+
+def bench_io(args):
+    cells = make_cells(args.rows, args.seed)
+    results = {}
+    for label, bulk in (("逐单元格", False), ("整块读写", True)):
+        sheet = MemorySheet(cells, latency=args.latency)
+        elapsed = run_pipeline(sheet, bulk)
+        results[label] = sheet
+        print(f"{label}: 调用 {sheet.calls} 次, 耗时 {elapsed:.3f}s")
+    per_cell, bulk = results["逐单元格"], results["整块读写"]
+    print("结果一致" if per_cell.cells == bulk.cells and per_cell.colors == bulk.colors else "结果不一致!")
+
+
+def bench_s1(args):
+    old_script = make_script(args.rows, args.seed)
+    new_script = perturb_script(old_script, args.seed + 1)
+    print(f"旧表 {len(old_script)} 行, 新表 {len(new_script)} 行")
+    t_index, matched, _ = run_stage1(old_script, new_script, True)
+    print(f"索引检索(全部): {t_index:.2f}s, 匹配 {matched} 行")
+    sample = new_script[:args.sample]
+    t_index_s, _, pairs_index = run_stage1(old_script, sample, True)
+    t_scan_s, _, pairs_scan = run_stage1(old_script, sample, False)
+    estimate = t_scan_s * len(new_script) / max(1, len(sample))
+    print(f"前{len(sample)}条: 索引 {t_index_s:.3f}s, 逐条扫描 {t_scan_s:.2f}s (全量扫描外推约 {estimate:.0f}s, 加速约 {estimate / max(t_index, 1e-9):.0f}倍)")
+    print("匹配结果一致" if pairs_index == pairs_scan else "匹配结果不一致!")
+    if np is None: print("未安装numpy, 跳过向量预排序"); return
+    t_vector, matched_vector, _ = run_stage1(old_script, new_script, False, vector=True)
+    _, _, pairs_vector = run_stage1(old_script, sample, False, vector=True)
+    agree = sum(1 for row in set(pairs_scan) | set(pairs_vector) if pairs_scan.get(row) == pairs_vector.get(row))
+    total = len(set(pairs_scan) | set(pairs_vector))
+    print(f"向量预排序(全部): {t_vector:.2f}s, 匹配 {matched_vector} 行; 前{len(sample)}条与逐条扫描一致 {agree}/{total} ({agree / max(1, total):.1%})")
+
+
+def bench_align(args):
+    old_script = make_script(args.rows, args.seed)
+    new_script = perturb_script(old_script, args.seed + 1)
+    print(f"旧表 {len(old_script)} 行, 新表 {len(new_script)} 行")
+    wb = Workbook(); ws = wb.active
+    for i, (speaker, text) in enumerate(old_script): ws.cell(5 + i, 6, speaker); ws.cell(5 + i, 7, text)
+    fd, old_path = tempfile.mkstemp(suffix='.xlsx'); os.close(fd)
+    try:
+        wb.save(old_path)
+        for matcher in ('heuristic', 'align'):
+            elapsed, speakers = run_copy_speakers(old_path, new_script, matcher)
+            filled = sum(1 for s in speakers if s)
+            correct = sum(1 for s, (truth, _) in zip(speakers, new_script) if s == truth)
+            print(f"{matcher}: 耗时 {elapsed:.2f}s, 填写 {filled} 行, 正确 {correct} 行 ({correct / max(1, len(new_script)):.1%})")
+    finally: os.remove(old_path)
+
+
+def legacy_classify_row(g_val, chinese_filter):
+    """清洗阶段原先的写法, 作为text基准的对照"""
+    merge_key_base = ''.join(re.findall(r'[\u4e00-\u9fff。？！]', g_val)) if chinese_filter else g_val
+    merge_key = re.sub(r'([。？！])\1{2,}', r'\1\1', merge_key_base) if chinese_filter and merge_key_base else merge_key_base
+    if chinese_filter:
+        if not re.search(r'[\u4e00-\u9fff]', g_val) and len(set(re.findall(r'[A-Za-z]', g_val))) < 3: return merge_key, "中文过滤:无中文且字母少于3种"
+    elif len(set(re.findall(r'[A-Za-z]', g_val))) < 3 and not re.search(r'[\u4e00-\u9fff0-9]', g_val): return merge_key, "常规:字母少于3种且无中文或数字"
+    return merge_key, ""
+
+
+def legacy_strip_end_punct(text, puncts, strip=str.rstrip):
+    while any(text.endswith(p) for p in puncts) and text:
+        for p in puncts:
+            if text.endswith(p): text = strip(text[:-len(p)]); break
+    return text
+
+
+def make_text_rows(rows, seed=1):
+    """清洗阶段见到的各种G列文本: 普通台词、英文噪声、数字、重复句末标点、首尾空白"""
+    rnd = random.Random(seed)
+    extras = NOISE + ['Hello world', 'abc', 'ab', '123', 'OK!!!', '……', ' 嗯 ', '第3集', 'TV', 'xyz。。。']
+    texts = []
+    for _ in range(rows):
+        if rnd.random() < 0.2: texts.append(rnd.choice(extras)); continue
+        text = ''.join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 6)))
+        texts.append(text + rnd.choice(['。', '？', '！', '，', '', '。。。', '！！！！', '？！', '…', '」', ' ', '."', 'abc']))
+    return texts
+
+
+def bench_text(args):
+    texts = make_text_rows(args.rows, args.seed)
+    print(f"{len(texts)} 行")
+    for chinese_filter in (True, False):
+        timings, results = {}, {}
+        for label, func in (("原写法", legacy_classify_row), ("预编译/查表", classify_row)):
+            start = time.perf_counter()
+            results[label] = [func(t, chinese_filter) for t in texts]
+            timings[label] = time.perf_counter() - start
+        same = results["原写法"] == results["预编译/查表"]
+        print(f"行判断(中文过滤={'开' if chinese_filter else '关'}): " + ", ".join(f"{k} {v / len(texts) * 1e6:.2f}µs/行" for k, v in timings.items())
+              + (", 结果一致" if same else ", 结果不一致!"))
+    for label, puncts, strip in (("末尾标点(说话人)", TRAILING_PUNCTUATIONS, str.rstrip), ("段落标点", tuple(PARAGRAPH_END_PUNCTS), str.strip)):
+        start = time.perf_counter(); before = [legacy_strip_end_punct(t, puncts, strip) for t in texts]; t_old = time.perf_counter() - start
+        lookup = frozenset(puncts)
+        start = time.perf_counter(); after = [strip_end_punct(t, lookup, strip) for t in texts]; t_new = time.perf_counter() - start
+        print(f"{label}去除: 原写法 {t_old / len(texts) * 1e6:.2f}µs/行, 查表 {t_new / len(texts) * 1e6:.2f}µs/行" + (", 结果一致" if before == after else ", 结果不一致!"))
+
+
+def legacy_merge_groups(texts, chinese_filter):
+    """合并重复原先的写法(先记下每行合并键, 再按行号顺序分组), 作为dedupe基准的黄金结果: [(合并键, 首行, [重复行])]"""
+    rows_del, merge_data, groups = [], {}, {}
+    for r, g_val in enumerate(texts):
+        merge_data[r], del_reason = classify_row(g_val, chinese_filter)
+        if del_reason: rows_del.append(r)
+    deleted = set(rows_del)
+    for r_num, key in sorted(merge_data.items()):
+        if r_num in deleted or not key: continue
+        groups.setdefault(key, []).append(r_num)
+    return [(key, g_rows[0], g_rows[1:]) for key, g_rows in groups.items() if len(g_rows) > 1]
+
+
+TRADITIONAL = str.maketrans('们为时学说没妈爸这么还样从会', '們為時學說沒媽爸這麼還樣從會')
+
+
+def make_dedupe_rows(rows, seed=1):
+    """带重复的台词: 同一句话的全角/半角、空白、繁体和改一个字的变体, 另有噪声行"""
+    rnd = random.Random(seed)
+    base = [''.join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 5))) + rnd.choice(['。', '？', '！', '']) for _ in range(max(1, rows // 3))]
+    texts = []
+    for _ in range(rows):
+        if rnd.random() < 0.05: texts.append(rnd.choice(NOISE)); continue
+        text = rnd.choice(base)
+        variant = rnd.random()
+        if variant < 0.1: text = text.replace('？', '?').replace('！', '!').replace('。', '.')
+        elif variant < 0.2: text = text[:2] + ' ' + text[2:] + 'ＯＫ'
+        elif variant < 0.3: text = text.translate(TRADITIONAL)
+        elif variant < 0.35 and len(text) > 4: k = rnd.randrange(len(text) - 1); text = text[:k] + rnd.choice(WORDS)[0] + text[k + 1:]
+        texts.append(text)
+    return texts
+
+
+def run_merger(texts, chinese_filter, folds=(), near_threshold=0.0):
+    merger = DuplicateMerger(chinese_filter, texts.__getitem__, folds, near_threshold)
+    for r, g_val in enumerate(texts):
+        key, del_reason = classify_row(g_val, chinese_filter)
+        if not del_reason: merger.add(r, g_val, key)
+    return merger
+
+
+def jaccard(a, b):
+    sa, sb = MinHashLSH.shingles(a), MinHashLSH.shingles(b)
+    return len(sa & sb) / len(sa | sb)
+
+
+def make_chain_rows(threshold):
+    """三句台词A、B、C: 各错开几个字, A~B和B~C达到阈值而A~C不到"""
+    chars = ''.join(dict.fromkeys(''.join(WORDS)))
+    for shift in range(1, 10):
+        rows = [chars[k * shift:k * shift + 24] + '。' for k in range(3)]
+        if jaccard(rows[0], rows[1]) >= threshold and jaccard(rows[1], rows[2]) >= threshold and jaccard(rows[0], rows[2]) < threshold: return rows
+    raise SystemExit(f"阈值 {threshold} 下构造不出链式台词")
+
+
+def bench_dedupe(args):
+    texts = make_dedupe_rows(args.rows, args.seed)
+    print(f"{len(texts)} 行")
+    ok = True
+    for chinese_filter in (True, False):
+        golden = legacy_merge_groups(texts, chinese_filter)
+        merged = run_merger(texts, chinese_filter).groups()
+        real_hash, 台词表辅助脚本._key_hash = 台词表辅助脚本._key_hash, lambda key: len(key) % 3 # 假哈希: 几乎每次都冲突
+        try: colliding = run_merger(texts, chinese_filter)
+        finally: 台词表辅助脚本._key_hash = real_hash
+        same = merged == golden and colliding.groups() == golden
+        ok = ok and same
+        print(f"黄金对照(中文过滤={'开' if chinese_filter else '关'}): {len(golden)} 组, 默认{'一致' if merged == golden else '不一致!'}, "
+              f"强制冲突({colliding.collisions} 次){'一致' if colliding.groups() == golden else '不一致!'}")
+    for folds in ((), ('width',), ('width', 'space'), ('width', 'space', 'traditional')):
+        if 'traditional' in folds and opencc is None: print("未安装opencc, 跳过繁简折叠"); continue
+        start = time.perf_counter(); merger = run_merger(texts, True, folds); elapsed = time.perf_counter() - start
+        print(f"折叠 {','.join(folds) or '无'}: {elapsed / len(texts) * 1e6:.2f}µs/行, " + ", ".join(f"{k} {v}" for k, v in merger.stats().items()))
+    exact = run_merger(texts, True).groups()
+    start = time.perf_counter(); near = run_merger(texts, True, near_threshold=args.near_threshold); groups = near.groups(); elapsed = time.perf_counter() - start
+    home = {r: first for _, first, rows in groups for r in [first] + rows}
+    kept = all(len({home.get(r) for r in [first] + rows}) == 1 for _, first, rows in exact)
+    similar = all(jaccard(key, near.key(texts[r])) >= args.near_threshold for key, _, rows in groups for r in rows)
+    ok = ok and kept and similar
+    print(f"近似重复(阈值 {args.near_threshold}): {elapsed / len(texts) * 1e6:.2f}µs/行, " + ", ".join(f"{k} {v}" for k, v in near.stats().items())
+          + (", 精确重复组均完整保留" if kept else ", 有精确重复组被拆开!") + (", 各行与首行均达到阈值" if similar else ", 有行与首行不够相似!"))
+    chain = make_chain_rows(args.near_threshold)
+    chained = [sorted([first] + rows) for _, first, rows in run_merger(chain, True, near_threshold=args.near_threshold).groups()]
+    split = chained == [[0, 1]] # A、B一组, C与A不够相似, 单独留下
+    ok = ok and split
+    print(f"链式台词(A~B {jaccard(chain[0], chain[1]):.2f}, B~C {jaccard(chain[1], chain[2]):.2f}, A~C {jaccard(chain[0], chain[2]):.2f}): 分组 {chained}"
+          + (", A、C未经B连成一组" if split else ", 分组不对!"))
+    if not ok: raise SystemExit(1)
+
+
+def run_delta_once(new_path, old_path, out_dir, matcher, delta):
+    """整表(delta=False)或增量处理一次, 输出写到out_dir; 返回(耗时, 输出路径, 沿用行数)"""
+    app = ExcelBatchProcessor()
+    app.config.update({'speaker_matcher': matcher, 'output_folder': out_dir, 'speaker_delta': delta, 'incremental': False, 'log_level': 'ERROR'})
+    app.old_queue = [old_path]; app.running = True
+    start = time.perf_counter()
+    output = app._proc_file(new_path)
+    return time.perf_counter() - start, output, app.counters['匹配行/沿用']
+
+
+def sheet_cells(path):
+    """活动表中有值或有填充色的单元格: {坐标: (值, 填充色)}"""
+    ws = load_workbook(path).active
+    return {c.coordinate: (c.value, c.fill.fgColor.rgb if c.fill.fill_type else None) for row in ws.iter_rows() for c in row
+            if c.value is not None or c.fill.fill_type}
+
+
+def bench_delta(args):
+    old_rows, new_rows, truth = make_sheet_pair(args)
+    rnd = random.Random(args.seed + 1)
+    edited = list(new_rows)
+    for i in rnd.sample([i for i, row in enumerate(new_rows) if not row[0].startswith('N')], min(args.edits, len(new_rows))):
+        edited[i] = (edited[i][0], edited[i][1] + rnd.choice(WORDS) + '。')
+    print(f"旧表 {len(old_rows)} 行, 新表 {len(new_rows)} 行, 改动 {min(args.edits, len(new_rows))} 行")
+    ok = True
+    with tempfile.TemporaryDirectory() as tmp:
+        for sub in ('new', 'old', 'full', 'delta'): os.makedirs(os.path.join(tmp, sub))
+        new_path, old_path = os.path.join(tmp, 'new', '第1集.xlsx'), os.path.join(tmp, 'old', '第1集.xlsx')
+        write_sheet(old_path, old_rows, args.header_row, True)
+        for matcher in args.matchers:
+            write_sheet(new_path, new_rows, args.header_row, False)
+            run_delta_once(new_path, old_path, os.path.join(tmp, 'delta'), matcher, False) # 上次输出
+            write_sheet(new_path, edited, args.header_row, False)
+            t_full, out_full, _ = run_delta_once(new_path, old_path, os.path.join(tmp, 'full'), matcher, False)
+            t_delta, out_delta, kept = run_delta_once(new_path, old_path, os.path.join(tmp, 'delta'), matcher, True)
+            full, delta = sheet_cells(out_full), sheet_cells(out_delta)
+            diff = sorted(k for k in set(full) | set(delta) if full.get(k) != delta.get(k))
+            ok = ok and (not diff or matcher != 'align')
+            res_full, res_delta = score_output(out_full, truth, args.header_row), score_output(out_delta, truth, args.header_row)
+            print(f"{matcher}: 整表 {t_full:.2f}s (准确率 {res_full['accuracy']:.1%}), 增量 {t_delta:.2f}s (沿用 {kept} 行, 准确率 {res_delta['accuracy']:.1%}), "
+                  + ("输出一致" if not diff else f"输出不一致! {len(diff)} 格不同, 如 {diff[:5]}" if matcher == 'align' else f"{len(diff)} 格与整表处理不同(重新匹配处), 如 {diff[:5]}"))
+    if not ok: raise SystemExit(1)
+
+
+def bench_suite(args):
+    old_rows, new_rows, truth = make_sheet_pair(args)
+    params = {k: v for k, v in vars(args).items() if k not in ('bench', 'out')}
+    report = {'time': datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(), 'params': params,
+              'old_rows': len(old_rows), 'new_rows': len(new_rows), 'runs': []}
+    with tempfile.TemporaryDirectory() as tmp:
+        for sub in ('new', 'old', 'out'): os.makedirs(os.path.join(tmp, sub))
+        new_path, old_path = os.path.join(tmp, 'new', '第1集.xlsx'), os.path.join(tmp, 'old', '第1集.xlsx')
+        write_sheet(old_path, old_rows, args.header_row, True)
+        write_sheet(new_path, new_rows, args.header_row, False)
+        out_dir = os.path.join(tmp, 'out')
+        for matcher in args.matchers:
+            walls, stages, output = [], {}, None
+            for _ in range(args.repeat): # 计时取最快一次, 与内存测量分开跑(tracemalloc本身会拖慢)
+                wall, output, st = run_suite_once(new_path, old_path, out_dir, matcher, args.engine)
+                if not walls or wall < min(walls): stages = st
+                walls.append(wall)
+            run = {'matcher': matcher, 'engine': args.engine, 'wall': round(min(walls), 4), 'walls': [round(w, 4) for w in walls],
+                   'stages': {k: round(v, 4) for k, v in stages.items()}}
+            if output: run['result'] = score_output(output, truth, args.header_row)
+            if args.memory:
+                tracemalloc.start()
+                run_suite_once(new_path, old_path, out_dir, matcher, args.engine)
+                run['peak_mem_mb'] = round(tracemalloc.get_traced_memory()[1] / 2**20, 2); tracemalloc.stop()
+            report['runs'].append(run)
+            res = run.get('result', {})
+            print(f"{matcher}: {run['wall']:.2f}s, 峰值内存 {run.get('peak_mem_mb', '-')}MB, 准确率 {res.get('accuracy', 0):.1%}, "
+                  f"残留噪声 {res.get('noise_left', '-')} 行, 残留重复 {res.get('duplicates_left', '-')} 行")
+            for stage, secs in sorted(run['stages'].items(), key=lambda kv: -kv[1])[:8]: print(f"    {stage}: {secs:.3f}s")
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f: f.write(text + "\n")
+        print(f"结果已写入 {args.out}")
+    else: print(text)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='bench', required=True)
+    p_io = sub.add_parser('io', help="逐单元格 vs 整块读写")
+    p_io.add_argument('--rows', type=int, default=3000)
+    p_io.add_argument('--latency', type=float, default=0.0, help="每次调用模拟耗时(秒)")
+    p_io.add_argument('--seed', type=int, default=1)
+    p_s1 = sub.add_parser('s1', help="Stage 1 索引检索 vs 逐条扫描 vs 向量预排序")
+    p_s1.add_argument('--rows', type=int, default=5000)
+    p_s1.add_argument('--sample', type=int, default=100, help="逐条扫描只跑前N条新台词")
+    p_s1.add_argument('--seed', type=int, default=1)
+    p_al = sub.add_parser('align', help="heuristic vs align 说话人匹配")
+    p_al.add_argument('--rows', type=int, default=1000)
+    p_al.add_argument('--seed', type=int, default=1)
+    p_tx = sub.add_parser('text', help="清洗阶段行判断和句末标点处理: 原写法 vs 预编译正则/查表")
+    p_tx.add_argument('--rows', type=int, default=50000)
+    p_tx.add_argument('--seed', type=int, default=1)
+    p_dd = sub.add_parser('dedupe', help="重复合并黄金对照(默认设置与原写法一致)和各折叠的分组统计")
+    p_dd.add_argument('--rows', type=int, default=100000)
+    p_dd.add_argument('--seed', type=int, default=1)
+    p_dd.add_argument('--near-threshold', type=float, default=0.7, help="近似重复合并的相似度阈值")
+    p_dl = sub.add_parser('delta', help="说话人增量复制与整表处理的输出对照")
+    p_dl.add_argument('--rows', type=int, default=2000, help="旧表台词行数")
+    p_dl.add_argument('--edits', type=int, default=15, help="新表改动的行数")
+    p_dl.add_argument('--speakers', type=int, default=5)
+    p_dl.add_argument('--dup-rate', type=float, default=0.03)
+    p_dl.add_argument('--merge-rate', type=float, default=0.05)
+    p_dl.add_argument('--noise-rate', type=float, default=0.05)
+    p_dl.add_argument('--header-row', type=int, default=4)
+    p_dl.add_argument('--matchers', nargs='+', default=['heuristic', 'align'], choices=['heuristic', 'align'])
+    p_dl.add_argument('--seed', type=int, default=1)
+    p_su = sub.add_parser('suite', help="生成台词表并跑完整流水线, 输出分阶段耗时/内存/准确率JSON")
+    p_su.add_argument('--rows', type=int, default=2000, help="旧表台词行数")
+    p_su.add_argument('--speakers', type=int, default=5, help="说话人数量")
+    p_su.add_argument('--dup-rate', type=float, default=0.03, help="新表紧邻重复行比例")
+    p_su.add_argument('--merge-rate', type=float, default=0.05, help="旧表多句台词(新表拆成多行)比例")
+    p_su.add_argument('--noise-rate', type=float, default=0.05, help="新表英文噪声行比例")
+    p_su.add_argument('--header-row', type=int, default=4, help="表头所在行, 0为无表头(数据从第5行开始)")
+    p_su.add_argument('--matchers', nargs='+', default=['heuristic', 'align'], choices=['heuristic', 'align'])
+    p_su.add_argument('--engine', default='openpyxl', choices=['openpyxl', 'com'])
+    p_su.add_argument('--repeat', type=int, default=1, help="计时重复次数, 取最快一次")
+    p_su.add_argument('--memory', action=argparse.BooleanOptionalAction, default=True, help="额外跑一次tracemalloc记录峰值内存")
+    p_su.add_argument('--seed', type=int, default=1)
+    p_su.add_argument('--out', help="JSON结果文件, 默认输出到屏幕")
+    args = parser.parse_args()
+    {'io': bench_io, 's1': bench_s1, 'align': bench_align, 'text': bench_text, 'dedupe': bench_dedupe, 'delta': bench_delta, 'suite': bench_suite}[args.bench](args)
+
+
+if __name__ == "__main__":
+    main()
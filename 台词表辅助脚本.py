@@ -1,1220 +1,3017 @@
-import os
-import re
-import tkinter as tk
-from tkinter import ttk, filedialog, messagebox, scrolledtext
-import win32com.client as win32 
-from datetime import datetime
-import pythoncom
-from openpyxl import load_workbook 
-import difflib
-import traceback
-import sys
-
-# --- COM Constants ---
-MSO_TRUE = -1 
-MSO_FALSE = 0 
-MSO_SCALE_FROM_TOP_LEFT = 0
-
-# Shape types
-MSO_PICTURE = 13
-MSO_LINKED_PICTURE = 16
-MSO_PLACEHOLDER = 14
-
-class ExcelBatchProcessor:
-    def __init__(self, root):
-        self.root = root
-        self.running = False
-        self.setup_config()
-        self.setup_ui()
-        self.excel = None
-        self.file_queue = []
-        self.old_queue = []
-
-    def setup_config(self):
-        self.config = {
-            'col_e': 'E', 'col_g': 'G', 'col_f_speaker': 'F',
-            'chinese_filter': True, 'merge_duplicates': True,
-            'copy_intro': True, 'copy_speakers': True,
-            'speaker_match_threshold': 0.6, 'exact_match_threshold': 0.95,
-            'exact_match_length_ratio_threshold': 0.7,
-            'segment_coherence_weight': 0.25, 'segment_length_ratio_weight': 0.15,
-            'segment_similarity_weight': 0.60, 
-            'content_guess_confidence_threshold': 0.7,
-            'old_file_match_threshold': 0.7,
-            'image_scale_factor': 0.9,
-            'last_folder': os.getcwd(), 'output_folder': os.getcwd(),
-            'log_level': "INFO"
-        }
-
-    def setup_ui(self):
-        self.root.title("Excel高级批量处理器 v8.16 (UI属性修复)") 
-        self.root.geometry("900x750")
-
-        top_controls_frame = ttk.Frame(self.root)
-        top_controls_frame.pack(pady=10, padx=10, fill=tk.X)
-
-        ttk.Label(top_controls_frame, text="新表:").grid(row=0, column=0, padx=(0,5), pady=3, sticky='w')
-        ttk.Button(top_controls_frame, text="选择新表文件", command=self.select_file).grid(row=0, column=1, padx=2, pady=3, sticky='ew')
-        ttk.Button(top_controls_frame, text="选择新表文件夹", command=self.select_folder).grid(row=0, column=2, padx=2, pady=3, sticky='ew')
-
-        ttk.Label(top_controls_frame, text="旧表:").grid(row=1, column=0, padx=(0,5), pady=3, sticky='w')
-        ttk.Button(top_controls_frame, text="选择旧表文件", command=self.select_old_file).grid(row=1, column=1, padx=2, pady=3, sticky='ew')
-        ttk.Button(top_controls_frame, text="选择旧表文件夹", command=self.select_old_folder).grid(row=1, column=2, padx=2, pady=3, sticky='ew')
-
-        ttk.Button(top_controls_frame, text="选择输出位置", command=self.select_output_folder).grid(row=2, column=0, columnspan=1, padx=(0,2), pady=(10,3), sticky='ew')
-
-        s = ttk.Style(); s.configure("Accent.TButton", font=('Segoe UI',9,'bold'), foreground='green'); s.configure("Stop.TButton", font=('Segoe UI',9,'bold'), foreground='red')
-        ttk.Button(top_controls_frame, text="开始处理", command=self.start_processing, style="Accent.TButton").grid(row=2, column=1, padx=2, pady=(10,3), ipady=4, sticky='ew')
-        ttk.Button(top_controls_frame, text="停止", command=self.stop_processing, style="Stop.TButton").grid(row=2, column=2, padx=2, pady=(10,3), ipady=4, sticky='ew')
-
-        top_controls_frame.columnconfigure(1, weight=1); top_controls_frame.columnconfigure(2, weight=1)
-
-        cfg_frame = ttk.LabelFrame(self.root, text="处理配置")
-        cfg_frame.pack(pady=5, padx=10, fill=tk.X)
-
-        # E, G, F 列输入框 - 使用 setattr 创建 self.entry_e, self.entry_g, self.entry_speaker
-        cols_cfg_data = [("内容列(E):", 'col_e'), ("文本列(G):", 'col_g'), ("说话人列(F):", 'col_f_speaker')]
-        for i, (text, cfg_key) in enumerate(cols_cfg_data):
-            ttk.Label(cfg_frame, text=text).grid(row=0, column=i*2, padx=5, pady=3, sticky='w')
-            entry = ttk.Entry(cfg_frame, width=5)
-            entry.insert(0, self.config[cfg_key])
-            entry.grid(row=0, column=i*2+1, padx=5, pady=3)
-            # setattr f"entry_{cfg_key.split('_')[-1]}" 会创建 self.entry_e, self.entry_g, self.entry_speaker
-            setattr(self, f"entry_{cfg_key.split('_')[-1]}", entry) 
-
-        # 复选框配置 - 使用明确的属性名 self.var_ch, self.var_mg, self.var_int, self.var_spk
-        self.var_ch = tk.BooleanVar(value=self.config['chinese_filter'])
-        ttk.Checkbutton(cfg_frame, text="启用中文过滤", variable=self.var_ch).grid(row=1, column=0, columnspan=2, padx=5, pady=3, sticky='w')
-        
-        self.var_mg = tk.BooleanVar(value=self.config['merge_duplicates'])
-        ttk.Checkbutton(cfg_frame, text="启用合并重复", variable=self.var_mg).grid(row=1, column=2, columnspan=2, padx=5, pady=3, sticky='w')
-        
-        self.var_int = tk.BooleanVar(value=self.config['copy_intro'])
-        ttk.Checkbutton(cfg_frame, text="启用简介复制", variable=self.var_int).grid(row=1, column=4, columnspan=2, padx=5, pady=3, sticky='w')
-        
-        self.var_spk = tk.BooleanVar(value=self.config['copy_speakers'])
-        ttk.Checkbutton(cfg_frame, text="启用说话人复制", variable=self.var_spk).grid(row=2, column=0, columnspan=2, padx=5, pady=3, sticky='w')
-
-        # 阈值输入框 - 使用明确的属性名 self.entry_th_speaker, self.entry_th_filename
-        ttk.Label(cfg_frame, text="内容匹配阈值:").grid(row=2, column=2, padx=5, pady=3, sticky='w')
-        self.entry_th_speaker = ttk.Entry(cfg_frame, width=5)
-        self.entry_th_speaker.insert(0, str(self.config['speaker_match_threshold']))
-        self.entry_th_speaker.grid(row=2, column=3, padx=5, pady=3)
-        
-        ttk.Label(cfg_frame, text="文件名匹配阈值:").grid(row=2, column=4, padx=5, pady=3, sticky='w')
-        self.entry_th_filename = ttk.Entry(cfg_frame, width=5)
-        self.entry_th_filename.insert(0, str(self.config['old_file_match_threshold']))
-        self.entry_th_filename.grid(row=2, column=5, padx=5, pady=3)
-
-        log_frame = ttk.LabelFrame(self.root, text="日志输出")
-        log_frame.pack(pady=5, padx=10, fill=tk.BOTH, expand=True)
-        self.log_text = scrolledtext.ScrolledText(log_frame, wrap=tk.WORD, font=("Consolas", 9))
-        self.log_text.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
-
-    def log(self, message, level="INFO"):
-        level_map={"TRACE":0,"DEBUG":1,"INFO":2,"WARNING":3,"ERROR":4,"CRITICAL":5}
-        cfg_log_lvl_str=self.config.get('log_level',"INFO").upper()
-        cfg_log_lvl=level_map.get(cfg_log_lvl_str,2)
-        msg_lvl=level_map.get(level.upper(),2)
-        if msg_lvl>=cfg_log_lvl:
-            ts=datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            self.log_text.insert(tk.END,f"[{level.upper()}] {ts} - {message}\n")
-            self.log_text.see(tk.END)
-            if self.root and self.root.winfo_exists(): self.root.update_idletasks()
-
-    def log_with_context(self, message, row=None, col_idx=None, level="INFO"):
-        ctx_info=""
-        if row is not None: ctx_info=f"行{row}"
-        if col_idx is not None:
-            try:col_ltr=self._idx2col(int(col_idx))
-            except:col_ltr=str(col_idx)
-            ctx_info+=f":{col_ltr}"
-        full_msg=f"{ctx_info} - {message}" if ctx_info else message
-        self.log(full_msg,level)
-
-    def select_file(self):
-        if self.running: messagebox.showwarning("提示","处理中..."); return
-        fp=filedialog.askopenfilename(title="选新表",filetypes=[("Excel","*.xlsx")],initialdir=self.config.get('last_folder',os.getcwd()))
-        if fp:self.config['last_folder']=os.path.dirname(fp);self.file_queue=[fp];self.log(f"选新表(单):{os.path.basename(fp)}")
-
-    def select_folder(self):
-        if self.running: messagebox.showwarning("提示","处理中..."); return
-        dp=filedialog.askdirectory(title="选新表文件夹",initialdir=self.config.get('last_folder',os.getcwd()))
-        if dp:
-            self.config['last_folder']=dp
-            self.file_queue=[os.path.join(dp,f) for f in os.listdir(dp) if f.lower().endswith('.xlsx') and not f.startswith('~')]
-            self.log(f"选新表文件夹:{dp}({len(self.file_queue)}个)" if self.file_queue else f"新表文件夹{dp}无.xlsx","INFO" if self.file_queue else "WARNING")
-
-    def select_old_file(self):
-        if self.running: messagebox.showwarning("提示","处理中..."); return
-        fp=filedialog.askopenfilename(title="选旧表",filetypes=[("Excel","*.xlsx")],initialdir=self.config.get('last_folder',os.getcwd()))
-        if fp:self.old_queue=[fp];self.log(f"选旧表(单):{os.path.basename(fp)}")
-
-    def select_old_folder(self):
-        if self.running: messagebox.showwarning("提示","处理中..."); return
-        dp=filedialog.askdirectory(title="选旧表文件夹",initialdir=self.config.get('last_folder',os.getcwd()))
-        if dp:
-            self.old_queue=[os.path.join(dp,f) for f in os.listdir(dp) if f.lower().endswith('.xlsx') and not f.startswith('~')]
-            self.log(f"选旧表文件夹:{dp}({len(self.old_queue)}个)" if self.old_queue else f"旧表文件夹{dp}无.xlsx","INFO" if self.old_queue else "WARNING")
-
-    def select_output_folder(self):
-        dp=filedialog.askdirectory(title="选输出位置",initialdir=self.config.get('output_folder',os.getcwd()))
-        if dp:self.config['output_folder']=dp;self.log(f"输出设为:{dp}")
-
-    def start_processing(self):
-        if self.running:messagebox.showwarning("处理中...","当前任务进行中。");return
-        if not self.file_queue:messagebox.showerror("错误","请先选新表。");return
-        self.update_cfg_from_ui() # 调用修正后的配置读取方法
-        if self.config.get('copy_speakers') and not self.old_queue:messagebox.showerror("错误","启用说话人复制但未选旧表。");return
-        self.running=True;self.log("===== 处理开始 =====","INFO")
-        try:
-            pythoncom.CoInitialize()
-            self.excel=win32.gencache.EnsureDispatch('Excel.Application')
-            self.excel.Visible=False;self.excel.DisplayAlerts=False
-            for i,fp in enumerate(self.file_queue):
-                if not self.running:self.log("处理被中止。","INFO");break
-                self.log(f"--- 处理第{i+1}/{len(self.file_queue)}个文件:{os.path.basename(fp)} ---","INFO")
-                self._proc_file(fp)
-            if self.running:self.log("所有文件处理完毕。","INFO");messagebox.showinfo("完成","所有文件处理完毕！")
-        except Exception as e:
-            self.log(f"主流程严重错误:{e}","CRITICAL");self.log(traceback.format_exc(),"DEBUG")
-            messagebox.showerror("严重错误",f"发生错误，详见日志:{e}")
-        finally:
-            if self.excel:
-                try:self.excel.Quit()
-                except Exception as eq:self.log(f"关Excel出错:{eq}","ERROR")
-                self.excel=None
-            pythoncom.CoUninitialize()
-            self.running=False;self.log("===== 处理结束 =====","INFO")
-
-    def stop_processing(self):
-        if self.running:self.running=False;self.log("用户请求停止...");messagebox.showinfo("停止请求","将尝试停止。")
-        else:self.log("当前无处理任务。","INFO")
-
-    def update_cfg_from_ui(self):
-        try:
-            self.config.update({
-                'col_e': self.entry_e.get().upper(),             # 使用 self.entry_e
-                'col_g': self.entry_g.get().upper(),             # 使用 self.entry_g
-                'col_f_speaker': self.entry_speaker.get().upper(),# 使用 self.entry_speaker
-                'chinese_filter': self.var_ch.get(),             # 使用 self.var_ch
-                'merge_duplicates': self.var_mg.get(),           # 使用 self.var_mg
-                'copy_intro': self.var_int.get(),                # 使用 self.var_int
-                'copy_speakers': self.var_spk.get(),             # 使用 self.var_spk (这个之前是正确的)
-                'speaker_match_threshold': float(self.entry_th_speaker.get()),
-                'old_file_match_threshold': float(self.entry_th_filename.get())
-            })
-            log_cfg={k:v for k,v in self.config.items() if k not in ['last_folder','output_folder']}
-            self.log(f"配置已从UI更新: {log_cfg}", "DEBUG")
-        except ValueError: # 特别是float转换
-            self.log("阈值输入无效，请输入数字。", "ERROR"); messagebox.showerror("配置错误", "匹配阈值必须是数字。")
-            # 保留之前的有效值或设置一个安全的默认值
-            self.config['speaker_match_threshold'] = self.config.get('speaker_match_threshold', 0.6)
-            self.config['old_file_match_threshold'] = self.config.get('old_file_match_threshold', 0.7)
-        except AttributeError as ae: 
-             self.log(f"UI配置读取错误: {ae}. 请检查UI控件变量名是否与代码中使用的属性名一致。", "CRITICAL")
-             messagebox.showerror("UI错误", f"读取配置控件时出错: {ae}")
-
-
-    def _normalize_name_for_matching(self, filename_no_ext):
-        name = re.sub(r'[【《\(（\[].*?[】》\)）\]]', '', filename_no_ext) 
-        name = name.replace("【】", "") 
-        common_affixes = [" - 译制台词表", "译制台词表", " - subtitles", "subtitles", " - 副本", "副本"]
-        for affix in common_affixes:
-            if name.lower().endswith(affix.lower()): name = name[:-len(affix)]
-            if name.lower().startswith(affix.lower()): name = name[len(affix):]
-        name = name.replace("仅字幕", "").replace(" ", "").lower().strip('-_. ')
-        name = re.sub(r'[-_]', '', name)
-        return name
-
-    def _match_old(self, new_filepath):
-        # 防止新旧表相同
-        for old_fp in self.old_queue:
-            if os.path.normpath(os.path.abspath(old_fp)) == os.path.normpath(os.path.abspath(new_filepath)):
-                self.log(f"警告: 新表和旧表是同一个文件 '{os.path.basename(old_fp)}'，无法从自身复制", "WARNING")
-                return None
-        
-        # 原有的匹配逻辑...
-        base_new_orig = os.path.basename(new_filepath)
-        norm_new = self._normalize_name_for_matching(os.path.splitext(base_new_orig)[0])
-        if not norm_new: self.log(f"新文件名 '{base_new_orig}' 规范化后为空。", "WARNING"); return None
-        
-        best_path, best_sim = None, 0.0
-        if not self.old_queue: self.log("旧表队列为空。", "WARNING"); return None
-        self.log(f"新表规范名: '{norm_new}' (来自 '{base_new_orig}')", "DEBUG")
-
-        for old_fp in self.old_queue:
-            norm_old = self._normalize_name_for_matching(os.path.splitext(os.path.basename(old_fp))[0])
-            if not norm_old: self.log(f"旧文件名 '{os.path.basename(old_fp)}' 规范化后为空, 跳过。", "TRACE"); continue
-            sim = difflib.SequenceMatcher(None, norm_new, norm_old).ratio()
-            self.log(f"  比较旧表: '{norm_old}' (来自 '{os.path.basename(old_fp)}') vs '{norm_new}' -> 相似度: {sim:.3f}", "TRACE")
-            if sim > best_sim: best_sim = sim; best_path = old_fp
-        
-        threshold = self.config.get('old_file_match_threshold', 0.7)
-        if best_sim >= threshold:
-            self.log(f"为 '{base_new_orig}' 找到旧表: '{os.path.basename(best_path)}' (相似度: {best_sim:.3f})", "INFO")
-            return best_path
-        else:
-            self.log(f"未能为 '{base_new_orig}' 找到足够相似旧表 (最高相似度 {best_sim:.3f} < 阈值 {threshold})", "WARNING")
-            return None
-
-    def _proc_file(self, newp):
-        name = os.path.basename(newp)
-        start_time = datetime.now()
-        current_stage = "初始化"
-        wb, ws = None, None
-        g_col_idx_local = self._col2idx(self.config['col_g']) # 在try块外先定义，确保finally中可用(如果需要)
-
-        def detect_start_row(sheet_obj, col_idx, sheet_name_log):
-            # ... (此函数实现与上一版相同)
-            self.log(f"检测 '{sheet_name_log}' (列 {self._idx2col(col_idx)}) 数据起始行...", "DEBUG")
-            for r_detect in range(1, 16):
-                try:
-                    val = str(sheet_obj.Cells(r_detect, col_idx).Value or "").lower()
-                    if val and any(h in val for h in ["序号", "台词", "说话人", "line id", "dialogue", "start time"]):
-                        self.log(f"'{sheet_name_log}': 检测到表头 '{val}' 在行 {r_detect}, 数据从行 {r_detect+1} 开始。", "INFO")
-                        return r_detect + 1
-                except Exception as e_detect_cell: 
-                    self.log(f"检测起始行单元格({r_detect},{col_idx})出错: {e_detect_cell}", "TRACE")
-            d_start = 5; self.log(f"'{sheet_name_log}': 未检测到表头 (检查前15行), 默认从行 {d_start} 开始。", "INFO"); return d_start
-
-        try:
-            current_stage = "打开文件"; wb = self.excel.Workbooks.Open(newp)
-            current_stage = "获取工作表"
-            try: ws = wb.ActiveSheet; self.log(f"打开 '{name}', 活动表: '{ws.Name}'", "INFO")
-            except: 
-                if wb.Sheets.Count > 0: ws = wb.Sheets(1); self.log(f"'{name}': 用首个表 '{ws.Name}'", "WARNING")
-                else: self.log(f"'{name}': 无工作表!", "ERROR"); wb.Close(False); return
-
-            # g_col_idx_local 在上面定义了
-            DATA_START_ROW = detect_start_row(ws, g_col_idx_local, ws.Name)
-
-            current_stage = "匹配旧表"; old_path = self._match_old(newp)
-            # 修正：使用 self.var_spk (这是在 setup_ui 中创建的 BooleanVar 的正确属性名)
-            if self.config.get('copy_speakers') and self.var_spk.get() and not old_path: 
-                self.log(f"警告: 为 '{name}' 启用说话人复制但未找到旧表。", "WARNING")
-
-            # 修正：使用 self.var_int
-            if self.config.get('copy_intro') and self.var_int.get() and old_path:
-                current_stage = "复制简介"; self._copy_intro(ws, old_path)
-            if not self.running: self.log("中止于简介后"); wb.Close(False); return
-
-            # 修正：使用 self.var_spk
-            if self.config.get('copy_speakers') and self.var_spk.get() and old_path: 
-                current_stage = "复制说话人"; self._copy_speakers(ws, old_path, DATA_START_ROW)
-            if not self.running: self.log("中止于说话人复制后"); wb.Close(False); return
-
-            current_stage = "内容清洗/合并"; last_row = DATA_START_ROW - 1
-            try: last_row = ws.Cells.Find("*", SearchOrder=win32.constants.xlByRows, SearchDirection=win32.constants.xlPrevious).Row
-            except: self.log(f"'{ws.Name}': 清洗前无法确定最后行", "WARNING")
-
-            r_loop_local = DATA_START_ROW # 初始化循环变量，确保在except块中可引用
-            if last_row >= DATA_START_ROW:
-                rows_del, merge_data = [], {}
-                e_col_idx = self._col2idx(self.config['col_e'])
-                for r_loop_local in range(DATA_START_ROW, last_row + 1):
-                    if not self.running: break
-                    g_val = str(ws.Cells(r_loop_local, g_col_idx_local).Value or "").strip()
-                    del_reason, should_del = "", False
-                    merge_key_base = ''.join(re.findall(r'[\u4e00-\u9fff。？！]', g_val)) if self.config.get('chinese_filter') else g_val
-                    merge_data[r_loop_local] = re.sub(r'([。？！])\1{2,}', r'\1\1', merge_key_base) if self.config.get('chinese_filter') and merge_key_base else merge_key_base
-                    
-                    if self.config.get('chinese_filter'): # 使用 .get() 避免KeyError
-                        if not re.search(r'[\u4e00-\u9fff]', g_val) and len(set(re.findall(r'[A-Za-z]', g_val))) < 3:
-                            should_del, del_reason = True, "中文过滤:无中文且字母少于3种"
-                    elif len(set(re.findall(r'[A-Za-z]', g_val))) < 3 and not re.search(r'[\u4e00-\u9fff0-9]', g_val):
-                        should_del, del_reason = True, "常规:字母少于3种且无中文或数字"
-                    if should_del: rows_del.append(r_loop_local); self.log_with_context(f"标记删除({del_reason}):'{g_val[:30]}'", r_loop_local, g_col_idx_local, "DEBUG")
-                if not self.running: self.log("中止于清洗判断后"); wb.Close(False); return
-
-                if self.config.get('merge_duplicates'):
-                    groups = {}
-                    for r_num, key in sorted(merge_data.items()):
-                        if r_num in rows_del or not key: continue
-                        if key not in groups: groups[key] = []
-                        groups[key].append(r_num)
-                    for key, g_rows in groups.items():
-                        if not self.running: break
-                        if len(g_rows) > 1:
-                            try:
-                                ws.Cells(g_rows[0], e_col_idx).Value = ws.Cells(g_rows[-1], e_col_idx).Value
-                                rows_del.extend(g_rows[1:])
-                                self.log(f"合并'{key[:20]}..':保留行{g_rows[0]},E列来自行{g_rows[-1]},删{g_rows[1:]}", "DEBUG")
-                            except Exception as me: self.log(f"合并'{key[:20]}..'出错:{me}", "WARNING")
-                if not self.running: self.log("中止于合并后"); wb.Close(False); return
-
-                if rows_del:
-                    unique_del = sorted(list(set(rows_del)), reverse=True)
-                    self.log(f"准备删除 {len(unique_del)} 行...", "INFO")
-                    for r_d in unique_del:
-                        if not self.running: break
-                        try: ws.Rows(r_d).Delete()
-                        except Exception as de: self.log_with_context(f"删除失败:{de}", r_d, level="WARNING")
-                else: self.log("内容清洗:无行标记删除", "INFO")
-            else: self.log(f"'{ws.Name}': 数据行({last_row})<起始行({DATA_START_ROW}),跳过清洗", "INFO")
-            if not self.running: self.log("中止于删除行后"); wb.Close(False); return
-            
-            current_stage = "段落标点调整"; final_lr_para_punct = DATA_START_ROW - 1
-            try: final_lr_para_punct = ws.Cells.Find("*", SearchOrder=win32.constants.xlByRows, SearchDirection=win32.constants.xlPrevious).Row
-            except: self.log(f"'{ws.Name}': 段落标点前无法确定最后行", "WARNING")
-            if final_lr_para_punct >= DATA_START_ROW: self._apply_default_punctuation_to_g_column(ws, final_lr_para_punct, DATA_START_ROW)
-            else: self.log(f"'{ws.Name}': 段落标点前数据行不足,跳过", "INFO")
-            if not self.running: self.log("中止于段落标点后"); wb.Close(False); return
-
-            current_stage = "最终标点检查"; final_lr_final_punct = DATA_START_ROW - 1
-            try: final_lr_final_punct = ws.Cells.Find("*", SearchOrder=win32.constants.xlByRows, SearchDirection=win32.constants.xlPrevious).Row
-            except: self.log(f"'{ws.Name}': 最终标点前无法确定最后行", "WARNING")
-            if final_lr_final_punct >= DATA_START_ROW: self._final_ensure_punctuation(ws, final_lr_final_punct, DATA_START_ROW, g_col_idx_local)
-            else: self.log(f"'{ws.Name}': 最终标点前数据行不足,跳过", "INFO")
-            if not self.running: self.log("中止于最终标点后"); wb.Close(False); return
-
-            current_stage = "调整图片"; self.adjust_images(ws)
-            if not self.running: self.log("中止于图片调整后"); wb.Close(False); return
-
-            current_stage = "保存文件"; out_name = f"改_{name}"
-            out_path = os.path.normpath(os.path.join(self.config['output_folder'], out_name))
-            try: wb.SaveAs(out_path, FileFormat=51); self.log(f"✅ 保存到: {out_path} [耗时: {(datetime.now()-start_time).total_seconds():.2f}s]")
-            except Exception as se:
-                self.log(f"保存 '{out_path}' 失败: {se}. 尝试备用名...", "ERROR")
-                try:
-                    bk_path = os.path.join(self.config['output_folder'], f"改_{os.path.splitext(name)[0]}_{datetime.now().strftime('%H%M%S')}{os.path.splitext(name)[1]}")
-                    wb.SaveAs(bk_path, FileFormat=51); self.log(f"✅ 已用备用名保存: {bk_path}")
-                except Exception as sbe: self.log(f"备用名保存也失败: {sbe}", "CRITICAL")
-        except Exception as epf:
-            ec_list = traceback.extract_tb(sys.exc_info()[2]); ef = ec_list[-1] if ec_list else None
-            efn,eln,efunc = (os.path.basename(ef.filename),ef.lineno,ef.name) if ef else ("N/A",)*3
-            lmsg = f"处理'{name}'阶段'{current_stage}'失败:{epf} ({efn}:{eln} {efunc})"
-            self.log(lmsg, "ERROR"); self.log(traceback.format_exc(), "DEBUG")
-            if 'r_loop_local' in locals() and isinstance(r_loop_local,int) and ws: 
-                try: 
-                    g_val_err = str(ws.Cells(r_loop_local,g_col_idx_local).Value or '')[:30]
-                    f_val_err = str(ws.Cells(r_loop_local,self._col2idx(self.config['col_f_speaker'])).Value or '')[:20]
-                    self.log_with_context(f"错误可能在行附近. G='{g_val_err}', F='{f_val_err}'",r_loop_local,level="DEBUG")
-                except Exception as e_ctx_log: self.log(f"记录错误上下文时出错: {e_ctx_log}", "WARNING")
-        finally: # _proc_file 的 finally
-            if wb: 
-                try: wb.Close(SaveChanges=False)
-                except Exception as ec: self.log(f"关闭工作簿 '{name}' 出错:{ec}", "ERROR")
-
-    def _get_trailing_punctuation(self, text_input):
-        if not text_input or not isinstance(text_input, str): return ""
-        m = re.search(r'([。！？，.,!?:;\uff0c\uff1b\uff1a\uff1f\uff01\uff0e\s]+)$', text_input)
-        return m.group(1).strip() if m else ""
-
-    def _apply_default_punctuation_to_g_column(self, ws_punct, last_valid_row, data_start_row_punct):
-        if not ws_punct or last_valid_row < data_start_row_punct: self.log(f"段落标点: 无效参数或数据不足 (行{data_start_row_punct}-{last_valid_row})", "WARNING"); return
-        self.log(f"段落标点调整 (行 {data_start_row_punct}-{last_valid_row})...", "INFO")
-        g_col, f_col = self._col2idx(self.config['col_g']), self._col2idx(self.config['col_f_speaker'])
-        valid_end_puncts = ('。','！','？','.','!','?',';','；',':','：',')','）','"','\'','”','’',']','】','》','…','>','}','\uff0e','\uff01','\uff1f','\uff1b','\uff1a','\uff09','\uff02','\u201d','\u2019','\u300b','\u2026')
-        modified, paras = 0, []; curr_para_rows, curr_speaker = [], "<INIT_SPEAKER_ADP>"
-        for r_p in range(data_start_row_punct, last_valid_row + 1):
-            if not self.running: break
-            try:
-                spk = str(ws_punct.Cells(r_p, f_col).Value or "").strip()
-                dlg = str(ws_punct.Cells(r_p, g_col).Value or "").strip()
-                if not dlg: 
-                    if curr_para_rows: paras.append(list(curr_para_rows)); curr_para_rows.clear()
-                    curr_speaker = "<RESET_SPEAKER_EMPTY_DLG_ADP>" 
-                    continue
-                if spk != curr_speaker:
-                    if curr_para_rows: paras.append(list(curr_para_rows)); curr_para_rows.clear()
-                    curr_speaker = spk
-                curr_para_rows.append(r_p)
-            except Exception as epd: self.log_with_context(f"段落识别错:{epd}",r_p,level="WARNING")
-        if curr_para_rows: paras.append(list(curr_para_rows))
-        if not paras: self.log("段落标点:未识别到段落", "INFO"); return
-        self.log(f"段落标点:识别到 {len(paras)} 段", "DEBUG")
-        for para_r_list in paras:
-            if not self.running or not para_r_list: break
-            num_lines = len(para_r_list)
-            for i_line, r_line_val in enumerate(para_r_list):
-                try:
-                    cell = ws_punct.Cells(r_line_val, g_col); text = str(cell.Value or "").strip()
-                    if not text: continue
-                    is_last, has_punct = (i_line == num_lines - 1), any(text.endswith(p) for p in valid_end_puncts)
-                    if is_last and not has_punct: cell.Value = text + "。"; modified +=1; self.log_with_context(f"段落标点:末行'{text[:20]}'加。",r_line_val,g_col,"TRACE")
-                    elif not is_last and has_punct:
-                        orig_t = text
-                        while any(text.endswith(p) for p in valid_end_puncts) and text:
-                            changed_in_iter = False
-                            for p_rem in valid_end_puncts: 
-                                if text.endswith(p_rem): text = text[:-len(p_rem)].strip(); changed_in_iter=True; break
-                            if not changed_in_iter: break 
-                        if text != orig_t: cell.Value = text; modified+=1; self.log_with_context(f"段落标点:中行'{orig_t[:20]}'去标点为'{text[:20]}'",r_line_val,g_col,"TRACE")
-                except Exception as epc: self.log_with_context(f"段落标点单元格操作错:{epc}",r_line_val,g_col,"WARNING")
-        self.log(f"段落标点调整完毕,修改 {modified} 处", "INFO")
-
-    def _final_ensure_punctuation(self, ws, last_row, data_start_row, g_col_idx):
-        if not ws or last_row < data_start_row: self.log("最终标点:无效参数或数据不足", "INFO"); return
-        self.log(f"最终标点检查 (行 {data_start_row}-{last_row})...", "INFO")
-        modified_count = 0
-        valid_endings = ('。','！','？','.','!','?',';','；',':','：',')','）','"','\'','”','’',']','】','》','…','>','}','\uff0e','\uff01','\uff1f','\uff1b','\uff1a','\uff0c','\uff09','\u201d','\u2019','\u300b','\u2026',',')
-
-        for r_fep in range(data_start_row, last_row + 1):
-            if not self.running: break
-            try:
-                cell = ws.Cells(r_fep, g_col_idx)
-                text = str(cell.Value or '').strip()
-                if text and not any(text.endswith(p) for p in valid_endings):
-                    new_val = text + "。"
-                    cell.Value = new_val; modified_count += 1
-                    self.log_with_context(f"最终标点: 为 '{text[:30]}' 加句号 -> '{new_val[:31]}'", r_fep, g_col_idx, "TRACE")
-            except Exception as efp_cell: self.log_with_context(f"最终标点检查行 {r_fep} 出错: {efp_cell}", r_fep, g_col_idx, "WARNING")
-        self.log(f"最终标点检查: {modified_count} 行补充句号" if modified_count else "最终标点检查: 无需补充", "INFO")
-
-    def _copy_intro(self, ws_intro, old_path_intro):
-        old_wb_intro_local = None # 使用局部变量
-        try:
-            self.log(f"尝试从旧表 '{os.path.basename(old_path_intro)}' 复制简介...", "INFO")
-            old_wb_intro_local = load_workbook(old_path_intro, data_only=True)
-            old_ws_name_intro = '台词管理' if '台词管理' in old_wb_intro_local.sheetnames else old_wb_intro_local.sheetnames[0]
-            old_ws_intro_obj = old_wb_intro_local[old_ws_name_intro]
-            g_col_idx_old_intro = self._col2idx(self.config['col_g'])
-            intro_text_val = old_ws_intro_obj.cell(row=2, column=g_col_idx_old_intro).value or ''
-            intro_text_str_val = str(intro_text_val).strip()
-            if not intro_text_str_val:
-                self.log(f"旧表 '{old_ws_name_intro}' 第2行G列无简介。", "WARNING")
-                old_wb_intro_local.close()
-                return
-            
-            # 找出实际的简介内容（最后一个译名后的内容）
-            sentences = intro_text_str_val.split("。")
-            
-            # 查找最后一个"译名是"的位置
-            last_translation_index = -1
-            for i, sentence in enumerate(sentences):
-                if "译名是" in sentence:
-                    last_translation_index = i
-            
-            # 提取最后一个译名之后的内容作为实际简介
-            actual_intro = ""
-            if last_translation_index != -1 and last_translation_index < len(sentences) - 1:
-                actual_intro = "。".join(sentences[last_translation_index + 1:]).strip()
-                if actual_intro and not actual_intro.endswith("。"):
-                    actual_intro += "。"
-                self.log(f"找到实际简介: '{actual_intro}'", "DEBUG")
-            else:
-                # 如果找不到明确的分隔点，使用原逻辑提取最后一句
-                sentences_punc = re.findall(r'[^。？！]+[。？！]*', intro_text_str_val)
-                actual_intro = sentences_punc[-1].strip() if sentences_punc else intro_text_str_val
-                self.log(f"未找到明确分隔，使用最后一句作为简介: '{actual_intro}'", "DEBUG")
-            
-            # 确保有内容
-            if not actual_intro:
-                actual_intro = intro_text_str_val
-            
-            # 写入H列完整内容
-            intro_dest_h_idx = self._col2idx('H')
-            ws_intro.Cells(2, intro_dest_h_idx).Value = intro_text_str_val
-            self.log_with_context(f"简介完整内容复制到H列:'{intro_text_str_val[:50]}'", 2, intro_dest_h_idx, "DEBUG")
-            
-            # 将提取出的实际简介写入其他列
-            for col_letter in ['J', 'L', 'N', 'P', 'R', 'T', 'V', 'X']:
-                col_idx = self._col2idx(col_letter)
-                ws_intro.Cells(2, col_idx).Value = actual_intro
-            
-            old_wb_intro_local.close()
-            self.log(f"简介从 '{os.path.basename(old_path_intro)}' 复制完成。实际简介: '{actual_intro[:50]}'", "INFO")
-        except Exception as e_intro:
-            self.log(f"复制简介失败 ('{os.path.basename(old_path_intro)}'): {e_intro}", "ERROR")
-            self.log(traceback.format_exc(), "DEBUG")
-        finally:
-            if old_wb_intro_local and hasattr(old_wb_intro_local, 'close') and not getattr(old_wb_intro_local, 'closed', True):
-                try: old_wb_intro_local.close()
-                except Exception as e_close_intro_wb: self.log(f"关闭简介用旧工作簿时出错: {e_close_intro_wb}", "ERROR")
-
-
-    # ==============================================================================
-    # BEGIN: _copy_speakers and its helper methods (FULL IMPLEMENTATION)
-    # ==============================================================================
-    def _build_character_patterns(self, old_data_list_build):
-        speakers_dialogs = {}
-        for item in old_data_list_build:
-            speaker = item.get('speaker')
-            dialog_text = item.get('dialog', '')
-            if not speaker or not dialog_text: continue
-            if speaker not in speakers_dialogs: speakers_dialogs[speaker] = []
-            speakers_dialogs[speaker].append(dialog_text)
-
-        character_patterns = {}
-        for speaker, dialogs in speakers_dialogs.items():
-            phrases = []
-            phrase_counts = {}
-            for dialog_text_item in dialogs:
-                if len(dialog_text_item) < 2: continue
-                for i_pattern in range(len(dialog_text_item) - 1): 
-                    for j_pattern_len in range(2, min(6, len(dialog_text_item) - i_pattern + 1)):
-                        phrase = dialog_text_item[i_pattern : i_pattern+j_pattern_len]
-                        if re.search(r'[\u4e00-\u9fff]', phrase): 
-                            phrases.append(phrase)
-            
-            if not phrases: continue
-            for phrase in phrases: phrase_counts[phrase] = phrase_counts.get(phrase, 0) + 1
-            
-            sorted_phrases = sorted(phrase_counts.items(), key=lambda x: x[1] * len(x[0]), reverse=True)
-            top_n_phrases = [p[0] for p in sorted_phrases[:15] if p[1] > 1 and len(p[0]) > 1] 
-            if top_n_phrases:
-                character_patterns[speaker] = top_n_phrases
-                self.log(f"为说话人 '{speaker}' 构建特征模式: {top_n_phrases}", "TRACE")
-        return character_patterns
-
-    def _guess_speaker_from_content(self, dialog_text_guess, char_patterns_guess):
-        if not dialog_text_guess or not char_patterns_guess: return None, 0.0
-        best_match_speaker, highest_score = None, 0.0
-        min_score_threshold = 0.3 
-
-        for speaker, patterns in char_patterns_guess.items():
-            current_score = 0.0
-            for pattern in patterns:
-                if pattern in dialog_text_guess:
-                    current_score += len(pattern) / 10.0 
-            if current_score > highest_score and current_score >= min_score_threshold:
-                highest_score = current_score
-                best_match_speaker = speaker
-        
-        final_confidence_threshold = self.config.get('content_guess_confidence_threshold', 0.7)
-        return (best_match_speaker, highest_score) if highest_score >= final_confidence_threshold else (None, 0.0)
-
-    def _has_ending_punctuation(self, text):
-        """判断文本是否以标点符号结尾"""
-        if not text or not isinstance(text, str): return False
-        valid_trailing_punctuations = ('。', '！', '？', '.', '!', '?', '；', ';', '：', ':', ')', '）', '"', "'", '"', "'", ']', '】', '》', '…')
-        return any(text.endswith(p) for p in valid_trailing_punctuations)
-
-    def _remove_ending_punctuation(self, text):
-        """移除文本末尾的标点符号"""
-        if not text or not isinstance(text, str): return text
-        valid_trailing_punctuations = ('。', '！', '？', '.', '!', '?', '；', ';', '：', ':', ')', '）', '"', "'", '"', "'", ']', '】', '》', '…')
-        result = text
-        while any(result.endswith(p) for p in valid_trailing_punctuations) and result:
-            for punct in valid_trailing_punctuations:
-                if result.endswith(punct):
-                    result = result[:-len(punct)].rstrip()
-                    break
-        return result
-
-    # _has_ending_punctuation and _remove_ending_punctuation are already defined globally in the class
-
-    def _process_paragraph_punctuation(self, ws_proc_para, new_data_list_para, dialog_col_idx_lqa):
-        self.log("说话人复制后：开始段落标点最终处理...", "INFO")
-        paragraphs_map = {} 
-        for item_p in new_data_list_para:
-            para_id_p = item_p.get('paragraph_id')
-            speaker_p = item_p.get('speaker_after_match') 
-            if not para_id_p or not speaker_p: continue
-
-            para_key = (speaker_p, para_id_p) 
-            if para_key not in paragraphs_map: paragraphs_map[para_key] = []
-            paragraphs_map[para_key].append(item_p)
-        
-        if not paragraphs_map: self.log("段落标点后处理：无有效段落数据。", "INFO"); return
-
-        processed_punct_count = 0
-        for para_key, items_in_para_p in paragraphs_map.items():
-            if not items_in_para_p or not self.running : continue
-            items_in_para_p.sort(key=lambda x: x.get('paragraph_position', float('inf'))) 
-
-            num_items_p = len(items_in_para_p)
-            for i_p_item, item_to_punct in enumerate(items_in_para_p):
-                is_last_line_p = (i_p_item == num_items_p - 1)
-                row_p_num = item_to_punct.get('row')
-                if not row_p_num: continue
-
-                try:
-                    cell_obj_p = ws_proc_para.Cells(row_p_num, dialog_col_idx_lqa)
-                    cell_text_val_p = str(cell_obj_p.Value or '').strip()
-                    if not cell_text_val_p: continue
-
-                    has_punct_p = self._has_ending_punctuation(cell_text_val_p)
-                    if is_last_line_p: 
-                        if not has_punct_p: 
-                            cell_obj_p.Value = cell_text_val_p + "。"
-                            processed_punct_count += 1
-                            self.log_with_context(f"段后标点: 末行 '{cell_text_val_p[:30]}...' 加句号", row=row_p_num, col_idx=dialog_col_idx_lqa, level="TRACE")
-                    else: 
-                        if has_punct_p: 
-                            stripped_text_p = self._remove_ending_punctuation(cell_text_val_p)
-                            if stripped_text_p != cell_text_val_p : 
-                                cell_obj_p.Value = stripped_text_p
-                                processed_punct_count += 1
-                                self.log_with_context(f"段后标点: 中行 '{cell_text_val_p[:30]}...' 移除标点后为 '{stripped_text_p[:30]}'", row=row_p_num, col_idx=dialog_col_idx_lqa, level="TRACE")
-                except Exception as e_para_punct_cell:
-                    self.log_with_context(f"段落标点后处理单元格操作出错: {e_para_punct_cell}", row=row_p_num, col_idx=dialog_col_idx_lqa, level="WARNING")
-        self.log(f"说话人复制后的段落标点最终处理完成，共修改 {processed_punct_count} 处。", "INFO")
-
-    def _calculate_segment_coherence(self, segment_texts_list_coh):
-        if not segment_texts_list_coh or len(segment_texts_list_coh) <= 1: return 1.0
-        coherence_score_val = 0.0; num_transitions_coh = len(segment_texts_list_coh) - 1
-        
-        for i_coh in range(num_transitions_coh):
-            current_text_coh = segment_texts_list_coh[i_coh]
-            next_text_coh = segment_texts_list_coh[i_coh+1]
-            transition_score_val = 0.0
-            if not current_text_coh or not next_text_coh: continue
-
-            continuity_words = ['然后','接着','所以','但是','而且','因为','不过','如果','因此','还有','另外','同时','于是','那么','此外']
-            if any(next_text_coh.startswith(word) for word in continuity_words):
-                transition_score_val += 0.4
-
-            try:
-                current_words_set_coh = set(re.findall(r'[\u4e00-\u9fffA-Za-z0-9]+', current_text_coh))
-                next_words_set_coh = set(re.findall(r'[\u4e00-\u9fffA-ZaZ0-9]+', next_text_coh))
-                common_words_coh = current_words_set_coh.intersection(next_words_set_coh)
-                if common_words_coh:
-                     transition_score_val += min(0.3, len(common_words_coh) * 0.05 + 0.05) 
-            except TypeError: pass
-            coherence_score_val += transition_score_val
-        
-        max_possible_score_per_trans = 0.7 
-        max_total_score_coh = num_transitions_coh * max_possible_score_per_trans
-        
-        final_coherence = 0.0
-        if max_total_score_coh > 0:
-            final_coherence = min(1.0, coherence_score_val / max_total_score_coh) if coherence_score_val > 0 else 0.0
-        self.log(f"段落连贯性计算: 文本='{'|'.join(s[:10] for s in segment_texts_list_coh)}', 得分={final_coherence:.2f}", "TRACE")
-        return final_coherence
-
-    def _looks_like_different_speaker(self, text1_lds, text2_lds):
-        if not text1_lds or not text2_lds: return False
-        if (text1_lds.endswith('?') or text1_lds.endswith('？')) and \
-           not any(text2_lds.startswith(pronoun) for pronoun in ['你','我','他','她']) and len(text2_lds)>2 :
-            return True
-        pronouns1 = {w for w in ['我','你','您'] if w in text1_lds}
-        pronouns2 = {w for w in ['我','你','您'] if w in text2_lds}
-        if (('我' in pronouns1 and ('你' in pronouns2 or '您' in pronouns2)) or \
-            (('你' in pronouns1 or '您' in pronouns1) and '我' in pronouns2)) and \
-           not pronouns1.intersection(pronouns2):
-            return True
-        if (text1_lds.endswith('吧') or text1_lds.endswith('啊') or text1_lds.endswith('呢')) and \
-           not (text2_lds.endswith('吧') or text2_lds.endswith('啊') or text2_lds.endswith('呢')):
-            if len(text1_lds) < 10 and len(text2_lds) > 3 : 
-                 return True
-        return False
-
-    def _looks_like_Youtube(self, row1_lqa, row2_lqa, ws_lqa, dialog_col_idx_lqa):
-        try:
-            text1_lqa_val = str(ws_lqa.Cells(row1_lqa, dialog_col_idx_lqa).Value or '').strip()
-            text2_lqa_val = str(ws_lqa.Cells(row2_lqa, dialog_col_idx_lqa).Value or '').strip()
-            if not text1_lqa_val or not text2_lqa_val: return False
-            is_q1 = text1_lqa_val.endswith(('?', '？')) or \
-                      any(text1_lqa_val.startswith(qw) for qw in ["什么","谁","哪","怎么","为啥","几时","难道","可否","能否"])
-            is_a2_start = any(text2_lqa_val.startswith(aw) for aw in ["是","不是","对","没错","好","嗯","不","没","也许","当然","因为","在于","就是"])
-            is_a2 = is_a2_start or (is_q1 and len(text2_lqa_val) > 0 and not (text2_lqa_val.endswith(('?', '？')))) 
-            return is_q1 and is_a2
-        except Exception as e_lqa_cell:
-            self.log_with_context(f"判断问答模式时单元格读取出错: {e_lqa_cell}", row=row1_lqa, level="WARNING")
-            return False
-
-    def _handle_special_cases(self, ws_hsc, new_data_list_hsc, speaker_col_f_idx_hsc, dialog_col_g_idx_hsc):
-        self.log("开始应用特殊情况处理规则 (如说话人交替修正)...", "INFO")
-        modified_by_rules_count = 0
-        dialog_pattern_hsc = [] 
-        all_speakers_set = set()
-        for item_h in new_data_list_hsc:
-            if item_h.get('matched') and item_h.get('speaker_after_match') and not item_h.get('content_speaker_guess'):
-                try:
-                    row_h_val = item_h['row']
-                    speaker_h_val = item_h['speaker_after_match']
-                    dialog_h_val = str(ws_hsc.Cells(row_h_val, dialog_col_g_idx_hsc).Value or '').strip()
-                    if dialog_h_val : 
-                        dialog_pattern_hsc.append({'row': row_h_val, 'speaker': speaker_h_val, 'dialog': dialog_h_val})
-                        all_speakers_set.add(speaker_h_val)
-                except Exception as e_hsc_get:
-                     self.log_with_context(f"特殊规则：读取数据时出错: {e_hsc_get}", row=item_h.get('row'), level="WARNING")
-        
-        if not dialog_pattern_hsc or len(dialog_pattern_hsc) < 2 :
-            self.log("特殊规则：无足够数据进行交替模式分析。", "INFO"); return
-        
-        dialog_pattern_hsc.sort(key=lambda x: x['row']) 
-
-        if 2 <= len(all_speakers_set) <= 3: 
-            self.log(f"特殊规则：检测到 {len(all_speakers_set)} 个主要说话人 ({', '.join(list(all_speakers_set))})，尝试交替修正。", "DEBUG")
-            speakers_list_hsc = list(all_speakers_set)
-
-            for i_hsc in range(1, len(dialog_pattern_hsc)):
-                prev_info_h = dialog_pattern_hsc[i_hsc-1]
-                curr_info_h = dialog_pattern_hsc[i_hsc]
-
-                if prev_info_h['speaker'] == curr_info_h['speaker']: 
-                    should_switch = self._looks_like_different_speaker(prev_info_h['dialog'], curr_info_h['dialog']) or \
-                                    self._looks_like_Youtube(prev_info_h['row'], curr_info_h['row'], ws_hsc, dialog_col_g_idx_hsc)
-                    
-                    if should_switch:
-                        other_speaker_h = None
-                        if len(speakers_list_hsc) == 2:
-                            other_speaker_h = speakers_list_hsc[0] if curr_info_h['speaker'] == speakers_list_hsc[1] else speakers_list_hsc[1]
-                        elif len(speakers_list_hsc) == 3: 
-                            possible_others = [s for s in speakers_list_hsc if s != curr_info_h['speaker'] and s != prev_info_h['speaker']]
-                            if possible_others: other_speaker_h = possible_others[0]
-                            # Fallback: try to get speaker from row before prev_info_h if possible (DATA_START_ROW check needed)
-                            elif prev_info_h['row'] > self.config.get('_DATA_START_ROW_CACHE', 1) : # Need a way to get DATA_START_ROW here
-                                try:
-                                    grand_prev_speaker = str(ws_hsc.Cells(prev_info_h['row']-1, speaker_col_f_idx_hsc).Value or '').strip()
-                                    if grand_prev_speaker in speakers_list_hsc and grand_prev_speaker != curr_info_h['speaker']:
-                                        other_speaker_h = grand_prev_speaker
-                                except: pass 
-
-                        if other_speaker_h and other_speaker_h != curr_info_h['speaker']:
-                            try:
-                                self.log_with_context(f"特殊规则修正(交替): 从 '{curr_info_h['speaker']}' 改为 '{other_speaker_h}'. 原对话: '{curr_info_h['dialog'][:20]}'", row=curr_info_h['row'], col_idx=speaker_col_f_idx_hsc, level="INFO")
-                                ws_hsc.Cells(curr_info_h['row'], speaker_col_f_idx_hsc).Value = other_speaker_h
-                                dialog_pattern_hsc[i_hsc]['speaker'] = other_speaker_h 
-                                # 修复：使用方法参数new_data_list_hsc，而不是未定义的全局变量new_data_list
-                                for item_to_update in new_data_list_hsc: 
-                                    if item_to_update.get('row') == curr_info_h['row']:
-                                        item_to_update['speaker_after_match'] = other_speaker_h; break
-                                modified_by_rules_count += 1
-                            except Exception as e_hsc_set:
-                                self.log_with_context(f"特殊规则修正时写入Excel出错: {e_hsc_set}", row=curr_info_h['row'], level="WARNING")
-        
-        if modified_by_rules_count > 0: self.log(f"特殊情况处理规则共修正了 {modified_by_rules_count} 处说话人。", "INFO")
-        else: self.log("特殊情况处理：未触发明确的修正。", "INFO")
-
-    def _copy_speakers(self, ws_copy, old_path_copy, data_start_row):
-        old_wb_copy = None 
-        try:
-            self.log(f"开始从旧表 '{os.path.basename(old_path_copy)}' 复制说话人 (数据从第 {data_start_row} 行开始)...", "INFO")
-            old_wb_copy = load_workbook(old_path_copy, data_only=True)
-            old_sheet_name_copy = '台词管理' if '台词管理' in old_wb_copy.sheetnames else old_wb_copy.sheetnames[0]
-            old_sheet_obj = old_wb_copy[old_sheet_name_copy]
-
-            speaker_col_f_idx = self._col2idx(self.config['col_f_speaker'])
-            dialog_col_g_idx = self._col2idx(self.config['col_g'])
-
-            old_data_list = []
-            self.log(f"旧表 '{old_sheet_name_copy}' 最大行: {old_sheet_obj.max_row}", "DEBUG")
-            for r_old_val in range(data_start_row, old_sheet_obj.max_row + 1):
-                speaker_val = str(old_sheet_obj.cell(row=r_old_val, column=speaker_col_f_idx).value or '').strip()
-                dialog_val = str(old_sheet_obj.cell(row=r_old_val, column=dialog_col_g_idx).value or '').strip()
-                if dialog_val: 
-                    old_data_list.append({'row': r_old_val, 'speaker': speaker_val, 'dialog': dialog_val, 'used': False})
-            
-            if not old_data_list:
-                self.log(f"旧表 '{old_sheet_name_copy}' 未找到可用台词数据 (检查列F/G和起始行{data_start_row})。", "WARNING")
-                return
-            self.log(f"旧表数据加载完成，共 {len(old_data_list)} 条有效对话。", "DEBUG")
-
-            char_patterns = self._build_character_patterns(old_data_list)
-            self.config['_DATA_START_ROW_CACHE'] = data_start_row # 缓存DATA_START_ROW给_handle_special_cases用
-
-            last_row_new = 1
-            try: last_row_new = ws_copy.Cells.Find("*", SearchOrder=win32.constants.xlByRows, SearchDirection=win32.constants.xlPrevious).Row
-            except: self.log_with_context("复制说话人：无法确定新表最后行，默认1", level="WARNING")
-            
-            new_data_list = []
-            for r_new_val in range(data_start_row, last_row_new + 1):
-                dialog_new_val = str(ws_copy.Cells(r_new_val, dialog_col_g_idx).Value or '').strip()
-                if dialog_new_val:
-                    item = {'row': r_new_val, 'dialog': dialog_new_val, 'matched': False, 
-                            'speaker_after_match': None, 'paragraph_id': None, 'paragraph_position': -1}
-                    if char_patterns:
-                        guess_s, guess_c = self._guess_speaker_from_content(dialog_new_val, char_patterns)
-                        if guess_s : 
-                            item['content_speaker_guess'] = guess_s
-                            item['content_confidence'] = guess_c
-                    new_data_list.append(item)
-
-            if not new_data_list:
-                self.log("新表中未找到可用台词数据进行匹配。", "WARNING")
-                return
-            self.log(f"新表数据加载完成，共 {len(new_data_list)} 条有效对话。", "DEBUG")
-
-            exact_thresh = self.config.get('exact_match_threshold', 0.95)
-            len_ratio_thresh = self.config.get('exact_match_length_ratio_threshold', 0.7)
-            general_match_thresh = self.config.get('speaker_match_threshold', 0.6)
-            seg_sim_w = self.config.get('segment_similarity_weight', 0.6)
-            seg_coh_w = self.config.get('segment_coherence_weight', 0.25)
-            seg_len_w = self.config.get('segment_length_ratio_weight', 0.15)
-            matched_s1, matched_s2_lines, matched_s3 = 0, 0, 0
-
-            self.log("说话人复制 - Stage 1: 精确匹配开始...", "INFO")
-            for new_item_s1 in new_data_list:
-                if not self.running or new_item_s1['matched'] or not new_item_s1['dialog']: continue
-                best_old_match_idx_s1, highest_ratio_s1 = -1, 0.0
-                for old_idx_s1, old_item_s1 in enumerate(old_data_list):
-                    if old_item_s1['used'] or not old_item_s1['dialog']: continue
-                    current_ratio_s1 = difflib.SequenceMatcher(None, new_item_s1['dialog'], old_item_s1['dialog']).ratio()
-                    if current_ratio_s1 > highest_ratio_s1: highest_ratio_s1, best_old_match_idx_s1 = current_ratio_s1, old_idx_s1
-                if highest_ratio_s1 >= exact_thresh and best_old_match_idx_s1 != -1:
-                    old_match_s1 = old_data_list[best_old_match_idx_s1]
-                    len_n, len_o = len(new_item_s1['dialog'].replace(" ","")), len(old_match_s1['dialog'].replace(" ",""))
-                    if len_n > 0 and len_o > 0 and (min(len_n, len_o) / max(len_n, len_o)) > len_ratio_thresh:
-                        try:
-                            ws_copy.Cells(new_item_s1['row'], speaker_col_f_idx).Value = old_match_s1['speaker']
-                            new_item_s1['speaker_after_match'] = old_match_s1['speaker']
-                            new_item_s1['matched'] = True; old_match_s1['used'] = True; matched_s1 += 1
-                            self.log_with_context(f"S1 精确匹配: OldR {old_match_s1['row']} (S:{old_match_s1['speaker']}) -> NewR {new_item_s1['row']} (R:{highest_ratio_s1:.2f})", row=new_item_s1['row'], level="DEBUG")
-                        except Exception as e_s1w : self.log_with_context(f"S1写入失败:{e_s1w}",row=new_item_s1['row'],level="WARNING")
-            self.log(f"说话人复制 - Stage 1: 精确匹配结束. 匹配 {matched_s1} 行.", "INFO")
-            if not self.running: self.log("中止于S1后"); return
-
-            # 完全重写的Stage 2分段匹配部分:
-            self.log("说话人复制 - Stage 2: 分段匹配开始 (增强版)...", "INFO")
-            import time
-            start_time_s2 = time.time()
-            matched_s2_lines = 0
-            max_processing_time_s2 = 60
-            processed_count = 0
-            
-            # 新增：按时间顺序跟踪旧表和新表的位置
-            old_position = 0
-            new_position = 0
-            
-            # 构建一对多映射检测
-            one_to_many_map = {}
-            for old_idx, old_item in enumerate(old_data_list):
-                if old_item['used']: continue
-                old_text = old_item['dialog']
-                if not old_text: continue
-                
-                # 检测是否可能是多行合并的台词
-                sentences = re.split(r'[。！？.!?]', old_text)
-                sentences = [s for s in sentences if s.strip()]
-                
-                if len(sentences) > 1:
-                    # 可能是多行合并，记录以备后用
-                    one_to_many_map[old_idx] = {
-                        'sentences': sentences,
-                        'full_text': old_text,
-                        'speaker': old_item['speaker'],
-                        'matched_new_rows': []
-                    }
-        
-            # 收集连续未匹配段落，考虑时间顺序
-            unmatched_segments = []
-            segment = []
-            
-            for i, new_item in enumerate(new_data_list):
-                if not new_item['matched']:
-                    segment.append(new_item)
-                else:
-                    if segment:
-                        unmatched_segments.append(segment)
-                        segment = []
-            
-            if segment:  # 添加最后一个段落
-                unmatched_segments.append(segment)
-            
-            # 处理一对多映射：寻找旧表一行匹配新表多行
-            for old_idx, mapping in one_to_many_map.items():
-                if not self.running: break
-                
-                for segment in unmatched_segments:
-                    if len(segment) < 2: continue  # 太短的段落跳过
-                    
-                    # 检查整个段落是否匹配合并的台词
-                    combined_text = " ".join([item['dialog'] for item in segment])
-                    similarity = difflib.SequenceMatcher(None, combined_text, mapping['full_text']).ratio()
-                    
-                    if similarity >= general_match_thresh:
-                        # 找到匹配，将相同说话人应用到所有行
-                        for idx, item in enumerate(segment):
-                            try:
-                                row = item['row']
-                                ws_copy.Cells(row, speaker_col_f_idx).Value = mapping['speaker']
-                                item['speaker_after_match'] = mapping['speaker']
-                                item['matched'] = True
-                                item['paragraph_id'] = processed_count
-                                item['paragraph_position'] = idx
-                                matched_s2_lines += 1
-                                
-                                self.log_with_context(
-                                    f"S2 一对多匹配: 旧行合并文本 '{mapping['full_text'][:20]}...' -> " +
-                                    f"新行 {row} (相似度:{similarity:.2f})",
-                                    row=row, level="DEBUG"
-                                )
-                            except Exception as e:
-                                self.log_with_context(f"S2一对多写入失败:{e}", row=item['row'], level="WARNING")
-                        
-                        old_data_list[old_idx]['used'] = True
-                        processed_count += 1
-                        break  # 找到匹配后处理下一个合并台词
-            
-            # 原有的段落匹配逻辑保留，但增加时间顺序约束
-            for segment in unmatched_segments:
-                if len(segment) < 2: continue  # 跳过单行段落
-                
-                # 限制搜索范围：
-                search_start = max(0, old_position - 5)  # 从当前位置往前最多5行
-                search_end = min(len(old_data_list), old_position + 20)  # 往后最多20行
-                
-                best_match_indices = []
-                best_match_score = 0
-                best_match_start = -1
-                
-                # 在有限范围内搜索最佳匹配
-                for start_idx in range(search_start, search_end - len(segment) + 1):
-                    if not self.running: break
-                    
-                    # 检查连续段落是否都未被使用
-                    all_available = True
-                    for i in range(len(segment)):
-                        if start_idx + i >= len(old_data_list) or old_data_list[start_idx + i]['used']:
-                            all_available = False
-                            break
-                    
-                    if not all_available:
-                        continue
-                    
-                    # 计算段落相似度
-                    old_segment_texts = [old_data_list[start_idx + i]['dialog'] for i in range(len(segment))]
-                    
-                    # 计算整体段落相似度
-                    segment_similarity = 0
-                    for i in range(len(segment)):
-                        sim = difflib.SequenceMatcher(None, segment[i]['dialog'], old_segment_texts[i]).ratio()
-                        segment_similarity += sim
-                    segment_similarity /= len(segment)
-                    
-                    # 计算段落连贯性
-                    coherence = self._calculate_segment_coherence([item['dialog'] for item in segment])
-                    old_coherence = self._calculate_segment_coherence(old_segment_texts)
-                    coherence_diff = abs(coherence - old_coherence)
-                    coherence_score = 1.0 - min(coherence_diff, 0.5) * 2  # 归一化为0-1
-                    
-                    # 计算段落长度比例相似度
-                    len_similarity = 1.0
-                    for i in range(len(segment)):
-                        len_n = len(segment[i]['dialog'])
-                        len_o = len(old_segment_texts[i])
-                        if len_n > 0 and len_o > 0:
-                            len_similarity *= min(len_n, len_o) / max(len_n, len_o)
-                    len_similarity = len_similarity ** (1.0 / len(segment))  # 几何平均
-                    
-                    # 综合评分
-                    match_score = (
-                        seg_sim_w * segment_similarity +
-                        seg_coh_w * coherence_score +
-                        seg_len_w * len_similarity
-                    )
-                    
-                    if match_score > best_match_score:
-                        best_match_score = match_score
-                        best_match_start = start_idx
-                        best_match_indices = [start_idx + i for i in range(len(segment))]
-                
-                # 应用最佳匹配
-                if best_match_score >= general_match_thresh and best_match_start != -1:
-                    for i, new_item_to_match in enumerate(segment):
-                        old_idx = best_match_start + i
-                        if old_idx < len(old_data_list):
-                            old_item_match = old_data_list[old_idx]
-                            
-                            try:
-                                ws_copy.Cells(new_item_to_match['row'], speaker_col_f_idx).Value = old_item_match['speaker']
-                                new_item_to_match['speaker_after_match'] = old_item_match['speaker']
-                                new_item_to_match['matched'] = True
-                                old_item_match['used'] = True
-                                new_item_to_match['paragraph_id'] = processed_count
-                                new_item_to_match['paragraph_position'] = i
-                                matched_s2_lines += 1
-                                
-                                self.log_with_context(
-                                    f"S2 段落匹配: OldR {old_item_match['row']} (S:{old_item_match['speaker']}) -> " +
-                                    f"NewR {new_item_to_match['row']} (整体分数:{best_match_score:.2f})",
-                                    row=new_item_to_match['row'], level="DEBUG"
-                                )
-                            except Exception as e_s2w:
-                                self.log_with_context(f"S2写入失败:{e_s2w}", row=new_item_to_match['row'], level="WARNING")
-                    
-                    processed_count += 1
-            
-            self.log(f"说话人复制 - Stage 2: 分段匹配结束. 耗时 {time.time() - start_time_s2:.1f}秒, 匹配 {matched_s2_lines} 行.", "INFO")
-            if not self.running: self.log("中止于S2后"); return
-
-            self.log("说话人复制 - Stage 3: 有序模糊单行匹配开始...", "INFO")
-            unmatched_s3_count = 0
-            
-            # 重置位置跟踪
-            old_position = 0
-            for new_item_s3 in new_data_list:
-                if not self.running or new_item_s3['matched']: continue
-                
-                # 在附近范围内寻找最佳匹配
-                search_window = 15  # 搜索窗口大小
-                best_old_match_idx_s3, highest_ratio_s3 = -1, 0.0
-                
-                # 优先在时间顺序合理的范围内搜索
-                search_start = max(0, old_position - 5)
-                search_end = min(len(old_data_list), old_position + search_window)
-                
-                for old_idx_s3 in range(search_start, search_end):
-                    old_item_s3 = old_data_list[old_idx_s3]
-                    if old_item_s3['used'] or not old_item_s3['dialog']: continue
-                    
-                    current_ratio_s3 = difflib.SequenceMatcher(None, new_item_s3['dialog'], old_item_s3['dialog']).ratio()
-                    if current_ratio_s3 > highest_ratio_s3:
-                        highest_ratio_s3, best_old_match_idx_s3 = current_ratio_s3, old_idx_s3
-                
-                row_s3 = new_item_s3['row']
-                if highest_ratio_s3 >= general_match_thresh and best_old_match_idx_s3 != -1:
-                    # 找到有效匹配，更新旧表位置
-                    old_match_s3 = old_data_list[best_old_match_idx_s3]
-                    old_position = best_old_match_idx_s3 + 1
-                    
-                    try:
-                        ws_copy.Cells(row_s3, speaker_col_f_idx).Value = old_match_s3['speaker']
-                        new_item_s3['speaker_after_match'] = old_match_s3['speaker']
-                        new_item_s3['matched'] = True
-                        old_match_s3['used'] = True
-                        matched_s3 += 1
-                        self.log_with_context(f"S3 有序匹配: OldR {old_match_s3['row']} -> NewR {row_s3} (R:{highest_ratio_s3:.2f})", row=row_s3, level="DEBUG")
-                    except Exception as e_s3w:
-                        self.log_with_context(f"S3写入失败:{e_s3w}", row=row_s3, level="WARNING")
-                else:
-                    # 只对内容猜测更有信心的情况进行标记，降低误标红率
-                    unmatched_s3_count += 1
-                    try:
-                        content_guess_threshold_final = self.config.get('content_guess_confidence_threshold', 0.7)
-                        content_guess_threshold_higher = content_guess_threshold_final + 0.1  # 提高阈值
-                        if new_item_s3.get('content_speaker_guess') and new_item_s3.get('content_confidence', 0) >= content_guess_threshold_higher:
-                            guessed_s_val = new_item_s3['content_speaker_guess']
-                            ws_copy.Cells(row_s3, speaker_col_f_idx).Value = guessed_s_val
-                            new_item_s3['speaker_after_match'] = guessed_s_val
-                            ws_copy.Cells(row_s3, speaker_col_f_idx).Interior.ColorIndex = 6
-                            self.log_with_context(f"S3 内容猜测填补: '{guessed_s_val}' (高可信度:{new_item_s3['content_confidence']:.2f})", row=row_s3, level="INFO")
-                        else:
-                            # 不再标红所有未匹配项，只标记那些特别可疑的
-                            suspicious = False
-                            for prev_idx in range(max(0, i-1), max(0, i-3), -1):
-                                if prev_idx >= 0 and prev_idx < len(new_data_list):
-                                    prev_item = new_data_list[prev_idx]
-                                    if prev_item.get('matched') and prev_item.get('speaker_after_match'):
-                                        # 如果前面几行台词与当前对话模式不符，标记为可疑
-                                        if self._looks_like_different_speaker(prev_item['dialog'], new_item_s3['dialog']):
-                                            suspicious = True
-                                            break
-                        
-                        if suspicious:
-                            ws_copy.Cells(row_s3, speaker_col_f_idx).Interior.ColorIndex = 3
-                    except Exception as e_s3color:
-                        self.log_with_context(f"S3标色失败:{e_s3color}", row=row_s3, level="WARNING")
-            self.log(f"说话人复制 - Stage 3: 模糊单行匹配结束. 匹配 {matched_s3} 行. 未匹配 {unmatched_s3_count} 行.", "INFO")
-            if not self.running: 
-                self.log("中止于S3后")
-                return
-
-            # 这些行必须在try块内，不能在try块之外
-            self._process_paragraph_punctuation(ws_copy, new_data_list, dialog_col_g_idx)
-            if not self.running: 
-                self.log("中止于段落标点后处理后")
-                return
-                
-            self._handle_special_cases(ws_copy, new_data_list, speaker_col_f_idx, dialog_col_g_idx)
-
-            total_matched = matched_s1 + matched_s2_lines + matched_s3
-            self.log(f"说话人复制总结: 总匹配行数 {total_matched} (精确:{matched_s1}, 分段行数:{matched_s2_lines}, 模糊:{matched_s3}).", "INFO")
-            
-        except Exception as e:
-            self.log(f"复制说话人主流程发生严重错误: {e}", "CRITICAL")
-            self.log(traceback.format_exc(), "DEBUG")
-        finally: 
-            if old_wb_copy and hasattr(old_wb_copy, 'close') and not getattr(old_wb_copy, 'closed', True):
-                try: old_wb_copy.close()
-                except Exception as e_close_old_wb: self.log(f"关闭旧工作簿时出错: {e_close_old_wb}", "ERROR")
-
-    def _validate_speaker_assignments(self, ws, new_data_list, speaker_col_idx):
-        self.log("进行说话人匹配自检验证...", "INFO")
-        issues = 0
-        
-        # 检查同一角色连续说话行过多
-        consecutive_same_speaker = 0
-        last_speaker = None
-        
-        # 按行遍历检查
-        for item in sorted(new_data_list, key=lambda x: x['row']):
-            current_speaker = item.get('speaker_after_match')
-            if not current_speaker:
-                continue
-                
-            # 检查同一角色连续说话
-            if current_speaker == last_speaker:
-                consecutive_same_speaker += 1
-                if consecutive_same_speaker > 7:  # 超过7行同一角色连续说话
-                    row = item['row']
-                    self.log_with_context(f"自检警告: 角色 '{current_speaker}' 连续说话超过7行", row=row, level="WARNING")
-                    # 标记可能的问题
-                    try:
-                        ws.Cells(row, speaker_col_idx).Interior.ColorIndex = 45  # 使用不同的颜色标记
-                        issues += 1
-                    except:
-                        pass
-            else:
-                consecutive_same_speaker = 1
-                last_speaker = current_speaker
-        
-        # 检查其他可能的问题...
-        
-        if issues > 0:
-            self.log(f"自检发现 {issues} 处可能的说话人分配问题，已用特别颜色标记", "WARNING")
-        else:
-            self.log("说话人分配自检通过", "INFO")
-
-    def _col2idx(self, col_letter):
-        """将Excel列字母转换为列索引数字"""
-        if not col_letter or not isinstance(col_letter, str):
-            return 1  # 默认返回第一列
-        col_letter = col_letter.upper().strip()
-        idx = 0
-        for c in col_letter:
-            idx = idx * 26 + (ord(c) - ord('A') + 1)
-        return idx
-
-    def _idx2col(self, col_idx):
-        """将列索引数字转换为Excel列字母"""
-        if not isinstance(col_idx, int) or col_idx < 1:
-            return 'A'  # 默认返回A列
-        result = ""
-        while col_idx > 0:
-            col_idx, remainder = divmod(col_idx - 1, 26)
-            result = chr(65 + remainder) + result
-        return result
-
-    def adjust_images(self, ws_images):
-        """调整工作表中的图片尺寸"""
-        try:
-            # 获取工作表中所有图片和形状
-            shape_count = ws_images.Shapes.Count
-            if shape_count == 0:
-                self.log("图片调整: 未发现图片/形状", "INFO")
-                return
-            
-            # 明确设置为1.0，表示保持原尺寸
-            scale_factor = 1.0  # 保持原尺寸，不进行缩放
-            
-            self.log(f"开始处理工作表 '{ws_images.Name}' 中的 {shape_count} 个图片/形状 (保持原尺寸)...", "INFO")
-            
-            success_count = 0
-            failure_count = 0
-            
-            # 遍历所有形状对象，但不进行缩放处理
-            for i in range(1, shape_count + 1):
-                if not self.running:
-                    break
-                    
-                try:
-                    shape = ws_images.Shapes(i)
-                    # 只进行记录，不执行缩放操作
-                    original_width = shape.Width
-                    original_height = shape.Height
-                    self.log(f"图片调整: 形状{i} - 保持原尺寸 {original_width:.1f}x{original_height:.1f}", "TRACE")
-                    success_count += 1
-                except Exception as e_shape:
-                    failure_count += 1
-                    self.log(f"图片调整: 形状{i}处理失败: {e_shape}", "WARNING")
-                    
-            self.log(f"图片调整:成功{success_count},失败{failure_count}", "INFO")
-        except Exception as e_all_images:
-            self.log(f"处理图片时发生错误: {e_all_images}", "ERROR")
-
-# 主程序入口
-if __name__ == "__main__":
-    try:
-        root = tk.Tk()
-        app = ExcelBatchProcessor(root)
-        root.mainloop()
-    except Exception as e:
-        print(f"程序启动失败: {e}")
-        import traceback
-        traceback.print_exc()
-        input("按任意键退出...")  # 在控制台窗口关闭前暂停
+import os
+import re
+import argparse
+import atexit
+import json
+try:
+    import tkinter as tk
+    from tkinter import ttk, filedialog, messagebox, scrolledtext
+except ImportError: # 无图形环境(如Linux构建机)时只能走命令行
+    tk = None
+try:
+    import win32com.client as win32 
+    import pythoncom
+except ImportError: # 非Windows环境只能使用openpyxl引擎
+    win32 = pythoncom = None
+try:
+    import numpy as np
+except ImportError: # 只有Stage 1向量预排序(s1_vector_prerank)需要numpy
+    np = None
+try:
+    import opencc
+except ImportError: # 只有合并重复时的繁简折叠(merge_key_folds含traditional)需要opencc
+    opencc = None
+from datetime import datetime
+from openpyxl import load_workbook 
+from openpyxl.styles import PatternFill
+from openpyxl.drawing.image import PILImage
+import difflib
+import traceback
+import sys
+import time
+import bisect
+import math
+import csv
+import cProfile
+from collections import Counter, OrderedDict, deque
+import multiprocessing
+import queue
+import threading
+import sqlite3
+import random
+import zlib
+import hashlib
+from array import array
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+# --- COM Constants ---
+MSO_TRUE = -1 
+MSO_FALSE = 0 
+MSO_SCALE_FROM_TOP_LEFT = 0
+
+# Shape types
+MSO_PICTURE = 13
+MSO_LINKED_PICTURE = 16
+MSO_PLACEHOLDER = 14
+
+# --- 处理引擎 ---
+# com: 通过Excel COM逐单元格读写 (需要Windows + Excel)
+# openpyxl: 一次性载入工作簿到内存处理后保存, 不依赖Excel
+ENGINES = ('com', 'openpyxl')
+
+# --- 日志 ---
+LOG_LEVELS = {"TRACE": 0, "DEBUG": 1, "INFO": 2, "WARNING": 3, "ERROR": 4, "CRITICAL": 5}
+LOG_QUEUE_SIZE = 10000 # 后台线程到界面的日志队列上限, 满时处理线程等界面消化
+LOG_DRAIN_MS = 100 # 界面每隔多少毫秒批量取一次日志
+LOG_DRAIN_BATCH = 2000 # 每次最多写入界面的日志行数
+
+# 说话人匹配模式: heuristic为S1/S2/S3三轮启发式匹配, align为带状单调序列对齐
+SPEAKER_MATCHERS = ('heuristic', 'align')
+
+# Excel ColorIndex -> ARGB, 供openpyxl引擎复现标色
+COLOR_INDEX_RGB = {3: 'FFFF0000', 6: 'FFFFFF00', 45: 'FFFF9900'}
+
+
+def _contiguous_runs(rows):
+    """把行号集合整理为升序的连续区间[(起始行, 结束行)]"""
+    runs = []
+    for r in sorted(set(rows)):
+        if runs and r == runs[-1][1] + 1: runs[-1][1] = r
+        else: runs.append([r, r])
+    return [tuple(run) for run in runs]
+
+
+def _paragraph_lines(lines):
+    """(行号, 说话人, 台词)流 -> 各非空台词行的(行号, 台词, 是否段首, 是否段末); 段落为同一说话人的连续非空台词。
+    只需看前后各一行, 跨窗口只带上一行的状态"""
+    pending, prev = None, None # pending: 等下一行来判断是否段末的(行号, 台词, 是否段首, 说话人); prev: 上一行(说话人, 台词)
+    for row, spk, text in lines:
+        if pending: yield pending[:3] + (not text or spk != pending[3],); pending = None
+        if text: pending = (row, text, prev is None or not prev[1] or prev[0] != spk, spk)
+        prev = (spk, text)
+    if pending: yield pending[:3] + (True,)
+
+
+class SheetBackend:
+    """工作表访问接口: 流水线各阶段只通过这些方法读写单元格, 不直接接触COM/openpyxl对象"""
+    name = ""
+
+    def get(self, row, col): raise NotImplementedError
+    def set(self, row, col, value): raise NotImplementedError
+    def set_color(self, row, col, color_index): raise NotImplementedError
+
+    def last_row(self):
+        """最后一个有内容的行号, 工作表为空时抛出异常 (与Cells.Find一致)"""
+        raise NotImplementedError
+
+    def delete_row(self, row): raise NotImplementedError
+
+    def delete_rows(self, rows):
+        """删除多行, 返回删除失败的[(起始行, 结束行, 异常)]; 默认从下往上逐行删除"""
+        failed = []
+        for r in sorted(set(rows), reverse=True):
+            try: self.delete_row(r)
+            except Exception as e: failed.append((r, r, e))
+        return failed
+
+    def shape_count(self): raise NotImplementedError
+    def shape_size(self, index):
+        """第index个(从1开始)图片/形状的(宽, 高), 单位为磅"""
+        raise NotImplementedError
+
+    def read_block(self, first_row, last_row, cols):
+        """读取first_row..last_row行、cols各列, 返回按行的二维元组; 默认逐单元格读取, 后端可覆盖为整块读取"""
+        return tuple(tuple(self.get(r, c) for c in cols) for r in range(first_row, last_row + 1))
+
+    def iter_rows(self, first_row, last_row, cols, window=2000):
+        """按window行一块调用read_block, 逐行产出(行号, 值元组); 调用方同一时间只持有一块的数据"""
+        for start in range(first_row, last_row + 1, max(1, window)):
+            block = self.read_block(start, min(last_row, start + max(1, window) - 1), cols)
+            for offset, values in enumerate(block): yield start + offset, values
+
+    def write_column(self, first_row, col, values):
+        """从first_row起把values写入col列; 默认逐单元格写入, 后端可覆盖为整列赋值"""
+        for i, v in enumerate(values): self.set(first_row + i, col, v)
+
+    def flush(self): pass # 有缓冲的后端在保存前把改动写回
+
+
+class ComSheet(SheetBackend):
+    """Excel COM工作表, 每次读写都是一次跨进程调用"""
+    def __init__(self, ws):
+        self.ws = ws
+        self.name = ws.Name
+
+    def get(self, row, col): return self.ws.Cells(row, col).Value
+    def set(self, row, col, value): self.ws.Cells(row, col).Value = value
+    def set_color(self, row, col, color_index): self.ws.Cells(row, col).Interior.ColorIndex = color_index
+
+    def last_row(self):
+        return self.ws.Cells.Find("*", SearchOrder=win32.constants.xlByRows, SearchDirection=win32.constants.xlPrevious).Row
+
+    def delete_row(self, row): self.ws.Rows(row).Delete()
+
+    def delete_rows(self, rows):
+        failed = []
+        for first, last in reversed(_contiguous_runs(rows)): # 连续行合并成一次Range删除, 从下往上删上方行号不变
+            try: self.ws.Range(f"{first}:{last}").Delete()
+            except Exception as e: failed.append((first, last, e))
+        return failed
+    def shape_count(self): return self.ws.Shapes.Count
+
+    def shape_size(self, index):
+        shape = self.ws.Shapes(index)
+        return shape.Width, shape.Height
+
+    def read_block(self, first_row, last_row, cols):
+        c1, c2 = min(cols), max(cols)
+        values = self.ws.Range(self.ws.Cells(first_row, c1), self.ws.Cells(last_row, c2)).Value
+        if not isinstance(values, tuple): values = ((values,),) # 单个单元格时COM返回标量
+        return tuple(tuple(row[c - c1] for c in cols) for row in values)
+
+    def write_column(self, first_row, col, values):
+        if not values: return
+        self.ws.Range(self.ws.Cells(first_row, col), self.ws.Cells(first_row + len(values) - 1, col)).Value = tuple((v,) for v in values)
+
+
+class OpenpyxlSheet(SheetBackend):
+    """openpyxl工作表, 整本工作簿已载入内存, 读写不经过Excel进程"""
+    def __init__(self, ws):
+        self.ws = ws
+        self.name = ws.title
+
+    def get(self, row, col): return self.ws.cell(row=row, column=col).value
+    def set(self, row, col, value): self.ws.cell(row=row, column=col).value = value
+
+    def set_color(self, row, col, color_index):
+        rgb = COLOR_INDEX_RGB.get(color_index)
+        if rgb: self.ws.cell(row=row, column=col).fill = PatternFill(fill_type='solid', start_color=rgb, end_color=rgb)
+
+    def last_row(self):
+        last = 0
+        for r, values in enumerate(self.ws.iter_rows(values_only=True), start=1):
+            if any(v is not None and v != "" for v in values): last = r
+        if not last: raise ValueError(f"工作表 '{self.name}' 无内容")
+        return last
+
+    def delete_row(self, row): self.delete_rows([row])
+
+    def delete_rows(self, rows):
+        """一次压缩删除多行: 按存活行重新编号单元格/行高/合并区域/图片锚点, 每类只遍历一遍。
+        openpyxl自带的delete_rows每调用一次就搬动下方全部单元格, 且不移动行高和图片"""
+        deleted = sorted(set(rows))
+        if not deleted: return []
+        gone = set(deleted)
+        ws = self.ws
+
+        def shifted(r): # 行号从1开始; 被删行映射到其后第一个存活行的新位置
+            return r - bisect.bisect_left(deleted, r)
+
+        # 合并区域与Excel整行删除一致: 区域内的行全被删时去掉, 部分被删时收缩到剩下的行(只剩一格时取消合并),
+        # 左上角所在行被删时把左上角单元格(值和格式)移到收缩后区域的左上角
+        merges, anchors = [], {}
+        for merged in ws.merged_cells.ranges:
+            survivors = merged.max_row - merged.min_row + 1 - (bisect.bisect_right(deleted, merged.max_row) - bisect.bisect_left(deleted, merged.min_row))
+            if not survivors: continue
+            top = shifted(merged.min_row)
+            if merged.min_row in gone: anchors[(top, merged.min_col)] = ws._cells.get((merged.min_row, merged.min_col))
+            merged.min_row, merged.max_row = top, top + survivors - 1
+            if merged.max_row > merged.min_row or merged.max_col > merged.min_col: merges.append(merged)
+        ws.merged_cells.ranges = set(merges)
+
+        cells = {}
+        for (r, c), cell in ws._cells.items(): # openpyxl自身移动单元格也是直接改_cells
+            if r in gone: continue
+            nr = shifted(r)
+            if nr != r: cell.row = nr
+            cells[(nr, c)] = cell
+        for (r, c), cell in anchors.items():
+            if cell is not None: cell.row = r; cells[(r, c)] = cell
+        ws._cells = cells
+
+        dims = ws.row_dimensions
+        for r in sorted(k for k in list(dims.keys()) if k >= deleted[0]):
+            dim = dims.pop(r)
+            if r not in gone: dim.index = shifted(r); dims[dim.index] = dim
+
+        kept_images = []
+        for img in getattr(ws, '_images', []):
+            anchor = getattr(img, 'anchor', None)
+            start, end = getattr(anchor, '_from', None), getattr(anchor, 'to', None)
+            if start is None: kept_images.append(img); continue
+            top, bottom = start.row + 1, (end.row + 1 if end is not None else start.row + 1) # 锚点行号从0开始
+            if all(r in gone for r in range(top, bottom + 1)): continue # 图片所在行全部被删, 与Excel一同删除
+            start.row = shifted(top) - 1
+            if end is not None: end.row = shifted(bottom) - 1
+            kept_images.append(img)
+        ws._images = kept_images
+        return []
+
+    def shape_count(self): return len(getattr(self.ws, '_images', []))
+
+    def shape_size(self, index):
+        img = self.ws._images[index - 1]
+        return img.width * 0.75, img.height * 0.75 # 像素 -> 磅
+
+
+class MemorySheet(SheetBackend):
+    """内存假工作表, 用于在无Excel的环境测试和基准对比逐单元格/整块读写。
+    calls统计"跨进程"调用次数, latency(秒)模拟每次COM调用的往返耗时"""
+    def __init__(self, cells=None, name="内存表", latency=0.0):
+        self.cells = dict(cells or {}) # (行, 列) -> 值
+        self.colors = {}
+        self.name = name
+        self.latency = latency
+        self.calls = 0
+
+    def _call(self):
+        self.calls += 1
+        if self.latency:
+            end = time.perf_counter() + self.latency
+            while time.perf_counter() < end: pass
+
+    def get(self, row, col): self._call(); return self.cells.get((row, col))
+
+    def set(self, row, col, value):
+        self._call()
+        if value is None or value == "": self.cells.pop((row, col), None)
+        else: self.cells[(row, col)] = value
+
+    def set_color(self, row, col, color_index): self._call(); self.colors[(row, col)] = color_index
+
+    def last_row(self):
+        self._call()
+        if not self.cells: raise ValueError(f"工作表 '{self.name}' 无内容")
+        return max(r for r, _ in self.cells)
+
+    def delete_row(self, row): self.delete_rows([row])
+
+    def delete_rows(self, rows):
+        deleted = sorted(set(rows))
+        if not deleted: return []
+        self._call()
+        gone = set(deleted)
+        self.cells = {(r - bisect.bisect_left(deleted, r), c): v for (r, c), v in self.cells.items() if r not in gone}
+        self.colors = {(r - bisect.bisect_left(deleted, r), c): v for (r, c), v in self.colors.items() if r not in gone}
+        return []
+
+    def shape_count(self): self._call(); return 0
+
+    def read_block(self, first_row, last_row, cols):
+        self._call()
+        return tuple(tuple(self.cells.get((r, c)) for c in cols) for r in range(first_row, last_row + 1))
+
+    def write_column(self, first_row, col, values):
+        if not values: return
+        self._call()
+        for i, v in enumerate(values):
+            if v is None or v == "": self.cells.pop((first_row + i, col), None)
+            else: self.cells[(first_row + i, col)] = v
+
+
+class SheetSnapshot(SheetBackend):
+    """数据区快照: 创建时用一次整块读取把起始行..最后行的若干列(E/F/G)读入内存,
+    之后这些单元格的读写都落在内存数组上; flush()时每个改动过的列用一次整列赋值写回。
+    数据区以外的单元格(如第2行简介)和标色直接透传给底层后端"""
+    def __init__(self, inner, cols, first_row):
+        self.inner = inner
+        self.name = inner.name
+        self.first_row = first_row
+        self.cols = sorted(set(cols))
+        try: self.last = inner.last_row()
+        except Exception: self.last = None
+        block = inner.read_block(first_row, self.last, self.cols) if self.last is not None and self.last >= first_row else ()
+        self.size = len(block)
+        self.data = {c: [row[i] for row in block] for i, c in enumerate(self.cols)}
+        self.dirty = set()
+
+    def _in_block(self, row, col):
+        return col in self.data and self.first_row <= row < self.first_row + self.size
+
+    def get(self, row, col):
+        if self._in_block(row, col): return self.data[col][row - self.first_row]
+        return self.inner.get(row, col)
+
+    def set(self, row, col, value):
+        if self._in_block(row, col): self.data[col][row - self.first_row] = value; self.dirty.add(col)
+        else: self.inner.set(row, col, value)
+
+    def set_color(self, row, col, color_index): self.inner.set_color(row, col, color_index)
+
+    def last_row(self):
+        if self.last is None: raise ValueError(f"工作表 '{self.name}' 无内容")
+        return self.last
+
+    def delete_row(self, row): self.delete_rows([row])
+
+    def delete_rows(self, rows):
+        # 底层删除后下方各行上移; 内存数组按存活行一次压缩即可保持对齐, 已改动的列在flush时整列覆盖
+        failed = self.inner.delete_rows(rows)
+        kept = {r for first, last, _ in failed for r in range(first, last + 1)}
+        gone = set(rows) - kept
+        if gone:
+            survivors = [i for i in range(self.size) if self.first_row + i not in gone]
+            for col, values in self.data.items(): self.data[col] = [values[i] for i in survivors]
+            self.size = len(survivors)
+            if self.last is not None: self.last -= sum(1 for r in gone if r <= self.last)
+        return failed
+
+    def shape_count(self): return self.inner.shape_count()
+    def shape_size(self, index): return self.inner.shape_size(index)
+
+    def flush(self):
+        for col in sorted(self.dirty): self.inner.write_column(self.first_row, col, self.data[col])
+        self.dirty.clear()
+
+
+class CountingSheet(SheetBackend):
+    """透传给底层后端并在counters中计数每类调用, 开启性能统计时套在原始后端外层, 统计的是真实的后端访问次数"""
+    def __init__(self, inner, counters):
+        self.inner, self.counters = inner, counters
+        self.name = inner.name
+
+    def get(self, row, col): self.counters['单元格读取'] += 1; return self.inner.get(row, col)
+    def set(self, row, col, value): self.counters['单元格写入'] += 1; self.inner.set(row, col, value)
+    def set_color(self, row, col, color_index): self.counters['单元格标色'] += 1; self.inner.set_color(row, col, color_index)
+    def last_row(self): self.counters['查找最后行'] += 1; return self.inner.last_row()
+    def delete_row(self, row): self.counters['删除调用'] += 1; self.inner.delete_row(row)
+
+    def delete_rows(self, rows):
+        self.counters['删除调用'] += 1
+        return self.inner.delete_rows(rows)
+
+    def shape_count(self): return self.inner.shape_count()
+    def shape_size(self, index): return self.inner.shape_size(index)
+
+    def read_block(self, first_row, last_row, cols):
+        block = self.inner.read_block(first_row, last_row, cols)
+        self.counters['整块读取'] += 1; self.counters['整块读取单元格'] += len(block) * len(cols)
+        return block
+
+    def write_column(self, first_row, col, values):
+        self.counters['整列写入'] += 1; self.counters['整列写入单元格'] += len(values)
+        self.inner.write_column(first_row, col, values)
+
+    def flush(self): self.inner.flush()
+
+
+# --- 缓存 ---
+class LRUCache:
+    """LRU缓存, 最多保留max_entries个, 0为不缓存。用于已解析的旧表(键为路径+修改时间+大小+列,
+    文件被修改后键随之变化, 不会用到过期内容)和说话人复制中的新旧台词两两相似度(键为两者下标)"""
+    def __init__(self, max_entries=8):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = self.misses = 0
+
+    def get(self, key, loader):
+        """返回(值, 是否命中); 未命中时调用loader()解析并放入缓存, 超出容量时淘汰最久未用的"""
+        if key in self.entries:
+            self.entries.move_to_end(key); self.hits += 1
+            return self.entries[key], True
+        self.misses += 1
+        value = loader()
+        if self.max_entries > 0:
+            self.entries[key] = value
+            while len(self.entries) > self.max_entries: self.entries.popitem(last=False)
+        return value, False
+
+    def clear(self):
+        self.entries.clear(); self.hits = self.misses = 0
+
+
+# --- 阶段计时 ---
+class StageTimer:
+    """按阶段累计耗时(秒): mark(名称)结束上一阶段并开始新阶段, mark(None)只结束上一阶段"""
+    def __init__(self, prefix=''):
+        self.prefix, self.times = prefix, {}
+        self._name, self._start = None, 0.0
+
+    def mark(self, name):
+        now = time.perf_counter()
+        if self._name is not None:
+            key = self.prefix + self._name
+            self.times[key] = self.times.get(key, 0.0) + now - self._start
+        self._name, self._start = name, now
+        return name
+
+    @staticmethod
+    def ordered(keys):
+        """阶段名排序: 按顶层阶段首次出现的顺序, 子阶段("父/子")紧跟在父阶段之后"""
+        keys = list(dict.fromkeys(keys))
+        first = {}
+        for i, k in enumerate(keys): first.setdefault(k.split('/')[0], i)
+        return sorted(keys, key=lambda k: (first[k.split('/')[0]], '/' in k))
+
+
+# --- 文本规范化 ---
+# 各处用到的正则在这里预编译; 句末标点表中都是单个字符, "以其中之一结尾"即最后一个字符在集合中
+CJK_RE = re.compile(r'[\u4e00-\u9fff]')
+CJK_OR_DIGIT_RE = re.compile(r'[\u4e00-\u9fff0-9]')
+LATIN_RE = re.compile(r'[A-Za-z]')
+NOT_MERGE_KEY_RE = re.compile(r'[^\u4e00-\u9fff。？！]+') # 中文过滤时合并键只保留汉字和。？！
+REPEATED_END_RE = re.compile(r'([。？！])\1{2,}')
+TRAILING_PUNCT_RE = re.compile(r'([。！？，.,!?:;\uff0c\uff1b\uff1a\uff1f\uff01\uff0e\s]+)$')
+WORD_RE = re.compile(r'[\u4e00-\u9fffA-Za-z0-9]+')
+WORD_NEXT_RE = re.compile(r'[\u4e00-\u9fffA-ZaZ0-9]+') # 连贯性评分中后一行一直用这个字符类, 保持原评分
+SENTENCE_SPLIT_RE = re.compile(r'[。！？.!?]')
+SENTENCE_RE = re.compile(r'[^。？！]+[。？！]*')
+BRACKETED_RE = re.compile(r'[【《\(（\[].*?[】》\)）\]]')
+NAME_SEPARATOR_RE = re.compile(r'[-_]')
+NOT_PLAIN_RE = re.compile(r'[^\u4e00-\u9fffA-Za-z0-9]+') # 去掉标点和空白, 增量复制说话人时比较新旧版本台词用
+
+TRAILING_PUNCTUATIONS = ('。', '！', '？', '.', '!', '?', '；', ';', '：', ':', ')', '）', '"', "'", '"', "'", ']', '】', '》', '…')
+TRAILING_PUNCT_SET = frozenset(TRAILING_PUNCTUATIONS)
+# 段落标点调整认可的句末标点
+PARAGRAPH_END_PUNCTS = frozenset(('。','！','？','.','!','?',';','；',':','：',')','）','"','\'','”','’',']','】','》','…','>','}','\uff0e','\uff01','\uff1f','\uff1b','\uff1a','\uff09','\uff02','\u201d','\u2019','\u300b','\u2026'))
+# 最终标点检查认可的结尾 (比段落标点多了逗号)
+FINAL_END_PUNCTS = frozenset(('。','！','？','.','!','?',';','；',':','：',')','）','"','\'','”','’',']','】','》','…','>','}','\uff0e','\uff01','\uff1f','\uff1b','\uff1a','\uff0c','\uff09','\u201d','\u2019','\u300b','\u2026',','))
+
+
+def strip_end_punct(text, puncts, strip=str.rstrip):
+    """反复去掉末尾属于puncts的字符, 每去一个后再strip"""
+    while text and text[-1] in puncts: text = strip(text[:-1])
+    return text
+
+
+def classify_row(text, chinese_filter):
+    """清洗/合并阶段对一行G列文本的判断, 返回(合并键, 删除原因); 不删除时原因为空串。
+    中文过滤: 合并键只留汉字和。？！且连续3个以上相同的收成2个, 无汉字且字母少于3种的行删除;
+    否则合并键为原文, 字母少于3种且无汉字和数字的行删除。先查汉字, 大多数行只需一次正则"""
+    if chinese_filter:
+        key = NOT_MERGE_KEY_RE.sub('', text)
+        if key and ('。。。' in key or '？？？' in key or '！！！' in key): key = REPEATED_END_RE.sub(r'\1\1', key)
+        if not CJK_RE.search(text) and len(set(LATIN_RE.findall(text))) < 3: return key, "中文过滤:无中文且字母少于3种"
+        return key, ""
+    if not CJK_OR_DIGIT_RE.search(text) and len(set(LATIN_RE.findall(text))) < 3: return text, "常规:字母少于3种且无中文或数字"
+    return text, ""
+
+
+# --- 重复台词合并 ---
+# 合并键的可选折叠: 先折叠台词再按classify_row取合并键
+MERGE_KEY_FOLDS = ('width', 'space', 'traditional')
+# 全角字母数字和全角空格转半角, 半角标点转全角 (中文台词里标点以全角为准, 不影响中文过滤合并键保留的。？！);
+# 句点另转为句号: 全角句点．不在合并键保留的标点里, "好."和"好。"要得到同一个键
+WIDTH_FOLD = {c: c - 0xFEE0 for c in range(0xFF01, 0xFF5F) if chr(c - 0xFEE0).isalnum()}
+WIDTH_FOLD.update({c: c + 0xFEE0 for c in range(0x21, 0x7F) if not chr(c).isalnum()})
+WIDTH_FOLD.update({ord('.'): '。', ord('．'): '。', 0x3000: 0x20})
+WHITESPACE_RE = re.compile(r'\s+')
+
+
+def _key_hash(key):
+    """合并键的64位blake2b哈希"""
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+MINHASH_PRIME = (1 << 31) - 1 # 系数和字串哈希都小于2^32, a*h+b不超出uint64, numpy和纯Python结果相同
+NEAR_DUP_MIN_LEN = 4 # 合并键短于此的台词(如"好的。")不做近似合并, 短句差一个字就是另一句话
+
+
+class MinHashLSH:
+    """近似重复检测: 合并键的字二元组集合算MinHash签名, 签名分成bands段, 任一段相同的两行为候选, 再按实际Jaccard相似度确认。
+    每行只算一次签名、每段查一次桶, 整体约为线性。段数b和每段长度r取(1/b)^(1/r)不高于阈值中最接近者, 候选概率在阈值附近陡升又不漏"""
+    def __init__(self, threshold, num_perm=64, seed=1):
+        self.threshold = threshold
+        self.bands, self.band_rows = self._bands(threshold, num_perm)
+        rnd = random.Random(seed)
+        self.perms = [(rnd.randrange(1, MINHASH_PRIME), rnd.randrange(0, MINHASH_PRIME)) for _ in range(self.bands * self.band_rows)]
+        if np is not None: self._a, self._b = (np.array(col, dtype=np.uint64) for col in zip(*self.perms))
+        self.buckets = {} # (段号, 段签名哈希) -> [行]
+        self.checked = 0
+
+    @staticmethod
+    def _bands(threshold, num_perm):
+        options = [(b, num_perm // b) for b in range(1, num_perm + 1)]
+        below = [(b, r) for b, r in options if (1 / b) ** (1 / r) <= threshold]
+        return max(below, key=lambda br: ((1 / br[0]) ** (1 / br[1]), br[0])) if below else (num_perm, 1)
+
+    @staticmethod
+    def shingles(text):
+        """字二元组的crc32集合(跨进程稳定, 不受PYTHONHASHSEED影响); 单字文本取该字"""
+        return {zlib.crc32(text[k:k + 2].encode('utf-8')) for k in range(max(1, len(text) - 1))}
+
+    def signature(self, text):
+        hashes = self.shingles(text)
+        if np is not None:
+            hs = np.fromiter(hashes, dtype=np.uint64, count=len(hashes))
+            return ((self._a[:, None] * hs[None, :] + self._b[:, None]) % MINHASH_PRIME).min(axis=1).tolist()
+        return [min((a * h + b) % MINHASH_PRIME for h in hashes) for a, b in self.perms]
+
+    def add(self, row, text):
+        sig, r = self.signature(text), self.band_rows
+        for band in range(self.bands): self.buckets.setdefault((band, hash(tuple(sig[band * r:(band + 1) * r]))), []).append(row)
+
+    def clusters(self, text_of):
+        """确认后的近似重复簇(按行号排序的行列表, 至少两行); text_of(行)取该行合并键。
+        按行号从前往后, 尚未归簇的行作为代表, 与它同桶的未归簇行只有和代表本身的相似度达到阈值才并入,
+        不经中间行传递(A~B、B~C而A、C不够相似时A、C不在一簇), 簇内每行都与保留的首行近似"""
+        shared = {} # 行 -> 它所在的多行桶
+        for rows in self.buckets.values():
+            if len(rows) > 1:
+                for row in rows: shared.setdefault(row, []).append(rows)
+        assigned, result = set(), []
+        for head in sorted(shared):
+            if head in assigned: continue
+            assigned.add(head)
+            head_set, members = self.shingles(text_of(head)), [head]
+            for row in sorted({row for rows in shared[head] for row in rows} - assigned):
+                self.checked += 1
+                other = self.shingles(text_of(row))
+                if len(head_set & other) >= self.threshold * len(head_set | other): members.append(row); assigned.add(row)
+            if len(members) > 1: result.append(members)
+        return result
+
+
+class DuplicateMerger:
+    """重复台词合并: 逐行add(行号, 台词, 合并键), 合并键相同的行归为一组, 只保留首行。
+    只出现一次的合并键只存64位哈希和首行号; 哈希再次出现时用read_text取首行台词重算合并键核对,
+    核对后的组才保存合并键文本; 真正的哈希冲突改用完整合并键分组, 结果与按合并键文本分组相同。
+    folds为取合并键前对台词的折叠: width全角/半角, space去空白, traditional繁体转简体(需要opencc)。
+    near_threshold>0时另把各合并键的首行加入MinHashLSH, 与最前一行的字二元组Jaccard相似度达到阈值的几组并成一组, 仍只保留最前一行"""
+    def __init__(self, chinese_filter, read_text, folds=(), near_threshold=0.0):
+        self.chinese_filter, self.read_text = chinese_filter, read_text
+        self.folds = tuple(f for f in MERGE_KEY_FOLDS if f in folds)
+        self._t2s = opencc.OpenCC('t2s') if 'traditional' in self.folds else None
+        self.first = {} # 哈希 -> 首行
+        self.dups = {} # 哈希 -> [首行, 合并键, [重复行]], 出现过重复的合并键
+        self.exact = {} # 哈希冲突的合并键 -> [首行, 合并键, [重复行]]
+        self.rows = self.collisions = self.near_groups = 0
+        self.near = MinHashLSH(near_threshold) if near_threshold > 0 else None
+        self._groups = None
+
+    def key(self, text, base_key=None):
+        """台词的合并键; 没有折叠时直接用classify_row算好的base_key"""
+        if not self.folds and base_key is not None: return base_key
+        if 'width' in self.folds: text = text.translate(WIDTH_FOLD)
+        if 'space' in self.folds: text = WHITESPACE_RE.sub('', text)
+        if self._t2s: text = self._t2s.convert(text)
+        return classify_row(text, self.chinese_filter)[0]
+
+    def add(self, row, text, base_key=None):
+        key = self.key(text, base_key)
+        if not key: return
+        self.rows += 1
+        h = _key_hash(key)
+        first = self.first.get(h)
+        if first is None: self.first[h] = row; self._add_near(row, key); return
+        group = self.dups.get(h)
+        if group is None:
+            group = [first, self.key(self.read_text(first)), []]
+            self.dups[h] = group
+        if group[1] != key: # 哈希相同而合并键不同
+            self.collisions += 1
+            group = self.exact.get(key)
+            if group is None: self.exact[key] = [row, key, []]; self._add_near(row, key); return
+        group[2].append(row)
+
+    def _add_near(self, row, key):
+        if self.near and len(key) >= NEAR_DUP_MIN_LEN: self.near.add(row, key)
+
+    def groups(self):
+        """有重复的各组(合并键, 首行, [重复行]), 按首行排序; 近似重复的几组合成一组, 合并键取最前一行的"""
+        if self._groups is not None: return self._groups
+        found = {g[0]: g for g in list(self.dups.values()) + list(self.exact.values()) if g[2]}
+        if self.near:
+            keys = {}
+            def key_of(r):
+                if r not in keys: keys[r] = self.key(self.read_text(r))
+                return keys[r]
+            for cluster in self.near.clusters(key_of):
+                rows = []
+                for r in cluster:
+                    if r != cluster[0]: rows.append(r)
+                    rows.extend(found.pop(r, (None, None, []))[2])
+                found[cluster[0]] = [cluster[0], key_of(cluster[0]), sorted(rows)]
+                self.near_groups += 1
+        self._groups = [(key, first, rows) for first, key, rows in sorted(found.values())]
+        return self._groups
+
+    def stats(self):
+        sizes = [len(rows) + 1 for _, _, rows in self.groups()]
+        return {'行数': self.rows, '不同台词': len(self.first) + len(self.exact), '重复组': len(sizes), '删除行': sum(sizes) - len(sizes),
+                '最大组': max(sizes, default=0), '哈希冲突': self.collisions, **({'近似合并组': self.near_groups, '近似候选核对': self.near.checked} if self.near else {})}
+
+
+# --- 逐行特征 ---
+CONTINUITY_WORDS = ('然后', '接着', '所以', '但是', '而且', '因为', '不过', '如果', '因此', '还有', '另外', '同时', '于是', '那么', '此外')
+QUESTION_STARTS = ("什么", "谁", "哪", "怎么", "为啥", "几时", "难道", "可否", "能否")
+ANSWER_STARTS = ("是", "不是", "对", "没错", "好", "嗯", "不", "没", "也许", "当然", "因为", "在于", "就是")
+
+
+class LineFeatures:
+    """一行台词的派生特征, 每行只算一次, 供各匹配阶段和后处理规则读取"""
+    __slots__ = ('length', 'plain_len', 'words', 'words_next', 'continues', 'sentences', 'ends_punct',
+                 'ends_question', 'question', 'answer_start', 'pronouns', 'starts_pronoun', 'ends_particle')
+
+    def __init__(self, text):
+        self.length = len(text)
+        self.plain_len = len(text.replace(" ", ""))
+        self.words = frozenset(WORD_RE.findall(text))
+        self.words_next = frozenset(WORD_NEXT_RE.findall(text))
+        self.continues = text.startswith(CONTINUITY_WORDS)
+        self.sentences = tuple(_split_sentences(text))
+        self.ends_punct = text[-1:] in TRAILING_PUNCT_SET
+        self.ends_question = text.endswith(('?', '？'))
+        self.question = self.ends_question or text.startswith(QUESTION_STARTS)
+        self.answer_start = text.startswith(ANSWER_STARTS)
+        self.pronouns = frozenset(w for w in ('我', '你', '您') if w in text)
+        self.starts_pronoun = text.startswith(('你', '我', '他', '她'))
+        self.ends_particle = text.endswith(('吧', '啊', '呢'))
+
+    def transition_to(self, nxt):
+        """本行接下一行的连贯分: 承接词0.4, 共有词最多0.3"""
+        score = 0.0
+        if nxt.continues: score += 0.4
+        common = self.words & nxt.words_next
+        if common: score += min(0.3, len(common) * 0.05 + 0.05)
+        return score
+
+    def differs_from(self, nxt):
+        """下一行像是换了说话人: 问句后不以代词开头的回答、我/你对称、语气词收尾后接长句"""
+        if self.ends_question and not nxt.starts_pronoun and nxt.length > 2: return True
+        p1, p2 = self.pronouns, nxt.pronouns
+        if (('我' in p1 and ('你' in p2 or '您' in p2)) or (('你' in p1 or '您' in p1) and '我' in p2)) and not p1 & p2: return True
+        return self.ends_particle and not nxt.ends_particle and self.length < 10 and nxt.length > 3
+
+    def answered_by(self, nxt):
+        """本行是问句且下一行像回答"""
+        return self.question and (nxt.answer_start or (nxt.length > 0 and not nxt.ends_question))
+
+
+# --- 说话人特征短语 ---
+class SpeakerPhrases:
+    """各说话人的特征短语{说话人: [短语, ...]}, 附一个覆盖全部短语的Aho–Corasick自动机:
+    每条台词只扫描一遍就找出出现的所有短语, 再按说话人、按短语原顺序累加得分, 与逐个短语做 in 判断的结果相同"""
+    def __init__(self, patterns):
+        self.patterns, self.speakers = patterns, list(patterns)
+        owners = {} # 短语 -> [(说话人序号, 在该说话人短语表中的位置)], 不同说话人可能有相同短语
+        for si, speaker in enumerate(self.speakers):
+            for pos, phrase in enumerate(patterns[speaker]): owners.setdefault(phrase, []).append((si, pos))
+        self.owners = list(owners.values())
+        self.goto, self.fail, self.out = [{}], [0], [()]
+        for pid, phrase in enumerate(owners):
+            node = 0
+            for ch in phrase:
+                child = self.goto[node].get(ch)
+                if child is None:
+                    child = self.goto[node][ch] = len(self.goto)
+                    self.goto.append({}); self.fail.append(0); self.out.append(())
+                node = child
+            self.out[node] += (pid,)
+        pending = deque(self.goto[0].values()) # 第一层的失败指针都是根
+        while pending:
+            node = pending.popleft()
+            for ch, child in self.goto[node].items():
+                pending.append(child)
+                f = self.fail[node]
+                while f and ch not in self.goto[f]: f = self.fail[f]
+                self.fail[child] = self.goto[f].get(ch, 0)
+                self.out[child] += self.out[self.fail[child]]
+
+    def __len__(self): return len(self.patterns)
+
+    def scores(self, text):
+        """[(说话人, 得分)]: 只含至少出现一个短语的说话人, 按说话人原顺序; 得分为出现短语的长度/10之和"""
+        goto, fail, out = self.goto, self.fail, self.out
+        found, node = set(), 0
+        for ch in text:
+            while node and ch not in goto[node]: node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node]: found.update(out[node])
+        hits = {}
+        for pid in found:
+            for si, pos in self.owners[pid]: hits.setdefault(si, []).append(pos)
+        result = []
+        for si in sorted(hits):
+            phrases, score = self.patterns[self.speakers[si]], 0.0
+            for pos in sorted(hits[si]): score += len(phrases[pos]) / 10.0
+            result.append((self.speakers[si], score))
+        return result
+
+
+# --- 台词行列式存储 ---
+class DialogueRow:
+    """DialogueTable中一行的视图, 用原来台词字典的键读写对应的列; 不复制数据, 用完即弃"""
+    __slots__ = ('table', 'i')
+
+    def __init__(self, table, i): self.table, self.i = table, i
+    def __getitem__(self, key): return self.table.get_field(self.i, key)
+    def __setitem__(self, key, value): self.table.set_field(self.i, key, value)
+
+    def get(self, key, default=None):
+        value = self.table.get_field(self.i, key)
+        return default if value is None else value
+
+
+class DialogueTable:
+    """台词行的列式存储, 供说话人复制各阶段共用: 行号/台词各一列, 说话人名编号后存为整数列(-1为无),
+    used/matched为bytearray标志; row_pos把行号映射到下标, 按行号查找和更新都是O(1)。
+    旧表用row/speaker/dialog/used; 新表另用matched/speaker_after_match/paragraph_id/paragraph_position
+    和内容猜测(content_speaker_guess/content_confidence)。热点循环直接读列, 其余代码可用table[i]['键']。
+    compute_features()之后features[i]为第i行的LineFeatures, transitions[i]为第i行接第i+1行的连贯分"""
+    def __init__(self):
+        self.rows, self.dialogs = array('i'), []
+        self.speaker_ids, self.speaker_after, self.guess_ids = array('i'), array('i'), array('i')
+        self.guess_conf, self.para_ids, self.para_pos = array('d'), array('i'), array('i')
+        self.used, self.matched = bytearray(), bytearray()
+        self.names, self.name_ids = [], {}
+        self.row_pos = {}
+        self.features = self.transitions = None
+
+    def compute_features(self):
+        """逐行特征提取, 已算过时直接返回 (fresh()副本与原表共用)"""
+        if self.features is None:
+            self.features = [LineFeatures(t) for t in self.dialogs]
+            self.transitions = [a.transition_to(b) for a, b in zip(self.features, self.features[1:])]
+        return self.features
+
+    def set_dialog(self, i, text):
+        """台词被改写(如段落标点)后同步更新该行及相邻的特征"""
+        self.dialogs[i] = text
+        if self.features is None: return
+        self.features[i] = LineFeatures(text)
+        if i > 0: self.transitions[i - 1] = self.features[i - 1].transition_to(self.features[i])
+        if i + 1 < len(self.features): self.transitions[i] = self.features[i].transition_to(self.features[i + 1])
+
+    def intern(self, name):
+        """说话人名 -> 编号, None为-1"""
+        if name is None: return -1
+        sid = self.name_ids.get(name)
+        if sid is None: sid = self.name_ids[name] = len(self.names); self.names.append(name)
+        return sid
+
+    def name(self, sid): return None if sid < 0 else self.names[sid]
+
+    def append(self, row, dialog, speaker=None, guess=None, confidence=0.0):
+        self.row_pos[row] = len(self.rows)
+        self.rows.append(row); self.dialogs.append(dialog)
+        self.speaker_ids.append(self.intern(speaker)); self.guess_ids.append(self.intern(guess)); self.guess_conf.append(confidence)
+        self.speaker_after.append(-1); self.para_ids.append(-1); self.para_pos.append(-1)
+        self.used.append(0); self.matched.append(0)
+
+    def fresh(self):
+        """共用行号/台词/说话人列, 匹配状态全部重置的副本 (缓存的旧表每次匹配前取一份)"""
+        t = DialogueTable.__new__(DialogueTable)
+        t.__dict__.update(self.__dict__)
+        n = len(self.rows)
+        t.speaker_after, t.para_ids, t.para_pos = array('i', [-1]) * n, array('i', [-1]) * n, array('i', [-1]) * n
+        t.used, t.matched = bytearray(n), bytearray(n)
+        t.names, t.name_ids = list(self.names), dict(self.name_ids)
+        return t
+
+    def __len__(self): return len(self.rows)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice): return [DialogueRow(self, j) for j in range(*i.indices(len(self.rows)))]
+        if not -len(self.rows) <= i < len(self.rows): raise IndexError(i)
+        return DialogueRow(self, i % len(self.rows))
+
+    def __iter__(self): return (DialogueRow(self, i) for i in range(len(self.rows)))
+
+    def speaker(self, i): return self.name(self.speaker_ids[i])
+
+    def get_field(self, i, key):
+        if key == 'row': return self.rows[i]
+        if key == 'dialog': return self.dialogs[i]
+        if key == 'speaker': return self.name(self.speaker_ids[i])
+        if key == 'used': return bool(self.used[i])
+        if key == 'matched': return bool(self.matched[i])
+        if key == 'speaker_after_match': return self.name(self.speaker_after[i])
+        if key == 'paragraph_id': return None if self.para_ids[i] < 0 else self.para_ids[i]
+        if key == 'paragraph_position': return self.para_pos[i]
+        if key == 'content_speaker_guess': return self.name(self.guess_ids[i])
+        if key == 'content_confidence': return self.guess_conf[i]
+        raise KeyError(key)
+
+    def set_field(self, i, key, value):
+        if key == 'used': self.used[i] = 1 if value else 0
+        elif key == 'matched': self.matched[i] = 1 if value else 0
+        elif key == 'speaker_after_match': self.speaker_after[i] = self.intern(value)
+        elif key == 'paragraph_id': self.para_ids[i] = -1 if value is None else value
+        elif key == 'paragraph_position': self.para_pos[i] = value
+        else: raise KeyError(key)
+
+
+# --- 台词检索 ---
+def _bigram_counts(text):
+    """文本的字符二元组计数"""
+    counts = {}
+    for i in range(len(text) - 1):
+        g = text[i:i + 2]; counts[g] = counts.get(g, 0) + 1
+    return counts
+
+
+class DialogIndex:
+    """旧表台词检索索引, 让Stage 1不必与每条旧台词逐一计算SequenceMatcher相似度。
+
+    候选过滤只使用相似度的上界 (长度上界、共享二元组数下界、real_quick_ratio/quick_ratio),
+    不会漏掉ratio达到阈值的旧台词, 因此选出的最佳匹配与全量扫描完全一致。
+    共享二元组下界: 任意单调对齐中, 新台词的二元组只会被未匹配字符(每个最多2个)或
+    旧台词中的未匹配字符间隔(每个最多1个)破坏, 故 共享数 >= (la-1) - 2(la-M) - (lb-M)"""
+    def __init__(self, texts):
+        self.texts = texts
+        self.ratio_calls = 0 # 实际计算SequenceMatcher.ratio()的次数
+        self.lengths = [len(t) for t in texts]
+        self.grams = [_bigram_counts(t) for t in texts]
+        self.exact, self.by_len, self.postings = {}, {}, {}
+        for j, text in enumerate(texts):
+            self.exact.setdefault(text, []).append(j)
+            self.by_len.setdefault(len(text), []).append(j)
+            for g in self.grams[j]: self.postings.setdefault(g, []).append(j)
+
+    @staticmethod
+    def _required_shared(la, lb, threshold):
+        min_matches = math.ceil(threshold * (la + lb) / 2.0 - 1e-9) # ratio=2M/(la+lb)>=阈值时M的最小值
+        return (la - 1) - 2 * (la - min_matches) - (lb - min_matches)
+
+    def candidates(self, text, threshold, is_used):
+        """返回可能达到阈值的未用旧台词[(共享二元组数, 下标)], 按共享数从多到少排列"""
+        la = len(text)
+        lengths = [lb for lb in range(max(1, int(la * threshold / (2.0 - threshold)) - 1), int(la * (2.0 - threshold) / threshold) + 2)
+                   if 2.0 * min(la, lb) / (la + lb) >= threshold] # 与real_quick_ratio同一公式
+        if not lengths: return []
+        query = _bigram_counts(text)
+        tau_min = min(self._required_shared(la, lb, threshold) for lb in lengths)
+        if tau_min <= 0 or not query: # 太短的台词无法用二元组过滤, 退回按长度取候选
+            pool = [j for lb in lengths for j in self.by_len.get(lb, ())]
+        else:
+            # 前缀过滤: 取若干最稀有的二元组使其出现次数之和>=(la-1)-tau_min+1, 达标的旧台词必然至少含其中之一
+            pool, budget = set(), (la - 1) - tau_min + 1
+            for g, c in sorted(query.items(), key=lambda gc: len(self.postings.get(gc[0], ()))):
+                pool.update(self.postings.get(g, ()))
+                budget -= c
+                if budget <= 0: break
+        allowed = set(lengths)
+        result = []
+        for j in pool:
+            lb = self.lengths[j]
+            if lb not in allowed or is_used(j): continue
+            grams_j = self.grams[j]
+            shared = sum(min(c, grams_j.get(g, 0)) for g, c in query.items())
+            if shared >= self._required_shared(la, lb, threshold): result.append((shared, j))
+        result.sort(key=lambda sj: (-sj[0], sj[1]))
+        return result
+
+    def best_match(self, text, threshold, is_used, top_k=0, ratio=None):
+        """返回(下标, ratio): 未用旧台词中ratio最高且>=threshold者, 并列取下标最小, 与逐条扫描的结果相同;
+        top_k>0时只对共享二元组最多的top_k个候选打分 (更快但不再保证与全量扫描一致)。
+        ratio(j)可代替SequenceMatcher.ratio()计算与第j条的相似度 (如经缓存), 此时不计入ratio_calls"""
+        if threshold <= 0: return -1, 0.0
+        for j in self.exact.get(text, ()):
+            if not is_used(j): return j, 1.0 # 完全相同的文本ratio为1.0, 下标最小者即为最佳
+        best_idx, best_ratio = -1, 0.0
+        cands = self.candidates(text, threshold, is_used)
+        if top_k: cands = cands[:top_k]
+        for _, j in cands:
+            sm = difflib.SequenceMatcher(None, text, self.texts[j])
+            floor = max(threshold, best_ratio)
+            if sm.real_quick_ratio() < floor or sm.quick_ratio() < floor: continue
+            if ratio: r = ratio(j)
+            else: r = sm.ratio(); self.ratio_calls += 1
+            if r >= threshold and (r > best_ratio or (r == best_ratio and j < best_idx)): best_idx, best_ratio = j, r
+        return best_idx, best_ratio
+
+
+class BigramVectors:
+    """台词的字符二元组哈希向量(需要numpy): 二元组计数按crc32落到dim维, 再做L2归一化, 两行的余弦相似度即点积。
+    新×旧相似度矩阵分块整批计算, 只用来预排序候选, 是否匹配仍由SequenceMatcher按阈值确认。
+    余弦高低与SequenceMatcher的排序不完全一致, 且有哈希碰撞, 结果可能与逐条扫描不同 (基准测试s1会报告一致率)"""
+    def __init__(self, texts, dim=1024):
+        self.dim = dim
+        self.matrix = self.encode(texts)
+
+    def encode(self, texts):
+        m = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for g, c in (_bigram_counts(text) or {text: 1}).items(): m[i, zlib.crc32(g.encode('utf-8')) % self.dim] += c # 单字台词用单字本身
+        norms = np.linalg.norm(m, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return m / norms
+
+    def top_candidates(self, queries, k, chunk=512):
+        """每条查询台词余弦相似度最高的k个旧台词下标, 按相似度从高到低 (并列时下标小的在前)"""
+        k = min(k, len(self.matrix))
+        result = np.empty((len(queries), k), dtype=np.int64)
+        if not k: return result
+        q = self.encode(queries)
+        for start in range(0, len(queries), chunk):
+            sims = q[start:start + chunk] @ self.matrix.T
+            part = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+            part.sort(axis=1)
+            order = np.argsort(-np.take_along_axis(sims, part, axis=1), axis=1, kind='stable')
+            result[start:start + chunk] = np.take_along_axis(part, order, axis=1)
+        return result
+
+
+# --- 旧表文件库索引 ---
+def _name_grams(norm):
+    """规范文件名的单字和二元组计数, 两者放在同一张倒排表里, 按长度区分"""
+    grams = Counter(norm); grams.update(_bigram_counts(norm))
+    return grams
+
+
+OLD_INDEX_VERSION = 1 # 文件名规范化规则或表结构改变时加1, 已有索引会自动重建
+OLD_INDEX_DEFAULT_DB = os.path.join(os.path.expanduser('~'), '.台词表辅助脚本', '旧表索引.sqlite')
+
+
+class OldLibraryIndex:
+    """旧表文件库的持久索引(SQLite): 规范化文件名及其单字/二元组倒排、各文件夹的列表快照、解析过的表信息。
+    规范名只取决于文件名, 已入库的文件无需重算; 文件夹修改时间未变时直接用库中的文件列表, 不再列目录。
+    candidates()只用相似度上界过滤, 不会漏掉达到阈值的旧表: 相似度>=t要求至少t*(la+lb)/2个字相同,
+    而相同字数不超过两者共有的单字数; 二元组的下界与DialogIndex相同。文件名通常很短, 主要靠单字过滤"""
+    def __init__(self, db_path, normalize):
+        self.db_path, self.normalize = db_path, normalize
+        self._local = threading.local() # sqlite连接不能跨线程使用, 每个线程各开一个
+        if os.path.dirname(db_path): os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._setup()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None: conn = self._local.conn = sqlite3.connect(self.db_path, timeout=30)
+        return conn
+
+    def _setup(self):
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        row = conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row and row[0] == str(OLD_INDEX_VERSION): return
+        with conn:
+            conn.executescript("""
+                DROP TABLE IF EXISTS sheets; DROP TABLE IF EXISTS grams; DROP TABLE IF EXISTS folders;
+                CREATE TABLE sheets (path TEXT PRIMARY KEY, folder TEXT, norm TEXT, nlen INTEGER,
+                                     mtime_ns INTEGER, size INTEGER, sheet_name TEXT, last_row INTEGER, dialog_count INTEGER);
+                CREATE INDEX sheets_folder ON sheets (folder);
+                CREATE INDEX sheets_nlen ON sheets (nlen);
+                CREATE TABLE grams (gram TEXT, path TEXT, cnt INTEGER);
+                CREATE INDEX grams_gram ON grams (gram, path);
+                CREATE INDEX grams_path ON grams (path, gram, cnt);
+                CREATE TABLE folders (folder TEXT PRIMARY KEY, mtime_ns INTEGER);""")
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (str(OLD_INDEX_VERSION),))
+
+    def _add(self, conn, paths):
+        for path in paths:
+            norm = self.normalize(os.path.splitext(os.path.basename(path))[0])
+            conn.execute("INSERT OR REPLACE INTO sheets (path, folder, norm, nlen) VALUES (?, ?, ?, ?)", (path, os.path.dirname(path), norm, len(norm)))
+            conn.execute("DELETE FROM grams WHERE path = ?", (path,))
+            conn.executemany("INSERT INTO grams VALUES (?, ?, ?)", [(g, path, c) for g, c in _name_grams(norm).items()])
+
+    def list_folder(self, folder):
+        """文件夹内的.xlsx旧表(绝对路径, 按名称排序); 文件夹有增删时重新列目录并增量更新索引"""
+        folder = os.path.abspath(folder)
+        conn = self._conn()
+        mtime = os.stat(folder).st_mtime_ns
+        row = conn.execute("SELECT mtime_ns FROM folders WHERE folder = ?", (folder,)).fetchone()
+        if row and row[0] == mtime: return [p for (p,) in conn.execute("SELECT path FROM sheets WHERE folder = ? ORDER BY path", (folder,))]
+        listing = sorted(os.path.join(folder, f) for f in os.listdir(folder) if f.lower().endswith('.xlsx') and not f.startswith('~'))
+        known = {p for (p,) in conn.execute("SELECT path FROM sheets WHERE folder = ?", (folder,))}
+        current = set(listing)
+        with conn:
+            self._add(conn, [p for p in listing if p not in known])
+            gone = [(p,) for p in known - current]
+            conn.executemany("DELETE FROM sheets WHERE path = ?", gone); conn.executemany("DELETE FROM grams WHERE path = ?", gone)
+            conn.execute("INSERT OR REPLACE INTO folders VALUES (?, ?)", (folder, mtime))
+        return listing
+
+    def ensure(self, paths):
+        """把尚未入库的旧表(如单独选择的文件)加入索引"""
+        conn, known = self._conn(), set()
+        paths = list(dict.fromkeys(os.path.abspath(p) for p in paths))
+        for i in range(0, len(paths), 500):
+            chunk = paths[i:i + 500]
+            known.update(p for (p,) in conn.execute(f"SELECT path FROM sheets WHERE path IN ({','.join('?' * len(chunk))})", chunk))
+        missing = [p for p in paths if p not in known]
+        if missing:
+            with conn: self._add(conn, missing)
+        return len(missing)
+
+    def candidates(self, norm, threshold):
+        """返回规范名与norm的SequenceMatcher相似度可能>=threshold的旧表[(路径, 规范名)]"""
+        la = len(norm)
+        if not la or threshold <= 0: return [(p, n) for p, n in self._conn().execute("SELECT path, norm FROM sheets")]
+        lengths = [lb for lb in range(max(1, int(la * threshold / (2.0 - threshold)) - 1), int(la * (2.0 - threshold) / threshold) + 2)
+                   if 2.0 * min(la, lb) / (la + lb) >= threshold]
+        if not lengths: return []
+        conn, query = self._conn(), _name_grams(norm)
+        # 前缀过滤: 共有字数至少need_min, 则必含出现最少的(la-need_min+1)个字之一, 只需查这些字的倒排
+        need_min = math.ceil(threshold * (la + lengths[0]) / 2.0 - 1e-9)
+        chars = list(Counter(norm).items())
+        df = dict(conn.execute(f"SELECT gram, COUNT(*) FROM grams WHERE gram IN ({','.join('?' * len(chars))}) GROUP BY gram", [c for c, _ in chars]))
+        chars.sort(key=lambda cc: df.get(cc[0], 0))
+        prefix, covered = [], 0
+        for c, cnt in chars:
+            if covered >= la - need_min + 1: break
+            prefix.append(c); covered += cnt
+        values = ",".join("(?, ?)" for _ in query)
+        sql = (f"WITH q (gram, cnt) AS (VALUES {values}), "
+               f"p (path) AS (SELECT DISTINCT path FROM grams WHERE gram IN ({','.join('?' * len(prefix))})) "
+               "SELECT s.path, s.norm, SUM(CASE WHEN length(q.gram) = 1 THEN MIN(g.cnt, q.cnt) ELSE 0 END), "
+               "SUM(CASE WHEN length(q.gram) = 2 THEN MIN(g.cnt, q.cnt) ELSE 0 END) "
+               "FROM p CROSS JOIN sheets s ON s.path = p.path CROSS JOIN grams g ON g.path = p.path JOIN q ON q.gram = g.gram " # 固定连接顺序, 从少数候选出发
+               "WHERE s.nlen BETWEEN ? AND ? GROUP BY s.path")
+        params = [x for gc in query.items() for x in gc] + prefix + [lengths[0], lengths[-1]]
+        return [(p, n) for p, n, chars, bigrams in conn.execute(sql, params)
+                if chars >= math.ceil(threshold * (la + len(n)) / 2.0 - 1e-9) and bigrams >= DialogIndex._required_shared(la, len(n), threshold)]
+
+    def record_sheet(self, path, sheet_name, last_row, dialog_count):
+        """记录解析旧表时得到的表信息(附文件修改时间和大小, 供以后判断是否过期)"""
+        path = os.path.abspath(path); st = os.stat(path)
+        with self._conn() as conn:
+            conn.execute("UPDATE sheets SET mtime_ns = ?, size = ?, sheet_name = ?, last_row = ?, dialog_count = ? WHERE path = ?",
+                         (st.st_mtime_ns, st.st_size, sheet_name, last_row, dialog_count, path))
+
+    def sheet_info(self, path):
+        """已记录且未过期的表信息 {'sheet_name', 'last_row', 'dialog_count'}, 没有时返回None"""
+        path = os.path.abspath(path)
+        row = self._conn().execute("SELECT mtime_ns, size, sheet_name, last_row, dialog_count FROM sheets WHERE path = ?", (path,)).fetchone()
+        if not row or row[0] is None: return None
+        st = os.stat(path)
+        if (row[0], row[1]) != (st.st_mtime_ns, st.st_size): return None
+        return {'sheet_name': row[2], 'last_row': row[3], 'dialog_count': row[4]}
+
+
+# --- 增量处理清单 ---
+MANIFEST_VERSION = 1 # 清单格式改变时加1, 已有清单作废
+MANIFEST_NAME = '处理清单.json'
+# 不影响输出内容的配置项, 不计入配置指纹
+MANIFEST_IGNORED_CONFIG = frozenset(('last_folder', 'output_folder', 'log_level', 'workers', 'profile', 'profile_cprofile', 'com_bulk_io',
+                                     'old_cache_size', 'pair_cache_size', 'old_index', 'old_index_db', 's1_use_index', 'incremental', 'row_window'))
+
+
+def _file_digest(path):
+    """文件内容的blake2b摘要(十六进制)"""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''): h.update(chunk)
+    return h.hexdigest()
+
+
+class RunManifest:
+    """输出文件夹下的处理清单(JSON): 每个新表上次成功处理时新表/旧表的[大小, 修改时间, 内容摘要]、配置指纹和输出文件。
+    大小和修改时间都与记录相同时直接沿用记录的摘要, 不读文件; 否则重新计算摘要再比较, 复制或touch过但内容没变的文件仍可跳过"""
+    def __init__(self, path, config_key):
+        self.path, self.config_key = path, config_key
+        self.entries, self._states, self.dirty = {}, {}, False
+        try:
+            with open(path, encoding='utf-8') as f: data = json.load(f)
+            if data.get('version') == MANIFEST_VERSION: self.entries = data.get('files', {})
+        except (OSError, ValueError, AttributeError): pass # 没有清单或清单损坏时全部重新处理
+
+    def state(self, path, recorded=None):
+        """文件的[大小, 修改时间, 摘要]; 同一文件在一次运行中只算一次(多个新表对应同一旧表)"""
+        path = os.path.abspath(path)
+        if path not in self._states:
+            st = os.stat(path)
+            if recorded and recorded[:2] == [st.st_size, st.st_mtime_ns]: self._states[path] = list(recorded)
+            else: self._states[path] = [st.st_size, st.st_mtime_ns, _file_digest(path)]
+        return self._states[path]
+
+    def check(self, new_path, old_path):
+        """返回(需要重新处理的原因, 本次的状态); 原因为None表示新表、旧表、配置和输出文件都与上次相同"""
+        entry = self.entries.get(os.path.abspath(new_path)) or {}
+        old_abs = os.path.abspath(old_path) if old_path else None
+        current = {'new': self.state(new_path, entry.get('new')), 'old_path': old_abs,
+                   'old': self.state(old_path, entry.get('old') if entry.get('old_path') == old_abs else None) if old_path else None, 'config': self.config_key}
+        if not entry: return "无处理记录", current
+        if entry.get('config') != self.config_key: return "配置或程序有变化", current
+        if entry['new'][2] != current['new'][2]: return "新表有变化", current
+        if entry.get('old_path') != old_abs: return "匹配到的旧表不同", current
+        if old_abs and entry['old'][2] != current['old'][2]: return "旧表有变化", current
+        try: st = os.stat(entry['output'])
+        except OSError: return "输出文件不存在", current
+        if entry.get('output_stat') != [st.st_size, st.st_mtime_ns]: return "输出文件已被修改", current
+        if entry['new'] != current['new'] or entry.get('old') != current['old']: entry.update(current); self.dirty = True # 只是修改时间变了, 记下新的
+        return None, current
+
+    def output(self, new_path): return self.entries[os.path.abspath(new_path)]['output']
+
+    def record(self, new_path, current, output):
+        """新表处理成功后记录本次状态和输出文件"""
+        st = os.stat(output)
+        self.entries[os.path.abspath(new_path)] = dict(current, output=os.path.abspath(output), output_stat=[st.st_size, st.st_mtime_ns])
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty: return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f: json.dump({'version': MANIFEST_VERSION, 'files': self.entries}, f, ensure_ascii=False, indent=1)
+        os.replace(tmp, self.path) # 先写临时文件再替换, 中途中断不会留下半个清单
+        self.dirty = False
+
+
+def _gram_set(text):
+    """对齐用的廉价特征: 字符二元组集合 (单字台词用字本身)"""
+    return frozenset(text[i:i + 2] for i in range(len(text) - 1)) if len(text) > 1 else frozenset(text)
+
+
+def _dice(a, b):
+    return 2.0 * len(a & b) / (len(a) + len(b)) if a and b else 0.0
+
+
+def _contained(part, whole):
+    """part的二元组过半出现在whole中, 合并时要求每条新行都是旧行的一部分"""
+    return bool(part) and 2 * len(part & whole) > len(part)
+
+
+def _split_sentences(text):
+    """按句末标点切句, 与Stage 2一对多检测的切法一致"""
+    return [seg for seg in SENTENCE_SPLIT_RE.split(text) if seg.strip()]
+
+
+def align_dialogs(new_texts, old_texts, min_sim=0.3, band=60, max_merge=4, mergeable=None):
+    """新旧台词的带状单调序列对齐 (Needleman-Wunsch式, 跳过任一侧的行不罚分)。
+
+    每对(新行, 旧行)得分为二元组Dice相似度减min_sim, 只保留正得分; mergeable[j]为真的旧行
+    还可以整体对应连续2..max_merge条新行(一对多合并, 得分乘以行数, 每条新行都须大半包含在旧行中)。只计算对角线附近
+    +-band列, 时间O((N+M)*band), 回溯表每格1字节。
+    返回[(新行下标列表, 旧行下标, 相似度)], 按新行顺序排列"""
+    n, m = len(new_texts), len(old_texts)
+    if not n or not m: return []
+    new_sets = [_gram_set(t) for t in new_texts]
+    old_sets = [_gram_set(t) for t in old_texts]
+    mergeable = mergeable or [False] * m
+    max_merge = max(1, max_merge)
+    w = max(band, math.ceil(m / n) + max_merge + 1) # 带宽至少覆盖每行对角线的推进量, 保证带内连通
+    width = 2 * w + 1
+    NEG = float('-inf')
+    lo = [round(i * m / n) - w for i in range(n + 1)] # 第i行带内第一列对应的旧行号j
+    back = bytearray((n + 1) * width) # 0起点 1匹配 2跳过新行 3跳过旧行 k+2为k行合并
+    rows = {} # 只保留最近max_merge+1行的得分
+
+    def score_at(i, j):
+        t = j - lo[i]
+        return rows[i][t] if 0 <= t < width else NEG
+
+    for i in range(n + 1):
+        cur = [NEG] * width
+        unions = [None, None] + [frozenset().union(*new_sets[i - k:i]) for k in range(2, min(max_merge, i) + 1)] if any(mergeable) else []
+        for t in range(width):
+            j = lo[i] + t
+            if j < 0 or j > m: continue
+            if i == 0: cur[t] = 0.0; back[t] = 3 if j else 0; continue
+            best, move = score_at(i - 1, j), 2
+            if t and cur[t - 1] > best: best, move = cur[t - 1], 3
+            if j:
+                sim = _dice(new_sets[i - 1], old_sets[j - 1])
+                if sim > min_sim:
+                    v = score_at(i - 1, j - 1) + sim - min_sim
+                    if v > best: best, move = v, 1
+                if mergeable[j - 1] and _contained(new_sets[i - 1], old_sets[j - 1]):
+                    for k in range(2, len(unions)):
+                        if not _contained(new_sets[i - k], old_sets[j - 1]): break
+                        sim = _dice(unions[k], old_sets[j - 1])
+                        if sim > min_sim:
+                            v = score_at(i - k, j - 1) + k * (sim - min_sim)
+                            if v > best: best, move = v, k + 2
+            cur[t] = best; back[i * width + t] = move
+        rows[i] = cur
+        rows.pop(i - max_merge - 1, None)
+
+    pairs = []
+    i, j = n, m
+    while i > 0 or j > 0:
+        move = back[i * width + (j - lo[i])]
+        if move == 2: i -= 1
+        elif move == 3: j -= 1
+        elif move == 1:
+            pairs.append(([i - 1], j - 1, _dice(new_sets[i - 1], old_sets[j - 1]))); i -= 1; j -= 1
+        elif move >= 4:
+            k = move - 2
+            pairs.append((list(range(i - k, i)), j - 1, _dice(frozenset().union(*new_sets[i - k:i]), old_sets[j - 1]))); i -= k; j -= 1
+        else: break
+    pairs.reverse()
+    return pairs
+
+
+class ExcelBatchProcessor:
+    def __init__(self, root=None):
+        self.root = root
+        self.running = False
+        self.log_text = None
+        self.log_queue = None # 并行模式下子进程把日志行放进这个队列, 由主进程写到界面
+        self.ui_queue = None # 后台处理线程发给界面线程的日志行和界面回调
+        self.worker = None
+        self.dropped_logs = 0
+        self.setup_config()
+        if root is not None: self.setup_ui()
+        self.excel = None
+        self.file_queue = []
+        self.old_queue = []
+        self.results = [] # 本次运行每个新表的结果 {'file', 'output', 'seconds', 'error', 'stages', 'counters'}
+        self.stage_times = {} # 最近处理的文件各阶段耗时, 见StageTimer
+        self.counters = Counter() # 最近处理的文件的计数: 单元格读写、SequenceMatcher调用、删除/合并/匹配行数
+        self.old_cache = LRUCache(self.config['old_cache_size'])
+        self.pair_cache = LRUCache(0) # _copy_speakers开始时按pair_cache_size重建
+        self.old_index = None # OldLibraryIndex, 首次用到时打开
+        self.old_positions = {} # 旧表绝对路径 -> (在old_queue中的顺序, 原路径), run_queue开始时建立
+        self.old_matches = {} # 新表 -> 增量检查时已匹配到的旧表, _proc_file不再重复匹配
+        self.manifest, self.manifest_pending = None, {} # RunManifest, 待处理新表 -> 检查时的状态
+
+    def setup_config(self):
+        self.config = {
+            'col_e': 'E', 'col_g': 'G', 'col_f_speaker': 'F',
+            'chinese_filter': True, 'merge_duplicates': True,
+            'copy_intro': True, 'copy_speakers': True,
+            'speaker_match_threshold': 0.6, 'exact_match_threshold': 0.95,
+            'exact_match_length_ratio_threshold': 0.7,
+            'segment_coherence_weight': 0.25, 'segment_length_ratio_weight': 0.15,
+            'segment_similarity_weight': 0.60, 
+            'content_guess_confidence_threshold': 0.7,
+            'old_file_match_threshold': 0.7,
+            'image_scale_factor': 0.9,
+            'last_folder': os.getcwd(), 'output_folder': os.getcwd(),
+            'log_level': "INFO",
+            'engine': 'com' if win32 else 'openpyxl',
+            'com_bulk_io': True, # COM引擎下数据区整块读写 (False为逐单元格, 便于对比)
+            's1_use_index': True, 's1_index_top_k': 0, # Stage 1候选索引; top_k>0时只给前k个候选打分
+            's1_vector_prerank': False, 's1_vector_top_k': 8, # Stage 1改用numpy二元组向量预排序, 只确认余弦最高的k个 (近似, 需numpy)
+            'speaker_matcher': 'heuristic', # heuristic: S1/S2/S3三轮匹配; align: 带状序列对齐
+            'align_band': 60, 'align_max_merge': 4, 'align_min_similarity': 0.3,
+            'workers': 1, # 并行处理的子进程数, 1为在当前进程内逐个处理
+            'profile': False, # 性能统计: 统计单元格读写次数, 日志输出每个文件的分阶段明细, 运行结束导出JSON/CSV
+            'profile_cprofile': False, # 性能统计时另为每个文件保存cProfile数据(输出文件夹下 改_文件名.prof)
+            'old_cache_size': 8, # 已解析旧表的缓存个数, 多个新表对应同一旧表时只解析一次; 0为不缓存
+            'pair_cache_size': 200000, # 说话人复制中新旧台词两两相似度的缓存条数, S1/S2/S3共用; 0为不缓存
+            'old_index': False, # 用持久索引列旧表文件夹和匹配旧表文件名, 旧表很多时不必逐个比较; 会在old_index_db写SQLite文件, 默认关闭
+            'old_index_db': '', # 索引文件路径, 空为用户目录下的 .台词表辅助脚本/旧表索引.sqlite
+            'speaker_delta': False, # 说话人增量复制(只用于align模式): 与上次的 改_ 输出逐行比对, 未改动的行沿用其说话人, 只对增改的部分求对齐
+            'speaker_delta_min_kept': 0.5, # 可沿用的行少于这个比例时(改动太多)仍整表匹配
+            'merge_key_folds': '', # 合并重复前对台词的折叠, 逗号分隔: width全角/半角, space去空白, traditional繁转简(需opencc); 空为按原合并键
+            'merge_near_duplicates': False, # 合并重复时另把近似重复的台词(如语音识别/翻译的小差异)并成一组, 需启用合并重复
+            'near_duplicate_threshold': 0.7, # 近似重复的相似度阈值: 合并键字二元组集合的Jaccard相似度
+            'row_window': 2000, # 清洗/合并和标点调整每次读入的行数, 这两步的内存只随窗口而不随总行数增长 (COM引擎关闭com_bulk_io时逐单元格读, 不分块)
+            'incremental': False # 增量处理(默认关闭, 会在输出文件夹写处理清单.json): 新表、匹配的旧表、配置和输出都与清单记录相同时跳过
+        }
+
+    def setup_ui(self):
+        self.root.title("Excel高级批量处理器 v8.16 (UI属性修复)") 
+        self.root.geometry("900x750")
+
+        top_controls_frame = ttk.Frame(self.root)
+        top_controls_frame.pack(pady=10, padx=10, fill=tk.X)
+
+        ttk.Label(top_controls_frame, text="新表:").grid(row=0, column=0, padx=(0,5), pady=3, sticky='w')
+        ttk.Button(top_controls_frame, text="选择新表文件", command=self.select_file).grid(row=0, column=1, padx=2, pady=3, sticky='ew')
+        ttk.Button(top_controls_frame, text="选择新表文件夹", command=self.select_folder).grid(row=0, column=2, padx=2, pady=3, sticky='ew')
+
+        ttk.Label(top_controls_frame, text="旧表:").grid(row=1, column=0, padx=(0,5), pady=3, sticky='w')
+        ttk.Button(top_controls_frame, text="选择旧表文件", command=self.select_old_file).grid(row=1, column=1, padx=2, pady=3, sticky='ew')
+        ttk.Button(top_controls_frame, text="选择旧表文件夹", command=self.select_old_folder).grid(row=1, column=2, padx=2, pady=3, sticky='ew')
+
+        ttk.Button(top_controls_frame, text="选择输出位置", command=self.select_output_folder).grid(row=2, column=0, columnspan=1, padx=(0,2), pady=(10,3), sticky='ew')
+
+        s = ttk.Style(); s.configure("Accent.TButton", font=('Segoe UI',9,'bold'), foreground='green'); s.configure("Stop.TButton", font=('Segoe UI',9,'bold'), foreground='red')
+        ttk.Button(top_controls_frame, text="开始处理", command=self.start_processing, style="Accent.TButton").grid(row=2, column=1, padx=2, pady=(10,3), ipady=4, sticky='ew')
+        ttk.Button(top_controls_frame, text="停止", command=self.stop_processing, style="Stop.TButton").grid(row=2, column=2, padx=2, pady=(10,3), ipady=4, sticky='ew')
+
+        top_controls_frame.columnconfigure(1, weight=1); top_controls_frame.columnconfigure(2, weight=1)
+
+        cfg_frame = ttk.LabelFrame(self.root, text="处理配置")
+        cfg_frame.pack(pady=5, padx=10, fill=tk.X)
+
+        # E, G, F 列输入框 - 使用 setattr 创建 self.entry_e, self.entry_g, self.entry_speaker
+        cols_cfg_data = [("内容列(E):", 'col_e'), ("文本列(G):", 'col_g'), ("说话人列(F):", 'col_f_speaker')]
+        for i, (text, cfg_key) in enumerate(cols_cfg_data):
+            ttk.Label(cfg_frame, text=text).grid(row=0, column=i*2, padx=5, pady=3, sticky='w')
+            entry = ttk.Entry(cfg_frame, width=5)
+            entry.insert(0, self.config[cfg_key])
+            entry.grid(row=0, column=i*2+1, padx=5, pady=3)
+            # setattr f"entry_{cfg_key.split('_')[-1]}" 会创建 self.entry_e, self.entry_g, self.entry_speaker
+            setattr(self, f"entry_{cfg_key.split('_')[-1]}", entry) 
+
+        # 复选框配置 - 使用明确的属性名 self.var_ch, self.var_mg, self.var_int, self.var_spk
+        self.var_ch = tk.BooleanVar(value=self.config['chinese_filter'])
+        ttk.Checkbutton(cfg_frame, text="启用中文过滤", variable=self.var_ch).grid(row=1, column=0, columnspan=2, padx=5, pady=3, sticky='w')
+        
+        self.var_mg = tk.BooleanVar(value=self.config['merge_duplicates'])
+        ttk.Checkbutton(cfg_frame, text="启用合并重复", variable=self.var_mg).grid(row=1, column=2, columnspan=2, padx=5, pady=3, sticky='w')
+        
+        self.var_int = tk.BooleanVar(value=self.config['copy_intro'])
+        ttk.Checkbutton(cfg_frame, text="启用简介复制", variable=self.var_int).grid(row=1, column=4, columnspan=2, padx=5, pady=3, sticky='w')
+        
+        self.var_spk = tk.BooleanVar(value=self.config['copy_speakers'])
+        ttk.Checkbutton(cfg_frame, text="启用说话人复制", variable=self.var_spk).grid(row=2, column=0, columnspan=2, padx=5, pady=3, sticky='w')
+
+        # 阈值输入框 - 使用明确的属性名 self.entry_th_speaker, self.entry_th_filename
+        ttk.Label(cfg_frame, text="内容匹配阈值:").grid(row=2, column=2, padx=5, pady=3, sticky='w')
+        self.entry_th_speaker = ttk.Entry(cfg_frame, width=5)
+        self.entry_th_speaker.insert(0, str(self.config['speaker_match_threshold']))
+        self.entry_th_speaker.grid(row=2, column=3, padx=5, pady=3)
+        
+        ttk.Label(cfg_frame, text="文件名匹配阈值:").grid(row=2, column=4, padx=5, pady=3, sticky='w')
+        self.entry_th_filename = ttk.Entry(cfg_frame, width=5)
+        self.entry_th_filename.insert(0, str(self.config['old_file_match_threshold']))
+        self.entry_th_filename.grid(row=2, column=5, padx=5, pady=3)
+
+        ttk.Label(cfg_frame, text="处理引擎:").grid(row=3, column=0, padx=5, pady=3, sticky='w')
+        self.var_engine = tk.StringVar(value=self.config['engine'])
+        ttk.Combobox(cfg_frame, textvariable=self.var_engine, values=ENGINES, state='readonly', width=9).grid(row=3, column=1, columnspan=2, padx=5, pady=3, sticky='w')
+
+        ttk.Label(cfg_frame, text="说话人匹配:").grid(row=3, column=2, padx=5, pady=3, sticky='w')
+        self.var_matcher = tk.StringVar(value=self.config['speaker_matcher'])
+        ttk.Combobox(cfg_frame, textvariable=self.var_matcher, values=SPEAKER_MATCHERS, state='readonly', width=9).grid(row=3, column=3, columnspan=2, padx=5, pady=3, sticky='w')
+
+        ttk.Label(cfg_frame, text="并行进程数:").grid(row=3, column=4, padx=5, pady=3, sticky='w')
+        self.entry_workers = ttk.Spinbox(cfg_frame, from_=1, to=max(1, os.cpu_count() or 1), width=4)
+        self.entry_workers.set(self.config['workers'])
+        self.entry_workers.grid(row=3, column=5, padx=5, pady=3)
+
+        self.var_prof = tk.BooleanVar(value=self.config['profile'])
+        ttk.Checkbutton(cfg_frame, text="性能统计", variable=self.var_prof).grid(row=4, column=0, columnspan=2, padx=5, pady=3, sticky='w')
+        self.var_cprof = tk.BooleanVar(value=self.config['profile_cprofile'])
+        ttk.Checkbutton(cfg_frame, text="保存cProfile", variable=self.var_cprof).grid(row=4, column=2, columnspan=2, padx=5, pady=3, sticky='w')
+        self.var_incr = tk.BooleanVar(value=self.config['incremental'])
+        ttk.Checkbutton(cfg_frame, text="跳过未变化的文件(写处理清单)", variable=self.var_incr).grid(row=4, column=4, columnspan=2, padx=5, pady=3, sticky='w')
+        self.var_oidx = tk.BooleanVar(value=self.config['old_index'])
+        ttk.Checkbutton(cfg_frame, text="旧表文件库索引", variable=self.var_oidx).grid(row=5, column=0, columnspan=2, padx=5, pady=3, sticky='w')
+
+        log_frame = ttk.LabelFrame(self.root, text="日志输出")
+        log_frame.pack(pady=5, padx=10, fill=tk.BOTH, expand=True)
+        self.log_text = scrolledtext.ScrolledText(log_frame, wrap=tk.WORD, font=("Consolas", 9))
+        self.log_text.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        self.ui_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        self.root.after(LOG_DRAIN_MS, self._drain_ui_queue)
+
+    def log_enabled(self, level):
+        """该级别的日志是否会输出; 逐行的TRACE/DEBUG日志先用它判断, 避免拼接用不到的字符串"""
+        return LOG_LEVELS.get(level,2)>=LOG_LEVELS.get(self.config.get('log_level',"INFO").upper(),2)
+
+    def log(self, message, level="INFO"):
+        level=level.upper()
+        if not self.log_enabled(level): return
+        line=f"[{level}] {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - {message}"
+        if self.log_queue is not None: self.log_queue.put((level, line)); return
+        self._emit(line)
+
+    def _emit(self, line):
+        """输出一行已格式化的日志: 无界面时打印; 界面线程直接写控件; 后台线程放进有界队列, 由界面定时批量取走"""
+        if self.log_text is None: print(line, file=sys.stderr, flush=True); return # 无界面(命令行)模式, stdout留给运行报告
+        if threading.current_thread() is threading.main_thread(): self.log_text.insert(tk.END,line+"\n"); self.log_text.see(tk.END); return
+        try: self.ui_queue.put(line, timeout=1)
+        except queue.Full: self.dropped_logs+=1 # 界面长时间未响应(如窗口已关闭)时丢弃, 不卡住处理线程
+
+    def _ui_call(self, func, *args):
+        """在界面线程执行func(*args) (弹窗等Tk操作只能在界面线程做); 无界面时直接忽略"""
+        if self.ui_queue is None: return
+        try: self.ui_queue.put((func, args), timeout=1)
+        except queue.Full: pass # 同_emit: 界面已不再取队列(如窗口已关闭)时放弃这次界面回调, 不让处理线程永远卡住
+
+    def _drain_ui_queue(self):
+        """界面线程定时回调: 一次取出一批日志合并成一次写入, 顺序执行其中的界面回调"""
+        lines=[]; calls=[]
+        try:
+            for _ in range(LOG_DRAIN_BATCH):
+                item=self.ui_queue.get_nowait()
+                if isinstance(item,str): lines.append(item)
+                else: calls.append(item); break # 回调之前的日志先显示出来
+        except queue.Empty: pass
+        if self.dropped_logs: lines.append(f"[WARNING] 界面未及时刷新, 丢弃了 {self.dropped_logs} 行日志"); self.dropped_logs=0
+        if lines: self.log_text.insert(tk.END,"\n".join(lines)+"\n"); self.log_text.see(tk.END)
+        for func,args in calls: func(*args)
+        if self.root.winfo_exists(): self.root.after(LOG_DRAIN_MS if not lines and not calls else 1, self._drain_ui_queue)
+
+    def log_with_context(self, message, row=None, col_idx=None, level="INFO"):
+        if not self.log_enabled(level.upper()): return
+        ctx_info=""
+        if row is not None: ctx_info=f"行{row}"
+        if col_idx is not None:
+            try:col_ltr=self._idx2col(int(col_idx))
+            except:col_ltr=str(col_idx)
+            ctx_info+=f":{col_ltr}"
+        full_msg=f"{ctx_info} - {message}" if ctx_info else message
+        self.log(full_msg,level)
+
+    def select_file(self):
+        if self.running: messagebox.showwarning("提示","处理中..."); return
+        fp=filedialog.askopenfilename(title="选新表",filetypes=[("Excel","*.xlsx")],initialdir=self.config.get('last_folder',os.getcwd()))
+        if fp:self.config['last_folder']=os.path.dirname(fp);self.file_queue=[fp];self.log(f"选新表(单):{os.path.basename(fp)}")
+
+    def select_folder(self):
+        if self.running: messagebox.showwarning("提示","处理中..."); return
+        dp=filedialog.askdirectory(title="选新表文件夹",initialdir=self.config.get('last_folder',os.getcwd()))
+        if dp:
+            self.config['last_folder']=dp
+            self.file_queue=[os.path.join(dp,f) for f in os.listdir(dp) if f.lower().endswith('.xlsx') and not f.startswith('~')]
+            self.log(f"选新表文件夹:{dp}({len(self.file_queue)}个)" if self.file_queue else f"新表文件夹{dp}无.xlsx","INFO" if self.file_queue else "WARNING")
+
+    def select_old_file(self):
+        if self.running: messagebox.showwarning("提示","处理中..."); return
+        fp=filedialog.askopenfilename(title="选旧表",filetypes=[("Excel","*.xlsx")],initialdir=self.config.get('last_folder',os.getcwd()))
+        if fp:self.old_queue=[fp];self.log(f"选旧表(单):{os.path.basename(fp)}")
+
+    def select_old_folder(self):
+        if self.running: messagebox.showwarning("提示","处理中..."); return
+        dp=filedialog.askdirectory(title="选旧表文件夹",initialdir=self.config.get('last_folder',os.getcwd()))
+        if dp:
+            self.config['old_index']=self.var_oidx.get(); idx=self._get_old_index()
+            self.old_queue=idx.list_folder(dp) if idx else [os.path.join(dp,f) for f in os.listdir(dp) if f.lower().endswith('.xlsx') and not f.startswith('~')]
+            self.log(f"选旧表文件夹:{dp}({len(self.old_queue)}个)" if self.old_queue else f"旧表文件夹{dp}无.xlsx","INFO" if self.old_queue else "WARNING")
+
+    def select_output_folder(self):
+        dp=filedialog.askdirectory(title="选输出位置",initialdir=self.config.get('output_folder',os.getcwd()))
+        if dp:self.config['output_folder']=dp;self.log(f"输出设为:{dp}")
+
+    def start_processing(self):
+        if self.running or (self.worker and self.worker.is_alive()):messagebox.showwarning("处理中...","当前任务进行中。");return
+        if not self.file_queue:messagebox.showerror("错误","请先选新表。");return
+        self.update_cfg_from_ui() # 调用修正后的配置读取方法
+        if self.config.get('copy_speakers') and not self.old_queue:messagebox.showerror("错误","启用说话人复制但未选旧表。");return
+        if self.config.get('engine')=='com' and win32 is None:messagebox.showerror("错误","当前环境无win32com,请改用openpyxl引擎。");return
+        self.running=True;self.log("===== 处理开始 =====","INFO")
+        self.worker=threading.Thread(target=self._process_in_background,daemon=True);self.worker.start()
+
+    def _process_in_background(self):
+        """后台线程执行run_queue, 界面保持响应; 弹窗经_ui_call交回界面线程"""
+        try:
+            self.run_queue()
+            if self.running:self.log("所有文件处理完毕。","INFO");self._ui_call(messagebox.showinfo,"完成","所有文件处理完毕！")
+        except Exception as e:
+            self.log(f"主流程严重错误:{e}","CRITICAL");self.log(traceback.format_exc(),"DEBUG")
+            self._ui_call(messagebox.showerror,"严重错误",f"发生错误，详见日志:{e}")
+        finally:
+            self.running=False;self.log("===== 处理结束 =====","INFO")
+
+    def run_queue(self):
+        """按配置的引擎依次处理file_queue (图形界面和命令行共用); workers>1且有多个文件时交给进程池"""
+        self.results=[]
+        self.old_cache=LRUCache(self.config.get('old_cache_size',8))
+        self._prepare_old_index()
+        all_files=self.file_queue; skipped=self._skip_unchanged() if self.config.get('incremental') else []
+        try:
+            if self.config.get('workers',1)>1 and len(self.file_queue)>1: self.run_pool()
+            elif self.file_queue: self._run_serial()
+        finally:
+            self.old_cache.clear(); self.file_queue=all_files; self.old_matches={}
+            if self.manifest:
+                try: self.manifest.save()
+                except OSError as e: self.log(f"保存处理清单失败:{e}","WARNING")
+                self.manifest,self.manifest_pending=None,{}
+        if skipped:
+            order={fp:i for i,fp in enumerate(all_files)}; self.results=sorted(self.results+skipped,key=lambda r:order.get(r['file'],0))
+        hits,misses=(sum(r.get('counters',{}).get(k,0) for r in self.results) for k in ('旧表缓存命中','旧表缓存未命中'))
+        if hits or misses: self.log(f"旧表缓存: 命中 {hits} 次, 未命中(解析) {misses} 次","INFO")
+        if self.config.get('profile') and self.results: self._export_profile()
+
+    def _manifest_config_key(self):
+        """配置指纹: 影响输出内容的配置项, 加上本脚本的内容摘要(脚本更新后全部重新处理)"""
+        cfg={k:v for k,v in self.config.items() if not k.startswith('_') and k not in MANIFEST_IGNORED_CONFIG}
+        h=hashlib.blake2b(json.dumps(cfg,sort_keys=True,ensure_ascii=False).encode('utf-8'),digest_size=16)
+        h.update(_file_digest(os.path.abspath(__file__)).encode('ascii'))
+        return h.hexdigest()
+
+    def _skip_unchanged(self):
+        """增量处理: 对照输出文件夹下的处理清单, 把新表、匹配到的旧表、配置和输出文件都没变的新表移出file_queue, 返回这些新表的结果。
+        只比较文件大小/修改时间, 变了才读文件算摘要; 匹配到的旧表记入old_matches, 处理时不再重复匹配"""
+        try: self.manifest=RunManifest(os.path.join(self.config['output_folder'],MANIFEST_NAME),self._manifest_config_key())
+        except OSError as e: self.log(f"读取处理清单失败, 全部重新处理:{e}","WARNING"); return []
+        uses_old=self.config.get('copy_speakers') or self.config.get('copy_intro')
+        pending,skipped=[],[]
+        for fp in self.file_queue:
+            try:
+                old_path=None
+                if uses_old: old_path=self.old_matches[fp]=self._match_old(fp)
+                reason,self.manifest_pending[fp]=self.manifest.check(fp,old_path)
+            except OSError as e: reason=f"读取文件失败:{e}"
+            except (KeyError,IndexError,TypeError): reason="处理记录无效"
+            if reason: pending.append(fp); self.log(f"增量处理: '{os.path.basename(fp)}' 需要处理 ({reason})","DEBUG")
+            else: skipped.append({'file':fp,'output':self.manifest.output(fp),'seconds':0.0,'error':None,'skipped':True})
+        self.log(f"增量处理: {len(skipped)} 个文件与上次相同, 跳过; {len(pending)} 个文件需要处理","INFO")
+        self.file_queue=pending
+        return skipped
+
+    def _record_result(self, result):
+        """新表处理成功后写入处理清单(每个文件写一次, 中途停止也保留已完成的记录)"""
+        current=self.manifest_pending.get(result['file']) if self.manifest else None
+        if not current or not result.get('output'): return
+        try: self.manifest.record(result['file'],current,result['output']); self.manifest.save()
+        except OSError as e: self.log(f"更新处理清单失败:{e}","WARNING")
+
+    def _run_serial(self):
+        use_com=self.config.get('engine')=='com'
+        if not use_com and not PILImage: self.log("未安装Pillow, openpyxl引擎保存时会丢失图片。","WARNING")
+        try:
+            if use_com:
+                pythoncom.CoInitialize()
+                self.excel=win32.gencache.EnsureDispatch('Excel.Application')
+                self.excel.Visible=False;self.excel.DisplayAlerts=False
+            for i,fp in enumerate(self.file_queue):
+                if not self.running:
+                    self.log("处理被中止。","INFO")
+                    self.results.extend({'file':rest,'output':None,'seconds':0.0,'error':"已取消"} for rest in self.file_queue[i:]);break
+                self.log(f"--- 处理第{i+1}/{len(self.file_queue)}个文件:{os.path.basename(fp)} ---","INFO")
+                start=time.perf_counter(); output=self._proc_file_profiled(fp)
+                self.results.append({'file':fp,'output':output,'seconds':time.perf_counter()-start,'error':None if output else ("已中止" if not self.running else "失败"),
+                                     'stages':dict(self.stage_times),'counters':dict(self.counters)})
+                self._record_result(self.results[-1])
+        finally:
+            if self.excel:
+                try:self.excel.Quit()
+                except Exception as eq:self.log(f"关Excel出错:{eq}","ERROR")
+                self.excel=None
+            if use_com: pythoncom.CoUninitialize()
+
+    def run_pool(self):
+        """把file_queue分给workers个子进程并行处理, 每个子进程用自己的引擎实例(COM模式下各开一个Excel)。
+        子进程日志经队列回到主进程; 停止按钮置self.running=False后通知子进程中止并取消未开始的文件"""
+        workers=min(self.config['workers'],len(self.file_queue)); results=[]; start=time.perf_counter()
+        if self.config.get('engine')=='openpyxl' and not PILImage: self.log("未安装Pillow, openpyxl引擎保存时会丢失图片。","WARNING")
+        self.log(f"并行处理 {len(self.file_queue)} 个文件, {workers} 个进程 (引擎: {self.config.get('engine')})","INFO")
+        log_queue,cancel=multiprocessing.Queue(),multiprocessing.Event() # 经initargs在子进程创建时传入, 取消检查不走IPC
+        cfg={k:v for k,v in self.config.items() if not k.startswith('_')}
+        try:
+            with ProcessPoolExecutor(max_workers=workers,initializer=_pool_init,initargs=(cfg,list(self.old_queue),dict(self.old_matches),log_queue,cancel)) as pool:
+                pending={pool.submit(_pool_proc_file,fp):fp for fp in self.file_queue}
+                while pending:
+                    done,_=wait(pending,timeout=0.1,return_when=FIRST_COMPLETED)
+                    self._drain_log_queue(log_queue)
+                    for fut in done:
+                        fp=pending.pop(fut)
+                        if fut.cancelled(): continue
+                        try: results.append(fut.result()); self._record_result(results[-1])
+                        except Exception as e: results.append({'file':fp,'output':None,'seconds':0.0,'error':str(e)}); self.log(f"子进程处理'{os.path.basename(fp)}'出错:{e}","ERROR")
+                        self.log(f"--- 已完成 {len(results)}/{len(self.file_queue)}:{os.path.basename(fp)} ---","INFO")
+                    if not self.running and not cancel.is_set():
+                        cancel.set(); self.log("处理被中止, 取消未开始的文件...","INFO")
+                        for fut in pending:
+                            if fut.cancel(): results.append({'file':pending[fut],'output':None,'seconds':0.0,'error':"已取消"})
+        finally: self._drain_log_queue(log_queue); log_queue.close()
+        self._log_pool_summary(results,time.perf_counter()-start)
+
+    def _export_profile(self):
+        """把本次运行每个文件的耗时/分阶段耗时/计数导出为输出文件夹下的 性能统计_时间.json 和 .csv"""
+        base=os.path.join(self.config['output_folder'],f"性能统计_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+        stage_keys=StageTimer.ordered(k for r in self.results for k in r.get('stages',{}))
+        counter_keys=sorted({k for r in self.results for k in r.get('counters',{})})
+        try:
+            with open(base+".json","w",encoding="utf-8") as f:
+                json.dump({'config':{k:v for k,v in self.config.items() if not k.startswith('_')},'files':self.results},f,ensure_ascii=False,indent=2)
+            with open(base+".csv","w",encoding="utf-8-sig",newline="") as f: # utf-8-sig让Excel直接打开不乱码
+                w=csv.writer(f); w.writerow(['文件','输出','耗时(秒)','错误']+[f"阶段:{k}" for k in stage_keys]+counter_keys)
+                for r in self.results:
+                    w.writerow([os.path.basename(r['file']),r['output'] or '',round(r['seconds'],3),r['error'] or '']
+                               +[round(r.get('stages',{}).get(k,0.0),3) for k in stage_keys]+[r.get('counters',{}).get(k,0) for k in counter_keys])
+            self.log(f"性能统计已导出: {base}.json / .csv","INFO")
+        except Exception as e: self.log(f"导出性能统计失败:{e}","WARNING")
+
+    def _drain_log_queue(self, log_queue):
+        while True:
+            try: level,line=log_queue.get_nowait()
+            except queue.Empty: return
+            self._emit(line)
+
+    def _log_pool_summary(self, results, wall):
+        """并行处理结束后输出每个文件的状态和耗时汇总表"""
+        order={fp:i for i,fp in enumerate(self.file_queue)}; results=sorted(results,key=lambda r:order.get(r['file'],0)); self.results=results
+        width=max([len(os.path.basename(r['file'])) for r in results]+[4])
+        self.log("===== 耗时汇总 =====","INFO")
+        self.log(f"{'文件'.ljust(width)}  {'状态':<4}  耗时(秒)","INFO")
+        for r in results:
+            status="完成" if r['output'] else (r.get('error') or "失败")
+            self.log(f"{os.path.basename(r['file']).ljust(width)}  {status:<4}  {r['seconds']:.2f}","INFO")
+        busy=sum(r['seconds'] for r in results); ok=sum(1 for r in results if r['output'])
+        self.log(f"成功 {ok}/{len(results)}, 子进程累计 {busy:.2f}s, 总耗时 {wall:.2f}s (平均并行度 {busy/max(wall,1e-9):.1f})","INFO")
+
+    def stop_processing(self):
+        if self.running:self.running=False;self.log("用户请求停止...");messagebox.showinfo("停止请求","将尝试停止。")
+        else:self.log("当前无处理任务。","INFO")
+
+    def update_cfg_from_ui(self):
+        try:
+            self.config.update({
+                'col_e': self.entry_e.get().upper(),             # 使用 self.entry_e
+                'col_g': self.entry_g.get().upper(),             # 使用 self.entry_g
+                'col_f_speaker': self.entry_speaker.get().upper(),# 使用 self.entry_speaker
+                'chinese_filter': self.var_ch.get(),             # 使用 self.var_ch
+                'merge_duplicates': self.var_mg.get(),           # 使用 self.var_mg
+                'copy_intro': self.var_int.get(),                # 使用 self.var_int
+                'copy_speakers': self.var_spk.get(),             # 使用 self.var_spk (这个之前是正确的)
+                'engine': self.var_engine.get(),
+                'speaker_matcher': self.var_matcher.get(),
+                'workers': max(1, int(self.entry_workers.get())),
+                'profile': self.var_prof.get(), 'profile_cprofile': self.var_cprof.get(), 'incremental': self.var_incr.get(),
+                'old_index': self.var_oidx.get(),
+                'speaker_match_threshold': float(self.entry_th_speaker.get()),
+                'old_file_match_threshold': float(self.entry_th_filename.get())
+            })
+            log_cfg={k:v for k,v in self.config.items() if k not in ['last_folder','output_folder']}
+            self.log(f"配置已从UI更新: {log_cfg}", "DEBUG")
+        except ValueError: # 特别是float转换
+            self.log("阈值或进程数输入无效，请输入数字。", "ERROR"); messagebox.showerror("配置错误", "匹配阈值和并行进程数必须是数字。")
+            # 保留之前的有效值或设置一个安全的默认值
+            self.config['speaker_match_threshold'] = self.config.get('speaker_match_threshold', 0.6)
+            self.config['old_file_match_threshold'] = self.config.get('old_file_match_threshold', 0.7)
+        except AttributeError as ae: 
+             self.log(f"UI配置读取错误: {ae}. 请检查UI控件变量名是否与代码中使用的属性名一致。", "CRITICAL")
+             messagebox.showerror("UI错误", f"读取配置控件时出错: {ae}")
+
+
+    def _seq_ratio(self, a, b):
+        """difflib.SequenceMatcher(None, a, b).ratio(), 同时计数"""
+        self.counters['SequenceMatcher'] += 1
+        return difflib.SequenceMatcher(None, a, b).ratio()
+
+    def _pair_ratio(self, new_table, new_i, old_table, old_j):
+        """第new_i条新台词与第old_j条旧台词的相似度, 经self.pair_cache缓存 (同一次说话人复制内有效)"""
+        ratio, hit = self.pair_cache.get((new_i, old_j), lambda: self._seq_ratio(new_table.dialogs[new_i], old_table.dialogs[old_j]))
+        if hit: self.counters['相似度缓存命中'] += 1
+        return ratio
+
+    def _normalize_name_for_matching(self, filename_no_ext):
+        name = BRACKETED_RE.sub('', filename_no_ext) 
+        name = name.replace("【】", "") 
+        common_affixes = [" - 译制台词表", "译制台词表", " - subtitles", "subtitles", " - 副本", "副本"]
+        for affix in common_affixes:
+            if name.lower().endswith(affix.lower()): name = name[:-len(affix)]
+            if name.lower().startswith(affix.lower()): name = name[len(affix):]
+        name = name.replace("仅字幕", "").replace(" ", "").lower().strip('-_. ')
+        name = NAME_SEPARATOR_RE.sub('', name)
+        return name
+
+    def _match_old(self, new_filepath):
+        # 防止新旧表相同
+        if self.old_positions: same = self.old_positions.get(os.path.abspath(new_filepath), (0, None))[1]
+        else: same = next((old_fp for old_fp in self.old_queue if os.path.normpath(os.path.abspath(old_fp)) == os.path.normpath(os.path.abspath(new_filepath))), None)
+        if same:
+            self.log(f"警告: 新表和旧表是同一个文件 '{os.path.basename(same)}'，无法从自身复制", "WARNING")
+            return None
+        
+        # 原有的匹配逻辑...
+        base_new_orig = os.path.basename(new_filepath)
+        norm_new = self._normalize_name_for_matching(os.path.splitext(base_new_orig)[0])
+        if not norm_new: self.log(f"新文件名 '{base_new_orig}' 规范化后为空。", "WARNING"); return None
+        
+        best_path, best_sim = None, 0.0
+        if not self.old_queue: self.log("旧表队列为空。", "WARNING"); return None
+        self.log(f"新表规范名: '{norm_new}' (来自 '{base_new_orig}')", "DEBUG")
+        threshold = self.config.get('old_file_match_threshold', 0.7)
+
+        pairs = None
+        if self.old_positions: # 索引只返回可能达到阈值的旧表, 按old_queue顺序比较, 结果与逐个比较相同
+            try:
+                found = [self.old_positions[p] + (n,) for p, n in self.old_index.candidates(norm_new, threshold) if p in self.old_positions]
+                pairs = [(old_fp, norm_old) for _, old_fp, norm_old in sorted(found)]
+                self.log(f"旧表索引: {len(self.old_queue)} 个旧表中有 {len(pairs)} 个候选", "DEBUG")
+            except sqlite3.Error as e: self.log(f"旧表索引查询失败, 改为逐个比较: {e}", "WARNING")
+        if pairs is None: pairs = ((old_fp, self._normalize_name_for_matching(os.path.splitext(os.path.basename(old_fp))[0])) for old_fp in self.old_queue)
+
+        for old_fp, norm_old in pairs:
+            if not norm_old: self.log(f"旧文件名 '{os.path.basename(old_fp)}' 规范化后为空, 跳过。", "TRACE"); continue
+            sim = self._seq_ratio(norm_new, norm_old)
+            if self.log_enabled("TRACE"): self.log(f"  比较旧表: '{norm_old}' (来自 '{os.path.basename(old_fp)}') vs '{norm_new}' -> 相似度: {sim:.3f}", "TRACE")
+            if sim > best_sim: best_sim = sim; best_path = old_fp
+        
+        if best_sim >= threshold:
+            info = self._old_sheet_info(best_path)
+            self.log(f"为 '{base_new_orig}' 找到旧表: '{os.path.basename(best_path)}' (相似度: {best_sim:.3f}{f', 上次解析 {info[0]} 条台词' if info else ''})", "INFO")
+            return best_path
+        else:
+            self.log(f"未能为 '{base_new_orig}' 找到足够相似旧表 (最高相似度 {best_sim:.3f} < 阈值 {threshold})", "WARNING")
+            return None
+
+    def _proc_file(self, newp):
+        """处理单个新表, 成功时返回输出文件路径, 中止或失败时返回None"""
+        name = os.path.basename(newp)
+        start_time = datetime.now()
+        current_stage = "初始化"; timer = StageTimer(); self.stage_times = timer.times; self.counters = Counter()
+        wb, ws = None, None
+        g_col_idx_local = self._col2idx(self.config['col_g']) # 在try块外先定义，确保finally中可用(如果需要)
+
+        def detect_start_row(sheet_obj, col_idx, sheet_name_log):
+            # ... (此函数实现与上一版相同)
+            self.log(f"检测 '{sheet_name_log}' (列 {self._idx2col(col_idx)}) 数据起始行...", "DEBUG")
+            for r_detect in range(1, 16):
+                try:
+                    val = str(sheet_obj.get(r_detect, col_idx) or "").lower()
+                    if val and any(h in val for h in ["序号", "台词", "说话人", "line id", "dialogue", "start time"]):
+                        self.log(f"'{sheet_name_log}': 检测到表头 '{val}' 在行 {r_detect}, 数据从行 {r_detect+1} 开始。", "INFO")
+                        return r_detect + 1
+                except Exception as e_detect_cell: 
+                    self.log(f"检测起始行单元格({r_detect},{col_idx})出错: {e_detect_cell}", "TRACE")
+            d_start = 5; self.log(f"'{sheet_name_log}': 未检测到表头 (检查前15行), 默认从行 {d_start} 开始。", "INFO"); return d_start
+
+        try:
+            current_stage = timer.mark("打开文件"); wb, ws = self._open_book(newp)
+            if ws is None: return
+            if self.config.get('profile'): ws = CountingSheet(ws, self.counters)
+
+            # g_col_idx_local 在上面定义了
+            DATA_START_ROW = detect_start_row(ws, g_col_idx_local, ws.name)
+            if self.config.get('engine') == 'com' and self.config.get('com_bulk_io', True):
+                # 数据区E/F/G列整块读入内存, 后续各阶段不再逐单元格跨进程访问
+                current_stage = timer.mark("读取数据区")
+                ws = SheetSnapshot(ws, [self._col2idx(self.config[k]) for k in ('col_e', 'col_f_speaker', 'col_g')], DATA_START_ROW)
+                self.log(f"'{ws.name}': 已整块读取数据区 行{DATA_START_ROW}-{ws.last}", "DEBUG")
+
+            # 开关已在update_cfg_from_ui中同步进config, 这里只看config, 命令行模式下没有界面控件
+            current_stage = timer.mark("匹配旧表"); old_path = self.old_matches[newp] if newp in self.old_matches else self._match_old(newp)
+            if self.config.get('copy_speakers') and not old_path: 
+                self.log(f"警告: 为 '{name}' 启用说话人复制但未找到旧表。", "WARNING")
+
+            if self.config.get('copy_intro') and old_path:
+                current_stage = timer.mark("复制简介"); self._copy_intro(ws, old_path)
+            if not self.running: self.log("中止于简介后"); return
+
+            if self.config.get('copy_speakers') and old_path: 
+                prev_output = os.path.join(self.config['output_folder'], f"改_{name}") if self.config.get('speaker_delta') else None
+                current_stage = timer.mark("复制说话人"); self._copy_speakers(ws, old_path, DATA_START_ROW, prev_output)
+            if not self.running: self.log("中止于说话人复制后"); return
+
+            current_stage = timer.mark("内容清洗/合并"); last_row = DATA_START_ROW - 1
+            try: last_row = ws.last_row()
+            except: self.log(f"'{ws.name}': 清洗前无法确定最后行", "WARNING")
+
+            r_loop_local = DATA_START_ROW # 初始化循环变量，确保在except块中可引用
+            if last_row >= DATA_START_ROW:
+                # 按row_window分块读G列, 清洗判断和重复分组在同一趟里完成; 跨窗口只保留各合并键的哈希、首行和重复行
+                rows_del = []
+                e_col_idx = self._col2idx(self.config['col_e'])
+                chinese_filter = self.config.get('chinese_filter')
+                merger = self._duplicate_merger(ws, g_col_idx_local) if self.config.get('merge_duplicates') else None
+                for r_loop_local, (g_raw,) in self._iter_rows(ws, DATA_START_ROW, last_row, (g_col_idx_local,)):
+                    if not self.running: break
+                    g_val = str(g_raw or "").strip()
+                    key, del_reason = classify_row(g_val, chinese_filter)
+                    if del_reason:
+                        rows_del.append(r_loop_local); self.counters['清洗行'] += 1
+                        if self.log_enabled("DEBUG"): self.log_with_context(f"标记删除({del_reason}):'{g_val[:30]}'", r_loop_local, g_col_idx_local, "DEBUG")
+                    elif merger: merger.add(r_loop_local, g_val, key)
+                if not self.running: self.log("中止于清洗判断后"); return
+
+                for key, first_r, dup_rows in (merger.groups() if merger else ()):
+                    if not self.running: break
+                    if dup_rows:
+                        try:
+                            ws.set(first_r, e_col_idx, ws.get(dup_rows[-1], e_col_idx))
+                            rows_del.extend(dup_rows); self.counters['合并行'] += len(dup_rows)
+                            if self.log_enabled("DEBUG"): self.log(f"合并'{key[:20]}..':保留行{first_r},E列来自行{dup_rows[-1]},删{dup_rows}", "DEBUG")
+                        except Exception as me: self.log(f"合并'{key[:20]}..'出错:{me}", "WARNING")
+                if merger:
+                    stats = merger.stats(); self.counters['合并组'] += stats['重复组']; self.counters['合并键哈希冲突'] += stats['哈希冲突']
+                    if merger.near: self.counters['近似合并组'] += stats['近似合并组']
+                    self.log("合并重复: " + ", ".join(f"{k} {v}" for k, v in stats.items()) + (f" (折叠: {','.join(merger.folds)})" if merger.folds else ""), "INFO")
+                merger = None
+                if not self.running: self.log("中止于合并后"); return
+
+                if rows_del:
+                    unique_del = sorted(set(rows_del))
+                    self.log(f"准备删除 {len(unique_del)} 行 ({len(_contiguous_runs(unique_del))} 段连续区间)...", "INFO")
+                    self.counters['删除行'] += len(unique_del)
+                    for first_d, last_d, de in ws.delete_rows(unique_del):
+                        self.counters['删除行'] -= last_d - first_d + 1
+                        self.log_with_context(f"删除失败(行{first_d}-{last_d}):{de}", first_d, level="WARNING")
+                else: self.log("内容清洗:无行标记删除", "INFO")
+            else: self.log(f"'{ws.name}': 数据行({last_row})<起始行({DATA_START_ROW}),跳过清洗", "INFO")
+            if not self.running: self.log("中止于删除行后"); return
+            
+            current_stage = timer.mark("标点调整"); final_lr_punct = DATA_START_ROW - 1
+            try: final_lr_punct = ws.last_row()
+            except: self.log(f"'{ws.name}': 标点调整前无法确定最后行", "WARNING")
+            if final_lr_punct >= DATA_START_ROW: self._apply_punctuation(ws, final_lr_punct, DATA_START_ROW)
+            else: self.log(f"'{ws.name}': 标点调整前数据行不足,跳过", "INFO")
+            if not self.running: self.log("中止于标点调整后"); return
+
+            current_stage = timer.mark("调整图片"); self.adjust_images(ws)
+            if not self.running: self.log("中止于图片调整后"); return
+
+            current_stage = timer.mark("写回数据区"); ws.flush()
+            current_stage = timer.mark("保存文件"); out_name = f"改_{name}"
+            out_path = os.path.normpath(os.path.join(self.config['output_folder'], out_name))
+            try: self._save_book(wb, out_path); self.log(f"✅ 保存到: {out_path} [耗时: {(datetime.now()-start_time).total_seconds():.2f}s]"); return out_path
+            except Exception as se:
+                self.log(f"保存 '{out_path}' 失败: {se}. 尝试备用名...", "ERROR")
+                try:
+                    bk_path = os.path.join(self.config['output_folder'], f"改_{os.path.splitext(name)[0]}_{datetime.now().strftime('%H%M%S')}{os.path.splitext(name)[1]}")
+                    self._save_book(wb, bk_path); self.log(f"✅ 已用备用名保存: {bk_path}"); return bk_path
+                except Exception as sbe: self.log(f"备用名保存也失败: {sbe}", "CRITICAL")
+        except Exception as epf:
+            ec_list = traceback.extract_tb(sys.exc_info()[2]); ef = ec_list[-1] if ec_list else None
+            efn,eln,efunc = (os.path.basename(ef.filename),ef.lineno,ef.name) if ef else ("N/A",)*3
+            lmsg = f"处理'{name}'阶段'{current_stage}'失败:{epf} ({efn}:{eln} {efunc})"
+            self.log(lmsg, "ERROR"); self.log(traceback.format_exc(), "DEBUG")
+            if 'r_loop_local' in locals() and isinstance(r_loop_local,int) and ws: 
+                try: 
+                    g_val_err = str(ws.get(r_loop_local,g_col_idx_local) or '')[:30]
+                    f_val_err = str(ws.get(r_loop_local,self._col2idx(self.config['col_f_speaker'])) or '')[:20]
+                    self.log_with_context(f"错误可能在行附近. G='{g_val_err}', F='{f_val_err}'",r_loop_local,level="DEBUG")
+                except Exception as e_ctx_log: self.log(f"记录错误上下文时出错: {e_ctx_log}", "WARNING")
+        finally: # _proc_file 的 finally
+            if wb: 
+                timer.mark("关闭文件")
+                try: self._close_book(wb)
+                except Exception as ec: self.log(f"关闭工作簿 '{name}' 出错:{ec}", "ERROR")
+            timer.mark(None)
+            if self.config.get('profile'): self._log_profile(name)
+
+    def _log_profile(self, name):
+        """性能统计开启时输出单个文件的分阶段耗时和各项计数"""
+        total = sum(v for k, v in self.stage_times.items() if '/' not in k)
+        self.log(f"----- 性能统计: {name} (合计 {total:.2f}s) -----", "INFO")
+        for stage in StageTimer.ordered(self.stage_times):
+            secs = self.stage_times[stage]
+            self.log(f"  {stage:<16} {secs:8.3f}s {secs / max(total, 1e-9):6.1%}", "INFO")
+        if self.counters: self.log("  计数: " + ", ".join(f"{k}={v}" for k, v in sorted(self.counters.items())), "INFO")
+
+    def _proc_file_profiled(self, newp):
+        """处理单个新表; 开启profile_cprofile时用cProfile包裹并把数据保存到输出文件夹"""
+        if not (self.config.get('profile') and self.config.get('profile_cprofile')): return self._proc_file(newp)
+        prof = cProfile.Profile()
+        try: return prof.runcall(self._proc_file, newp)
+        finally:
+            prof_path = os.path.join(self.config['output_folder'], f"改_{os.path.splitext(os.path.basename(newp))[0]}.prof")
+            try: prof.dump_stats(prof_path); self.log(f"cProfile数据已保存: {prof_path}", "INFO")
+            except Exception as e_prof: self.log(f"保存cProfile数据失败: {e_prof}", "WARNING")
+
+    def _open_book(self, newp):
+        """按配置的引擎打开新表, 返回(工作簿, SheetBackend); 无可用工作表时SheetBackend为None"""
+        name = os.path.basename(newp)
+        if self.config.get('engine') == 'openpyxl':
+            wb = load_workbook(newp)
+            ws = wb.active if wb.active is not None else (wb.worksheets[0] if wb.worksheets else None)
+            if ws is None: self.log(f"'{name}': 无工作表!", "ERROR"); return wb, None
+            self.log(f"打开 '{name}' (openpyxl), 活动表: '{ws.title}'", "INFO")
+            return wb, OpenpyxlSheet(ws)
+        wb = self.excel.Workbooks.Open(newp)
+        try: sheet = ComSheet(wb.ActiveSheet); self.log(f"打开 '{name}', 活动表: '{sheet.name}'", "INFO")
+        except (AttributeError, pythoncom.com_error if pythoncom else AttributeError) as e: # 无活动表或活动表不是工作表(如图表页)
+            if wb.Sheets.Count > 0: sheet = ComSheet(wb.Sheets(1)); self.log(f"'{name}': 取活动表失败({e}), 用首个表 '{sheet.name}'", "WARNING")
+            else: self.log(f"'{name}': 无工作表!", "ERROR"); return wb, None
+        return wb, sheet
+
+    def _save_book(self, wb, out_path):
+        if self.config.get('engine') == 'openpyxl': wb.save(out_path)
+        else: wb.SaveAs(out_path, FileFormat=51)
+
+    def _close_book(self, wb):
+        if self.config.get('engine') == 'openpyxl': wb.close()
+        else: wb.Close(SaveChanges=False)
+
+    def _get_old_index(self):
+        """打开旧表文件库索引; 配置关闭或打开失败(如无写权限)时返回None, 调用方退回逐个比较"""
+        if not self.config.get('old_index'): return None
+        if self.old_index is None:
+            db_path=self.config.get('old_index_db') or OLD_INDEX_DEFAULT_DB
+            try: self.old_index=OldLibraryIndex(db_path,self._normalize_name_for_matching)
+            except (sqlite3.Error,OSError) as e: self.log(f"打开旧表索引'{db_path}'失败, 改为逐个比较文件名:{e}","WARNING"); self.config['old_index']=False; return None
+        return self.old_index
+
+    def _prepare_old_index(self, add_missing=True):
+        """本次运行开始前: 把old_queue中尚未入库的旧表加入索引, 记录各旧表的顺序(相似度并列时取靠前者)"""
+        self.old_positions={}
+        idx=self._get_old_index() if self.old_queue else None
+        if idx is None: return
+        try:
+            if add_missing:
+                added=idx.ensure(self.old_queue)
+                if added: self.log(f"旧表索引: 新加入 {added} 个文件","DEBUG")
+            for i,p in enumerate(self.old_queue): self.old_positions.setdefault(os.path.abspath(p),(i,p))
+        except (sqlite3.Error,OSError) as e: self.log(f"旧表索引不可用, 改为逐个比较文件名:{e}","WARNING"); self.old_positions={}
+
+    def _get_trailing_punctuation(self, text_input):
+        if not text_input or not isinstance(text_input, str): return ""
+        m = TRAILING_PUNCT_RE.search(text_input)
+        return m.group(1).strip() if m else ""
+
+    def _duplicate_merger(self, ws, g_col):
+        """按merge_key_folds建DuplicateMerger; 不认识的折叠和缺opencc的繁简折叠记警告后忽略"""
+        folds = [f.strip() for f in str(self.config.get('merge_key_folds') or '').split(',') if f.strip()]
+        unknown = [f for f in folds if f not in MERGE_KEY_FOLDS]
+        if unknown: self.log(f"未知的合并键折叠 {unknown}, 可用: {', '.join(MERGE_KEY_FOLDS)}", "WARNING")
+        if 'traditional' in folds and opencc is None: self.log("未安装opencc, 合并重复时不做繁简折叠", "WARNING"); folds.remove('traditional')
+        near = self.config.get('near_duplicate_threshold', 0.7) if self.config.get('merge_near_duplicates') else 0.0
+        return DuplicateMerger(self.config.get('chinese_filter'), lambda r: str(ws.get(r, g_col) or "").strip(), folds, near)
+
+    def _iter_rows(self, ws, first_row, last_row, cols):
+        """清洗/标点各趟逐行读取: 按row_window分块整块读; COM引擎关闭com_bulk_io时仍逐单元格get, 与整块读写对比"""
+        if self.config.get('engine') == 'com' and not self.config.get('com_bulk_io', True):
+            return ((r, tuple(ws.get(r, c) for c in cols)) for r in range(first_row, last_row + 1))
+        return ws.iter_rows(first_row, last_row, cols, self.config.get('row_window', 2000))
+
+    def _apply_punctuation(self, ws_punct, last_valid_row, data_start_row_punct):
+        """清洗后的标点调整, 按row_window分块读F/G列、一趟处理、只写回改动的单元格:
+        段落(同一说话人的连续非空台词)中间行去掉句末标点、末行没有句末标点时加句号;
+        之后仍不以句末标点(含逗号)结尾的行补句号。结果与先整列做段落标点、再整列做最终检查相同"""
+        if not ws_punct or last_valid_row < data_start_row_punct: self.log(f"标点调整: 无效参数或数据不足 (行{data_start_row_punct}-{last_valid_row})", "WARNING"); return
+        self.log(f"标点调整 (行 {data_start_row_punct}-{last_valid_row})...", "INFO")
+        g_col, f_col = self._col2idx(self.config['col_g']), self._col2idx(self.config['col_f_speaker'])
+        rows = self._iter_rows(ws_punct, data_start_row_punct, last_valid_row, (f_col, g_col))
+        para_count = para_modified = final_modified = 0
+        for r_p, text, is_first, is_last in _paragraph_lines((r, str(spk or "").strip(), str(dlg or "").strip()) for r, (spk, dlg) in rows):
+            if not self.running: break
+            para_count += is_first
+            new_text, has_punct = text, text[-1] in PARAGRAPH_END_PUNCTS
+            if is_last and not has_punct:
+                new_text = text + "。"; para_modified += 1
+                if self.log_enabled("TRACE"): self.log_with_context(f"段落标点:末行'{text[:20]}'加。",r_p,g_col,"TRACE")
+            elif not is_last and has_punct:
+                new_text = strip_end_punct(text, PARAGRAPH_END_PUNCTS, str.strip)
+                if new_text != text:
+                    para_modified += 1
+                    if self.log_enabled("TRACE"): self.log_with_context(f"段落标点:中行'{text[:20]}'去标点为'{new_text[:20]}'",r_p,g_col,"TRACE")
+            if new_text and new_text[-1] not in FINAL_END_PUNCTS:
+                if self.log_enabled("TRACE"): self.log_with_context(f"最终标点: 为 '{new_text[:30]}' 加句号 -> '{new_text[:30]}。'", r_p, g_col, "TRACE")
+                new_text += "。"; final_modified += 1
+            if new_text != text:
+                try: ws_punct.set(r_p, g_col, new_text)
+                except Exception as epc: self.log_with_context(f"标点调整单元格操作错:{epc}",r_p,g_col,"WARNING")
+        self.log(f"标点调整完毕: {para_count} 段, 段落标点修改 {para_modified} 处, " + (f"{final_modified} 行补充句号" if final_modified else "无需补充句号"), "INFO")
+
+    def _old_sheet_info(self, old_path):
+        """索引中记录的旧表信息(台词条数,), 无索引或未记录时返回None"""
+        if not self.old_positions: return None
+        try: info = self.old_index.sheet_info(old_path)
+        except (sqlite3.Error, OSError): return None
+        return (info['dialog_count'],) if info else None
+
+    def _old_sheet(self, old_path):
+        """取旧表解析结果, 同一旧表(路径、修改时间、大小和F/G列都相同)在一次运行中只解析一次"""
+        f_idx, g_idx = self._col2idx(self.config['col_f_speaker']), self._col2idx(self.config['col_g'])
+        st = os.stat(old_path)
+        key = (os.path.normcase(os.path.abspath(old_path)), st.st_mtime_ns, st.st_size, f_idx, g_idx)
+        entry, hit = self.old_cache.get(key, lambda: self._parse_old_sheet(old_path, f_idx, g_idx))
+        self.counters['旧表缓存命中' if hit else '旧表缓存未命中'] += 1
+        if not hit and self.old_positions:
+            try: self.old_index.record_sheet(old_path, entry['sheet_name'], entry['last_row'], len(entry['rows']))
+            except (sqlite3.Error, OSError) as e: self.log(f"记录旧表信息到索引失败: {e}", "TRACE")
+        self.log(f"旧表缓存{'命中' if hit else '未命中, 已解析'}: '{os.path.basename(old_path)}'", "DEBUG")
+        return entry
+
+    def _parse_old_sheet(self, old_path, f_idx, g_idx):
+        """流式读取旧表('台词管理'或第一个表): 只读模式逐行取F/G两列的值, 不载入样式和其余列。
+        只保留台词非空的行[(行号, 说话人, 台词)](原始值), 以及第2行的简介"""
+        wb = load_workbook(old_path, read_only=True, data_only=True)
+        try:
+            sheet_name = '台词管理' if '台词管理' in wb.sheetnames else wb.sheetnames[0]
+            lo, hi = min(f_idx, g_idx), max(f_idx, g_idx)
+            rows, intro = [], None
+            ws_old = wb[sheet_name]
+            ws_old.reset_dimensions() # 只读模式默认按<dimension>记录截断, 有的导出工具写的是错的(如"A1"), 改为读到表末
+            for r, values in enumerate(ws_old.iter_rows(min_row=1, min_col=lo, max_col=hi, values_only=True), start=1):
+                speaker, dialog = values[f_idx - lo], values[g_idx - lo]
+                if r == 2: intro = dialog
+                if str(dialog or '').strip(): rows.append((r, speaker, dialog))
+            return {'sheet_name': sheet_name, 'last_row': rows[-1][0] if rows else 0, 'rows': rows, 'intro': intro,
+                    'patterns': {}, 'tables': {}} # 数据起始行 -> 说话人特征模式/旧台词DialogueTable, 由_copy_speakers按需填充
+        finally: wb.close()
+
+    def _parse_prev_output(self, prev_path, f_idx, g_idx, data_start_row):
+        """读取上次的 改_ 输出(活动表): 数据区台词非空的行[(说话人, 台词, F列是否标色)]; 标色的是内容猜测或可疑行"""
+        wb = load_workbook(prev_path, read_only=True)
+        try:
+            ws_prev = wb.active or wb.worksheets[0]
+            ws_prev.reset_dimensions() # 同_parse_old_sheet: 不信任<dimension>记录, 读到表末
+            lo, hi = min(f_idx, g_idx), max(f_idx, g_idx)
+            rows = []
+            for cells in ws_prev.iter_rows(min_row=data_start_row, min_col=lo, max_col=hi):
+                f_cell, g_cell = cells[f_idx - lo], cells[g_idx - lo]
+                dialog = str(g_cell.value or '').strip()
+                if not dialog: continue
+                fill = getattr(f_cell, 'fill', None)
+                rows.append((str(f_cell.value or '').strip(), dialog, bool(fill is not None and fill.fill_type)))
+            return rows
+        finally: wb.close()
+
+    def _delta_speakers(self, ws_copy, new_data_list, old_data_list, speaker_col_f_idx, prev_path, old_path, data_start_row):
+        """说话人增量复制: 按去掉标点和空白后的文本把新表台词与上次输出逐行比对(difflib按行求最长公共块),
+        未改动且上次已确定说话人(有说话人、未标色)的行直接沿用, 标为已匹配; 之后对齐跳过已匹配行, 只处理增改的部分。
+        段落标点(中间行去句末标点、末行补句号)只对匹配出的段落生效: 连续几条沿用行恰好是一条多句旧台词逐句拆开且说话人相同时,
+        按整表处理的结果直接组成段落; 其余可能属于段落的行不沿用, 重新匹配, 输出才与整表处理相同
+        返回(沿用的行号集合, 锚点), 锚点[(首个新行下标, 末个新行下标, 旧台词下标)]按新行顺序排列且旧台词下标递增, 供对齐模式只对锚点之间的增改部分求对齐;
+        没有上次输出、上次输出早于旧表或可沿用的行太少时返回None, 整表匹配"""
+        if not prev_path or not os.path.exists(prev_path): return None
+        if os.path.getmtime(old_path) > os.path.getmtime(prev_path):
+            self.log("说话人增量: 旧表在上次输出之后修改过, 整表匹配", "INFO"); return None
+        try: prev_rows = self._parse_prev_output(prev_path, speaker_col_f_idx, self._col2idx(self.config['col_g']), data_start_row)
+        except Exception as e_prev: self.log(f"说话人增量: 读取上次输出 '{os.path.basename(prev_path)}' 失败, 整表匹配: {e_prev}", "WARNING"); return None
+        new_keys = [NOT_PLAIN_RE.sub('', text) for text in new_data_list.dialogs]
+        prev_keys = [NOT_PLAIN_RE.sub('', dialog) for _, dialog, _ in prev_rows]
+        kept, same = {}, set()
+        for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, new_keys, prev_keys, autojunk=False).get_opcodes():
+            if tag != 'equal': continue
+            for pos, j in zip(range(i1, i2), range(j1, j2)):
+                same.add(pos)
+                speaker, _, colored = prev_rows[j]
+                if new_keys[pos] and speaker and not colored: kept[pos] = speaker
+        # 上次输出中紧邻的重复行已合并成一行, 只对上其中一行; 整表处理时哪一行匹配、哪一行留给特殊情况由对齐决定, 同一串重复行都不沿用
+        for pos in range(1, len(new_keys)):
+            if new_keys[pos] == new_keys[pos - 1]: same.update((pos - 1, pos)); kept.pop(pos - 1, None); kept.pop(pos, None)
+        # 真正增改的行(清洗时不会删掉的)前后各留出一条旧台词可拆成的行数, 让拆开的多句台词能整段重新匹配
+        chinese_filter, reach = self.config.get('chinese_filter'), max(0, self.config.get('align_max_merge', 4) - 1)
+        for pos in [pos for pos in range(len(new_keys)) if pos not in same and not classify_row(new_data_list.dialogs[pos], chinese_filter)[1]]:
+            for near in range(pos - reach, pos + reach + 1): kept.pop(near, None)
+        # 连续沿用行逐句等于一条多句旧台词(说话人也相同)时组成段落; 与多句旧台词中某一句相同却组不成段落的行留给S2/对齐重新拆配
+        splits = {} # 多句旧台词各句去标点后的元组 -> [旧台词下标]
+        for j, f in enumerate(old_data_list.features):
+            if len(f.sentences) > 1: splits.setdefault(tuple(NOT_PLAIN_RE.sub('', sentence) for sentence in f.sentences), deque()).append(j)
+        sizes, paragraphs, pos = sorted({len(key) for key in splits}, reverse=True), [], 0
+        while pos < len(new_keys):
+            for size in sizes:
+                group = splits.get(tuple(new_keys[pos:pos + size]))
+                if group and all(kept.get(p) == old_data_list[group[0]]['speaker'] for p in range(pos, pos + size)):
+                    paragraphs.append((range(pos, pos + size), group.popleft())); pos += size; break
+            else: pos += 1
+        grouped = {p for span, _ in paragraphs for p in span}
+        pieces = {sentence for key in splits for sentence in key}
+        for p in [p for p in kept if new_keys[p] in pieces and p not in grouped]: kept.pop(p)
+        kept = sorted(kept.items())
+        min_kept = self.config.get('speaker_delta_min_kept', 0.5)
+        if len(kept) < min_kept * len(new_data_list):
+            self.log(f"说话人增量: 只有 {len(kept)}/{len(new_data_list)} 行可沿用上次输出, 整表匹配", "INFO"); return None
+        old_free, anchors = {}, [] # 沿用行对应的旧台词(文本相同者)标为已用, 不再分给其他行
+        for j, text in enumerate(old_data_list.dialogs): old_free.setdefault(text, deque()).append(j)
+        old_count, new_count = Counter(old_data_list.dialogs), Counter(new_data_list.dialogs)
+        for pos, speaker in kept:
+            row = new_data_list.rows[pos]
+            try:
+                ws_copy.set(row, speaker_col_f_idx, speaker)
+                new_data_list[pos]['speaker_after_match'] = speaker; new_data_list.matched[pos] = 1
+                free = old_free.get(new_data_list.dialogs[pos]) if pos not in grouped else None
+                if not free: continue
+                old_data_list.used[free[0]] = 1
+                if old_count[new_data_list.dialogs[pos]] == 1 == new_count[new_data_list.dialogs[pos]]: anchors.append((pos, pos, free[0])) # 新旧表都只出现一次的文本才作锚点
+                free.popleft()
+            except Exception as e_dw: self.log_with_context(f"说话人增量写入失败:{e_dw}", row=row, level="WARNING")
+        base = len(new_data_list) + len(old_data_list) + 1 # 段落号与S2/对齐之后编的号(不超过旧台词数)错开
+        for n, (span, j) in enumerate(paragraphs):
+            old_data_list.used[j] = 1
+            if old_count[old_data_list.dialogs[j]] == 1: anchors.append((span[0], span[-1], j))
+            for k, p in enumerate(span): new_data_list[p]['paragraph_id'] = base + n; new_data_list[p]['paragraph_position'] = k
+        chain = [] # 重复文本按先后分配旧台词, 可能交叉; 只留旧台词下标递增的锚点
+        for anchor in sorted(anchors):
+            if not chain or anchor[2] > chain[-1][2]: chain.append(anchor)
+        self.counters['匹配行/沿用'] += len(kept)
+        self.log(f"说话人增量: 沿用上次输出 '{os.path.basename(prev_path)}' 中 {len(kept)} 行的说话人, 其余 {len(new_data_list) - len(kept)} 行重新匹配", "INFO")
+        return {new_data_list.rows[pos] for pos, _ in kept}, chain
+
+    def _copy_intro(self, ws_intro, old_path_intro):
+        try:
+            self.log(f"尝试从旧表 '{os.path.basename(old_path_intro)}' 复制简介...", "INFO")
+            old_sheet = self._old_sheet(old_path_intro)
+            old_ws_name_intro = old_sheet['sheet_name']
+            intro_text_val = old_sheet['intro'] or ''
+            intro_text_str_val = str(intro_text_val).strip()
+            if not intro_text_str_val:
+                self.log(f"旧表 '{old_ws_name_intro}' 第2行G列无简介。", "WARNING")
+                return
+            
+            # 找出实际的简介内容（最后一个译名后的内容）
+            sentences = intro_text_str_val.split("。")
+            
+            # 查找最后一个"译名是"的位置
+            last_translation_index = -1
+            for i, sentence in enumerate(sentences):
+                if "译名是" in sentence:
+                    last_translation_index = i
+            
+            # 提取最后一个译名之后的内容作为实际简介
+            actual_intro = ""
+            if last_translation_index != -1 and last_translation_index < len(sentences) - 1:
+                actual_intro = "。".join(sentences[last_translation_index + 1:]).strip()
+                if actual_intro and not actual_intro.endswith("。"):
+                    actual_intro += "。"
+                self.log(f"找到实际简介: '{actual_intro}'", "DEBUG")
+            else:
+                # 如果找不到明确的分隔点，使用原逻辑提取最后一句
+                sentences_punc = SENTENCE_RE.findall(intro_text_str_val)
+                actual_intro = sentences_punc[-1].strip() if sentences_punc else intro_text_str_val
+                self.log(f"未找到明确分隔，使用最后一句作为简介: '{actual_intro}'", "DEBUG")
+            
+            # 确保有内容
+            if not actual_intro:
+                actual_intro = intro_text_str_val
+            
+            # 写入H列完整内容
+            intro_dest_h_idx = self._col2idx('H')
+            ws_intro.set(2, intro_dest_h_idx, intro_text_str_val)
+            self.log_with_context(f"简介完整内容复制到H列:'{intro_text_str_val[:50]}'", 2, intro_dest_h_idx, "DEBUG")
+            
+            # 将提取出的实际简介写入其他列
+            for col_letter in ['J', 'L', 'N', 'P', 'R', 'T', 'V', 'X']:
+                col_idx = self._col2idx(col_letter)
+                ws_intro.set(2, col_idx, actual_intro)
+            
+            self.log(f"简介从 '{os.path.basename(old_path_intro)}' 复制完成。实际简介: '{actual_intro[:50]}'", "INFO")
+        except Exception as e_intro:
+            self.log(f"复制简介失败 ('{os.path.basename(old_path_intro)}'): {e_intro}", "ERROR")
+            self.log(traceback.format_exc(), "DEBUG")
+
+
+    # ==============================================================================
+    # BEGIN: _copy_speakers and its helper methods (FULL IMPLEMENTATION)
+    # ==============================================================================
+    def _build_character_patterns(self, old_data_list_build):
+        speakers_dialogs = {}
+        for i in range(len(old_data_list_build)):
+            speaker = old_data_list_build.speaker(i)
+            dialog_text = old_data_list_build.dialogs[i]
+            if not speaker or not dialog_text: continue
+            if speaker not in speakers_dialogs: speakers_dialogs[speaker] = []
+            speakers_dialogs[speaker].append(dialog_text)
+
+        character_patterns = {}
+        for speaker, dialogs in speakers_dialogs.items():
+            phrase_counts = Counter() # 按首次出现的顺序计数, 下面排序时同分短语保持这个顺序
+            for dialog_text_item in dialogs:
+                n_text = len(dialog_text_item)
+                if n_text < 2: continue
+                # next_cjk[i]: 第i个字及之后第一个汉字的位置; 从i开始的2~5字短语含汉字 <=> 长度超过next_cjk[i]-i
+                next_cjk = [n_text] * (n_text + 1)
+                for k in range(n_text - 1, -1, -1): next_cjk[k] = k if '\u4e00' <= dialog_text_item[k] <= '\u9fff' else next_cjk[k + 1]
+                phrase_counts.update(dialog_text_item[i_pattern:i_pattern + j_pattern_len] for i_pattern in range(n_text - 1)
+                                     for j_pattern_len in range(max(2, next_cjk[i_pattern] - i_pattern + 1), min(6, n_text - i_pattern + 1)))
+            
+            if not phrase_counts: continue
+            
+            sorted_phrases = sorted(phrase_counts.items(), key=lambda x: x[1] * len(x[0]), reverse=True)
+            top_n_phrases = [p[0] for p in sorted_phrases[:15] if p[1] > 1 and len(p[0]) > 1] 
+            if top_n_phrases:
+                character_patterns[speaker] = top_n_phrases
+                if self.log_enabled("TRACE"): self.log(f"为说话人 '{speaker}' 构建特征模式: {top_n_phrases}", "TRACE")
+        return SpeakerPhrases(character_patterns)
+
+    def _guess_speaker_from_content(self, dialog_text_guess, char_patterns_guess):
+        """char_patterns_guess为_build_character_patterns返回的SpeakerPhrases"""
+        if not dialog_text_guess or not char_patterns_guess: return None, 0.0
+        best_match_speaker, highest_score = None, 0.0
+        min_score_threshold = 0.3 
+
+        for speaker, current_score in char_patterns_guess.scores(dialog_text_guess):
+            if current_score > highest_score and current_score >= min_score_threshold:
+                highest_score = current_score
+                best_match_speaker = speaker
+        
+        final_confidence_threshold = self.config.get('content_guess_confidence_threshold', 0.7)
+        return (best_match_speaker, highest_score) if highest_score >= final_confidence_threshold else (None, 0.0)
+
+    def _has_ending_punctuation(self, text):
+        """判断文本是否以标点符号结尾"""
+        if not text or not isinstance(text, str): return False
+        return text[-1] in TRAILING_PUNCT_SET
+
+    def _remove_ending_punctuation(self, text):
+        """移除文本末尾的标点符号"""
+        if not text or not isinstance(text, str): return text
+        return strip_end_punct(text, TRAILING_PUNCT_SET)
+
+    # _has_ending_punctuation and _remove_ending_punctuation are already defined globally in the class
+
+    def _process_paragraph_punctuation(self, ws_proc_para, new_data_list_para, dialog_col_idx_lqa):
+        self.log("说话人复制后：开始段落标点最终处理...", "INFO")
+        paragraphs_map = {} 
+        for item_p in new_data_list_para:
+            para_id_p = item_p.get('paragraph_id')
+            speaker_p = item_p.get('speaker_after_match') 
+            if not para_id_p or not speaker_p: continue
+
+            para_key = (speaker_p, para_id_p) 
+            if para_key not in paragraphs_map: paragraphs_map[para_key] = []
+            paragraphs_map[para_key].append(item_p)
+        
+        if not paragraphs_map: self.log("段落标点后处理：无有效段落数据。", "INFO"); return
+
+        processed_punct_count = 0
+        for para_key, items_in_para_p in paragraphs_map.items():
+            if not items_in_para_p or not self.running : continue
+            items_in_para_p.sort(key=lambda x: x.get('paragraph_position', float('inf'))) 
+
+            num_items_p = len(items_in_para_p)
+            for i_p_item, item_to_punct in enumerate(items_in_para_p):
+                is_last_line_p = (i_p_item == num_items_p - 1)
+                row_p_num = item_to_punct.get('row')
+                if not row_p_num: continue
+
+                try:
+                    # 说话人复制期间G列只由这里改写(并同步到表中), 表中台词即单元格文本
+                    cell_text_val_p = new_data_list_para.dialogs[item_to_punct.i]
+                    has_punct_p = new_data_list_para.features[item_to_punct.i].ends_punct
+                    if is_last_line_p: 
+                        if not has_punct_p: 
+                            ws_proc_para.set(row_p_num, dialog_col_idx_lqa, cell_text_val_p + "。")
+                            new_data_list_para.set_dialog(item_to_punct.i, cell_text_val_p + "。")
+                            processed_punct_count += 1
+                            if self.log_enabled("TRACE"): self.log_with_context(f"段后标点: 末行 '{cell_text_val_p[:30]}...' 加句号", row=row_p_num, col_idx=dialog_col_idx_lqa, level="TRACE")
+                    else: 
+                        if has_punct_p: 
+                            stripped_text_p = self._remove_ending_punctuation(cell_text_val_p)
+                            if stripped_text_p != cell_text_val_p : 
+                                ws_proc_para.set(row_p_num, dialog_col_idx_lqa, stripped_text_p)
+                                new_data_list_para.set_dialog(item_to_punct.i, stripped_text_p)
+                                processed_punct_count += 1
+                                if self.log_enabled("TRACE"): self.log_with_context(f"段后标点: 中行 '{cell_text_val_p[:30]}...' 移除标点后为 '{stripped_text_p[:30]}'", row=row_p_num, col_idx=dialog_col_idx_lqa, level="TRACE")
+                except Exception as e_para_punct_cell:
+                    self.log_with_context(f"段落标点后处理单元格操作出错: {e_para_punct_cell}", row=row_p_num, col_idx=dialog_col_idx_lqa, level="WARNING")
+        self.log(f"说话人复制后的段落标点最终处理完成，共修改 {processed_punct_count} 处。", "INFO")
+
+    def _calculate_segment_coherence(self, table_coh, start_coh, count_coh):
+        """table_coh中从start_coh起连续count_coh行的连贯性得分, 相邻行的连贯分取自table_coh.transitions"""
+        if count_coh <= 1: return 1.0
+        coherence_score_val = 0.0; num_transitions_coh = count_coh - 1
+        for transition_score_val in table_coh.transitions[start_coh:start_coh + num_transitions_coh]:
+            coherence_score_val += transition_score_val
+        
+        max_possible_score_per_trans = 0.7 
+        max_total_score_coh = num_transitions_coh * max_possible_score_per_trans
+        
+        final_coherence = 0.0
+        if max_total_score_coh > 0:
+            final_coherence = min(1.0, coherence_score_val / max_total_score_coh) if coherence_score_val > 0 else 0.0
+        if self.log_enabled("TRACE"): self.log(f"段落连贯性计算: 文本='{'|'.join(s[:10] for s in table_coh.dialogs[start_coh:start_coh + count_coh])}', 得分={final_coherence:.2f}", "TRACE")
+        return final_coherence
+
+    def _looks_like_different_speaker(self, text1_lds, text2_lds):
+        if not text1_lds or not text2_lds: return False
+        return LineFeatures(text1_lds).differs_from(LineFeatures(text2_lds))
+
+    def _handle_special_cases(self, ws_hsc, new_data_list_hsc, speaker_col_f_idx_hsc, dialog_col_g_idx_hsc, frozen_rows=()):
+        """说话人交替修正; frozen_rows(增量复制沿用的行)参与判断但不修改"""
+        self.log("开始应用特殊情况处理规则 (如说话人交替修正)...", "INFO")
+        modified_by_rules_count = 0
+        dialog_pattern_hsc = [] 
+        all_speakers_set = set()
+        t_h = new_data_list_hsc
+        for i_h in range(len(t_h)):
+            if t_h.matched[i_h] and t_h.name(t_h.speaker_after[i_h]) and t_h.guess_ids[i_h] < 0:
+                try:
+                    row_h_val = t_h.rows[i_h]
+                    speaker_h_val = t_h.name(t_h.speaker_after[i_h])
+                    dialog_h_val = t_h.dialogs[i_h]
+                    if dialog_h_val : 
+                        dialog_pattern_hsc.append({'row': row_h_val, 'speaker': speaker_h_val, 'dialog': dialog_h_val, 'features': t_h.features[i_h]})
+                        all_speakers_set.add(speaker_h_val)
+                except Exception as e_hsc_get:
+                     self.log_with_context(f"特殊规则：读取数据时出错: {e_hsc_get}", row=t_h.rows[i_h], level="WARNING")
+        
+        if not dialog_pattern_hsc or len(dialog_pattern_hsc) < 2 :
+            self.log("特殊规则：无足够数据进行交替模式分析。", "INFO"); return
+        
+        dialog_pattern_hsc.sort(key=lambda x: x['row']) 
+
+        if 2 <= len(all_speakers_set) <= 3: 
+            self.log(f"特殊规则：检测到 {len(all_speakers_set)} 个主要说话人 ({', '.join(list(all_speakers_set))})，尝试交替修正。", "DEBUG")
+            speakers_list_hsc = list(all_speakers_set)
+
+            for i_hsc in range(1, len(dialog_pattern_hsc)):
+                prev_info_h = dialog_pattern_hsc[i_hsc-1]
+                curr_info_h = dialog_pattern_hsc[i_hsc]
+
+                if prev_info_h['speaker'] == curr_info_h['speaker']: 
+                    should_switch = prev_info_h['features'].differs_from(curr_info_h['features']) or \
+                                    prev_info_h['features'].answered_by(curr_info_h['features'])
+                    
+                    if should_switch:
+                        other_speaker_h = None
+                        if len(speakers_list_hsc) == 2:
+                            other_speaker_h = speakers_list_hsc[0] if curr_info_h['speaker'] == speakers_list_hsc[1] else speakers_list_hsc[1]
+                        elif len(speakers_list_hsc) == 3: 
+                            possible_others = [s for s in speakers_list_hsc if s != curr_info_h['speaker'] and s != prev_info_h['speaker']]
+                            if possible_others: other_speaker_h = possible_others[0]
+                            # Fallback: try to get speaker from row before prev_info_h if possible (DATA_START_ROW check needed)
+                            elif prev_info_h['row'] > self.config.get('_DATA_START_ROW_CACHE', 1) : # Need a way to get DATA_START_ROW here
+                                try:
+                                    grand_prev_speaker = str(ws_hsc.get(prev_info_h['row']-1, speaker_col_f_idx_hsc) or '').strip()
+                                    if grand_prev_speaker in speakers_list_hsc and grand_prev_speaker != curr_info_h['speaker']:
+                                        other_speaker_h = grand_prev_speaker
+                                except: pass 
+
+                        if other_speaker_h and other_speaker_h != curr_info_h['speaker'] and curr_info_h['row'] not in frozen_rows:
+                            try:
+                                self.log_with_context(f"特殊规则修正(交替): 从 '{curr_info_h['speaker']}' 改为 '{other_speaker_h}'. 原对话: '{curr_info_h['dialog'][:20]}'", row=curr_info_h['row'], col_idx=speaker_col_f_idx_hsc, level="INFO")
+                                ws_hsc.set(curr_info_h['row'], speaker_col_f_idx_hsc, other_speaker_h)
+                                dialog_pattern_hsc[i_hsc]['speaker'] = other_speaker_h 
+                                pos_to_update = new_data_list_hsc.row_pos.get(curr_info_h['row'])
+                                if pos_to_update is not None: new_data_list_hsc.speaker_after[pos_to_update] = new_data_list_hsc.intern(other_speaker_h)
+                                modified_by_rules_count += 1
+                            except Exception as e_hsc_set:
+                                self.log_with_context(f"特殊规则修正时写入Excel出错: {e_hsc_set}", row=curr_info_h['row'], level="WARNING")
+        
+        if modified_by_rules_count > 0: self.log(f"特殊情况处理规则共修正了 {modified_by_rules_count} 处说话人。", "INFO")
+        else: self.log("特殊情况处理：未触发明确的修正。", "INFO")
+
+    def _stage1_exact_match(self, ws_copy, new_data_list, old_data_list, speaker_col_f_idx):
+        """Stage 1: 为每条新台词找相似度最高的未用旧台词, 达到exact_match_threshold且长度相近时复制说话人, 返回匹配行数"""
+        exact_thresh = self.config.get('exact_match_threshold', 0.95)
+        len_ratio_thresh = self.config.get('exact_match_length_ratio_threshold', 0.7)
+        old_dialogs, old_used = old_data_list.dialogs, old_data_list.used
+        index = ranked = None
+        if self.config.get('s1_vector_prerank') and np is None: self.log("未安装numpy, Stage 1不使用向量预排序", "WARNING")
+        if self.config.get('s1_vector_prerank') and np is not None:
+            ranked = BigramVectors(old_dialogs).top_candidates(new_data_list.dialogs, self.config.get('s1_vector_top_k', 8)).tolist()
+            exact = {}
+            for j, text in enumerate(old_dialogs): exact.setdefault(text, []).append(j)
+        elif self.config.get('s1_use_index', True): index = DialogIndex(old_dialogs)
+        top_k = self.config.get('s1_index_top_k', 0)
+        is_used = old_used.__getitem__
+        matched_s1 = 0
+        for i_s1, new_dialog_s1 in enumerate(new_data_list.dialogs):
+            if not self.running or new_data_list.matched[i_s1] or not new_dialog_s1: continue
+            if ranked is not None: # 完全相同的文本优先, 否则在余弦最高的几个未用旧台词中取ratio最高者
+                best_old_match_idx_s1, highest_ratio_s1 = next(((j, 1.0) for j in exact.get(new_dialog_s1, ()) if not old_used[j]), (-1, 0.0))
+                if best_old_match_idx_s1 == -1:
+                    for old_idx_s1 in sorted(j for j in ranked[i_s1] if not old_used[j]):
+                        current_ratio_s1 = self._pair_ratio(new_data_list, i_s1, old_data_list, old_idx_s1)
+                        if current_ratio_s1 > highest_ratio_s1: highest_ratio_s1, best_old_match_idx_s1 = current_ratio_s1, old_idx_s1
+            elif index is not None:
+                best_old_match_idx_s1, highest_ratio_s1 = index.best_match(new_dialog_s1, exact_thresh, is_used, top_k,
+                                                                           ratio=lambda j: self._pair_ratio(new_data_list, i_s1, old_data_list, j))
+            else:
+                best_old_match_idx_s1, highest_ratio_s1 = -1, 0.0
+                for old_idx_s1, old_dialog_s1 in enumerate(old_dialogs):
+                    if old_used[old_idx_s1] or not old_dialog_s1: continue
+                    current_ratio_s1 = self._pair_ratio(new_data_list, i_s1, old_data_list, old_idx_s1)
+                    if current_ratio_s1 > highest_ratio_s1: highest_ratio_s1, best_old_match_idx_s1 = current_ratio_s1, old_idx_s1
+            if highest_ratio_s1 >= exact_thresh and best_old_match_idx_s1 != -1:
+                old_match_s1, new_row_s1 = old_data_list[best_old_match_idx_s1], new_data_list.rows[i_s1]
+                len_n, len_o = new_data_list.features[i_s1].plain_len, old_data_list.features[best_old_match_idx_s1].plain_len
+                if len_n > 0 and len_o > 0 and (min(len_n, len_o) / max(len_n, len_o)) > len_ratio_thresh:
+                    try:
+                        ws_copy.set(new_row_s1, speaker_col_f_idx, old_match_s1['speaker'])
+                        new_data_list[i_s1]['speaker_after_match'] = old_match_s1['speaker']
+                        new_data_list.matched[i_s1] = 1; old_used[best_old_match_idx_s1] = 1; matched_s1 += 1
+                        if self.log_enabled("DEBUG"): self.log_with_context(f"S1 精确匹配: OldR {old_match_s1['row']} (S:{old_match_s1['speaker']}) -> NewR {new_row_s1} (R:{highest_ratio_s1:.2f})", row=new_row_s1, level="DEBUG")
+                    except Exception as e_s1w : self.log_with_context(f"S1写入失败:{e_s1w}",row=new_row_s1,level="WARNING")
+        if index is not None: self.counters['SequenceMatcher'] += index.ratio_calls
+        return matched_s1
+
+    def _align_speakers(self, ws_copy, new_data_list, old_data_list, speaker_col_f_idx, anchors=None):
+        """对齐模式: 用align_dialogs一次性求新旧台词的单调对应关系, 代替S1/S2/S3三轮贪心匹配。
+        有增量锚点时只对相邻锚点之间含未匹配行的窗口分别求对齐, 不再对整表做动态规划。
+        对齐给出的每一对再用SequenceMatcher按speaker_match_threshold确认, 返回匹配行数"""
+        general_match_thresh = self.config.get('speaker_match_threshold', 0.6)
+        start_time_al = time.time()
+        self.log("说话人复制 - 对齐匹配开始...", "INFO")
+        new_texts, old_texts = new_data_list.dialogs, old_data_list.dialogs
+        mergeable = [len(f.sentences) > 1 for f in old_data_list.features]
+        windows = [(0, len(new_texts), 0, len(old_texts))]
+        if anchors is not None: # 窗口: 前一锚点之后到后一锚点之前, 新旧两侧都是左闭右开
+            bounds = [(-1, -1, -1)] + anchors + [(len(new_texts), len(new_texts), len(old_texts))]
+            windows = [(a[1] + 1, b[0], a[2] + 1, b[2]) for a, b in zip(bounds, bounds[1:])
+                       if not all(new_data_list.matched[i] for i in range(a[1] + 1, b[0]))]
+        pairs = []
+        for i1, i2, j1, j2 in windows:
+            pairs += [([i1 + i for i in new_idxs], j1 + old_idx, sim) for new_idxs, old_idx, sim in
+                      align_dialogs(new_texts[i1:i2], old_texts[j1:j2],
+                                    min_sim=self.config.get('align_min_similarity', 0.3), band=self.config.get('align_band', 60),
+                                    max_merge=self.config.get('align_max_merge', 4), mergeable=mergeable[j1:j2])]
+        matched_lines, merged_groups, paragraph_count = 0, 0, 0
+        for new_idxs, old_idx, cheap_sim in pairs:
+            if not self.running: break
+            if any(new_data_list.matched[i] for i in new_idxs): continue # 增量复制已沿用的行
+            old_item = old_data_list[old_idx]
+            segment = [new_data_list[i] for i in new_idxs]
+            combined_text = " ".join(item['dialog'] for item in segment)
+            ratio = self._seq_ratio(combined_text, old_item['dialog'])
+            if ratio < general_match_thresh:
+                if self.log_enabled("TRACE"): self.log_with_context(f"对齐候选未通过确认: OldR {old_item['row']} (相似度:{ratio:.2f}, 对齐分:{cheap_sim:.2f})", row=segment[0]['row'], level="TRACE")
+                continue
+            for pos, item in enumerate(segment):
+                try:
+                    ws_copy.set(item['row'], speaker_col_f_idx, old_item['speaker'])
+                    item['speaker_after_match'] = old_item['speaker']; item['matched'] = True
+                    if len(segment) > 1: item['paragraph_id'] = paragraph_count; item['paragraph_position'] = pos
+                    matched_lines += 1
+                    if self.log_enabled("DEBUG"): self.log_with_context(f"对齐匹配: OldR {old_item['row']} (S:{old_item['speaker']}) -> NewR {item['row']} (R:{ratio:.2f}{', 合并' + str(len(segment)) + '行' if len(segment) > 1 else ''})", row=item['row'], level="DEBUG")
+                except Exception as e_alw: self.log_with_context(f"对齐写入失败:{e_alw}", row=item['row'], level="WARNING")
+            old_item['used'] = True
+            if len(segment) > 1: paragraph_count += 1; merged_groups += 1
+
+        unmatched_count = 0
+        for pos in range(len(new_data_list)):
+            if not self.running: break
+            if new_data_list.matched[pos]: continue
+            unmatched_count += 1
+            self._fill_unmatched_line(ws_copy, new_data_list, pos, speaker_col_f_idx)
+        self.log(f"说话人复制 - 对齐匹配结束. 耗时 {time.time() - start_time_al:.1f}秒, 匹配 {matched_lines} 行 (其中一对多 {merged_groups} 组), 未匹配 {unmatched_count} 行.", "INFO")
+        return matched_lines
+
+    def _fill_unmatched_line(self, ws_copy, new_data_list, pos, speaker_col_f_idx):
+        """未匹配行: 内容猜测可信度足够高时填入并标黄, 与前两行说话模式明显不符时标红"""
+        item = new_data_list[pos]; row = item['row']
+        try:
+            content_guess_threshold_higher = self.config.get('content_guess_confidence_threshold', 0.7) + 0.1
+            if item.get('content_speaker_guess') and item.get('content_confidence', 0) >= content_guess_threshold_higher:
+                ws_copy.set(row, speaker_col_f_idx, item['content_speaker_guess'])
+                item['speaker_after_match'] = item['content_speaker_guess']
+                ws_copy.set_color(row, speaker_col_f_idx, 6)
+                self.log_with_context(f"内容猜测填补: '{item['content_speaker_guess']}' (高可信度:{item['content_confidence']:.2f})", row=row, level="INFO")
+                return
+            for prev_item in new_data_list[max(0, pos - 2):pos][::-1]:
+                if prev_item.get('matched') and prev_item.get('speaker_after_match') and new_data_list.features[prev_item.i].differs_from(new_data_list.features[pos]):
+                    ws_copy.set_color(row, speaker_col_f_idx, 3); break
+        except Exception as e_fill: self.log_with_context(f"未匹配行标色失败:{e_fill}", row=row, level="WARNING")
+
+    def _copy_speakers(self, ws_copy, old_path_copy, data_start_row, prev_output=None):
+        timer = StageTimer('复制说话人/'); timer.mark("加载旧表")
+        try:
+            self.log(f"开始从旧表 '{os.path.basename(old_path_copy)}' 复制说话人 (数据从第 {data_start_row} 行开始)...", "INFO")
+            old_sheet = self._old_sheet(old_path_copy)
+            old_sheet_name_copy = old_sheet['sheet_name']
+
+            speaker_col_f_idx = self._col2idx(self.config['col_f_speaker'])
+            dialog_col_g_idx = self._col2idx(self.config['col_g'])
+
+            self.log(f"旧表 '{old_sheet_name_copy}' 最后台词行: {old_sheet['last_row']}", "DEBUG")
+            old_table = old_sheet['tables'].get(data_start_row)
+            if old_table is None: # 同一旧表、同一起始行只建一次, 之后每次取匹配状态清空的副本
+                old_table = old_sheet['tables'][data_start_row] = DialogueTable()
+                for r_old_val, speaker_raw, dialog_raw in old_sheet['rows']:
+                    if r_old_val < data_start_row: continue
+                    speaker_val = str(speaker_raw or '').strip()
+                    dialog_val = str(dialog_raw or '').strip()
+                    if dialog_val: old_table.append(r_old_val, dialog_val, speaker=speaker_val)
+                old_table.compute_features()
+            old_data_list = old_table.fresh()
+            
+            if not old_data_list:
+                self.log(f"旧表 '{old_sheet_name_copy}' 未找到可用台词数据 (检查列F/G和起始行{data_start_row})。", "WARNING")
+                return
+            self.log(f"旧表数据加载完成，共 {len(old_data_list)} 条有效对话。", "DEBUG")
+
+            char_patterns = old_sheet['patterns'].get(data_start_row)
+            if char_patterns is None: char_patterns = old_sheet['patterns'][data_start_row] = self._build_character_patterns(old_data_list)
+            self.config['_DATA_START_ROW_CACHE'] = data_start_row # 缓存DATA_START_ROW给_handle_special_cases用
+
+            timer.mark("加载新表"); last_row_new = 1
+            try: last_row_new = ws_copy.last_row()
+            except: self.log_with_context("复制说话人：无法确定新表最后行，默认1", level="WARNING")
+            
+            new_data_list = DialogueTable()
+            for r_new_val in range(data_start_row, last_row_new + 1):
+                dialog_new_val = str(ws_copy.get(r_new_val, dialog_col_g_idx) or '').strip()
+                if dialog_new_val:
+                    guess_s, guess_c = self._guess_speaker_from_content(dialog_new_val, char_patterns) if char_patterns else (None, 0.0)
+                    new_data_list.append(r_new_val, dialog_new_val, guess=guess_s, confidence=guess_c if guess_s else 0.0)
+
+            if not new_data_list:
+                self.log("新表中未找到可用台词数据进行匹配。", "WARNING")
+                return
+            new_data_list.compute_features()
+            self.pair_cache = LRUCache(self.config.get('pair_cache_size', 200000))
+            self.log(f"新表数据加载完成，共 {len(new_data_list)} 条有效对话。", "DEBUG")
+            kept_rows, anchors = (), None
+            if prev_output and self.config.get('speaker_matcher', 'heuristic') != 'align': # S1/S2比读上次输出、逐行比对还快, 增量省不了时间
+                self.log("说话人增量只用于align模式, heuristic模式整表匹配", "INFO")
+            elif prev_output:
+                timer.mark("增量比对"); kept_rows, anchors = self._delta_speakers(ws_copy, new_data_list, old_data_list, speaker_col_f_idx, prev_output, old_path_copy, data_start_row) or ((), None)
+
+            if self.config.get('speaker_matcher', 'heuristic') == 'align':
+                timer.mark("对齐匹配"); matched_align = self._align_speakers(ws_copy, new_data_list, old_data_list, speaker_col_f_idx, anchors)
+                if not self.running: self.log("中止于对齐匹配后"); return
+                timer.mark("段落标点"); self._process_paragraph_punctuation(ws_copy, new_data_list, dialog_col_g_idx)
+                if not self.running: self.log("中止于段落标点后处理后"); return
+                timer.mark("特殊情况"); self._handle_special_cases(ws_copy, new_data_list, speaker_col_f_idx, dialog_col_g_idx, kept_rows)
+                self.counters['匹配行/对齐'] += matched_align
+                self.log(f"说话人复制总结(对齐模式): 总匹配行数 {matched_align}.", "INFO")
+                return
+
+            general_match_thresh = self.config.get('speaker_match_threshold', 0.6)
+            seg_sim_w = self.config.get('segment_similarity_weight', 0.6)
+            seg_coh_w = self.config.get('segment_coherence_weight', 0.25)
+            seg_len_w = self.config.get('segment_length_ratio_weight', 0.15)
+            matched_s1, matched_s2_lines, matched_s3 = 0, 0, 0
+
+            timer.mark("S1"); self.log("说话人复制 - Stage 1: 精确匹配开始...", "INFO")
+            matched_s1 = self._stage1_exact_match(ws_copy, new_data_list, old_data_list, speaker_col_f_idx)
+            self.log(f"说话人复制 - Stage 1: 精确匹配结束. 匹配 {matched_s1} 行.", "INFO")
+            if not self.running: self.log("中止于S1后"); return
+
+            # 完全重写的Stage 2分段匹配部分:
+            timer.mark("S2"); self.log("说话人复制 - Stage 2: 分段匹配开始 (增强版)...", "INFO")
+            import time
+            start_time_s2 = time.time()
+            matched_s2_lines = 0
+            max_processing_time_s2 = 60
+            processed_count = 0
+            
+            # 新增：按时间顺序跟踪旧表和新表的位置
+            old_position = 0
+            new_position = 0
+            
+            # 构建一对多映射检测
+            one_to_many_map = {}
+            for old_idx, old_text in enumerate(old_data_list.dialogs):
+                if old_data_list.used[old_idx]: continue
+                if not old_text: continue
+                
+                # 检测是否可能是多行合并的台词
+                sentences = old_data_list.features[old_idx].sentences
+                
+                if len(sentences) > 1:
+                    # 可能是多行合并，记录以备后用
+                    one_to_many_map[old_idx] = {
+                        'sentences': list(sentences),
+                        'full_text': old_text,
+                        'speaker': old_data_list.speaker(old_idx),
+                        'matched_new_rows': []
+                    }
+        
+            # 收集连续未匹配段落，考虑时间顺序
+            unmatched_segments = []
+            segment = []
+            
+            for i, new_item in enumerate(new_data_list):
+                if not new_data_list.matched[i]:
+                    segment.append(new_item)
+                else:
+                    if segment:
+                        unmatched_segments.append(segment)
+                        segment = []
+            
+            if segment:  # 添加最后一个段落
+                unmatched_segments.append(segment)
+            
+            # 处理一对多映射：寻找旧表一行匹配新表多行
+            # 各段落的合并文本与旧台词无关, 先拼好并统计字频; 长度上界(real_quick_ratio)或共有字数上界(quick_ratio)
+            # 已低于阈值的组合不可能匹配, 不必计算相似度
+            combined_texts = [" ".join([item['dialog'] for item in segment]) if len(segment) >= 2 else None for segment in unmatched_segments]
+            combined_chars = [Counter(text) if text else None for text in combined_texts]
+            for old_idx, mapping in one_to_many_map.items():
+                if not self.running: break
+                len_full, chars_full = len(mapping['full_text']), Counter(mapping['full_text'])
+                
+                for segment, combined_text, chars in zip(unmatched_segments, combined_texts, combined_chars):
+                    if len(segment) < 2: continue  # 太短的段落跳过
+                    
+                    # 检查整个段落是否匹配合并的台词
+                    total_len = len(combined_text) + len_full
+                    if 2.0 * min(len(combined_text), len_full) / total_len < general_match_thresh: continue
+                    if 2.0 * sum((chars & chars_full).values()) / total_len < general_match_thresh: self.counters['S2一对多跳过'] += 1; continue
+                    similarity = self._seq_ratio(combined_text, mapping['full_text'])
+                    
+                    if similarity >= general_match_thresh:
+                        # 找到匹配，将相同说话人应用到所有行
+                        for idx, item in enumerate(segment):
+                            try:
+                                row = item['row']
+                                ws_copy.set(row, speaker_col_f_idx, mapping['speaker'])
+                                item['speaker_after_match'] = mapping['speaker']
+                                item['matched'] = True
+                                item['paragraph_id'] = processed_count
+                                item['paragraph_position'] = idx
+                                matched_s2_lines += 1
+                                
+                                if self.log_enabled("DEBUG"): self.log_with_context(
+                                    f"S2 一对多匹配: 旧行合并文本 '{mapping['full_text'][:20]}...' -> " +
+                                    f"新行 {row} (相似度:{similarity:.2f})",
+                                    row=row, level="DEBUG"
+                                )
+                            except Exception as e:
+                                self.log_with_context(f"S2一对多写入失败:{e}", row=item['row'], level="WARNING")
+                        
+                        old_data_list.used[old_idx] = 1
+                        processed_count += 1
+                        break  # 找到匹配后处理下一个合并台词
+            
+            # 原有的段落匹配逻辑保留，但增加时间顺序约束
+            for segment in unmatched_segments:
+                if len(segment) < 2: continue  # 跳过单行段落
+                
+                # 限制搜索范围：
+                search_start = max(0, old_position - 5)  # 从当前位置往前最多5行
+                search_end = min(len(old_data_list), old_position + 20)  # 往后最多20行
+                
+                best_match_indices = []
+                best_match_score = 0
+                best_match_start = -1
+                # 新段落的连贯性与候选位置无关, 只算一次
+                coherence = self._calculate_segment_coherence(new_data_list, segment[0].i, len(segment))
+                
+                # 在有限范围内搜索最佳匹配
+                for start_idx in range(search_start, search_end - len(segment) + 1):
+                    if not self.running: break
+                    
+                    # 检查连续段落是否都未被使用
+                    all_available = True
+                    for i in range(len(segment)):
+                        if start_idx + i >= len(old_data_list) or old_data_list.used[start_idx + i]:
+                            all_available = False
+                            break
+                    
+                    if not all_available:
+                        continue
+                    
+                    # 先算与相似度无关的两项, 再用长度上界(2*min/(la+lb), 即real_quick_ratio)逐行收紧综合分上界:
+                    # 上界已不超过当前最佳或低于阈值的位置不可能被选中, 直接跳过, 结果与逐个计算相同
+                    old_coherence = self._calculate_segment_coherence(old_data_list, start_idx, len(segment))
+                    coherence_diff = abs(coherence - old_coherence)
+                    coherence_score = 1.0 - min(coherence_diff, 0.5) * 2  # 归一化为0-1
+                    
+                    # 计算段落长度比例相似度
+                    len_similarity = 1.0
+                    for i in range(len(segment)):
+                        len_n = new_data_list.features[segment[i].i].length
+                        len_o = old_data_list.features[start_idx + i].length
+                        if len_n > 0 and len_o > 0:
+                            len_similarity *= min(len_n, len_o) / max(len_n, len_o)
+                    len_similarity = len_similarity ** (1.0 / len(segment))  # 几何平均
+                    
+                    # 计算整体段落相似度
+                    sims = [2.0 * min(new_data_list.features[segment[i].i].length, old_data_list.features[start_idx + i].length) /
+                            (new_data_list.features[segment[i].i].length + old_data_list.features[start_idx + i].length) for i in range(len(segment))]
+                    pruned = False
+                    for k in range(len(segment)): # 不用i: S3的可疑行判断沿用了这里留下的i
+                        if seg_sim_w >= 0:
+                            bound_similarity = 0
+                            for sim in sims: bound_similarity += sim
+                            bound_similarity /= len(segment)
+                            bound_score = seg_sim_w * bound_similarity + seg_coh_w * coherence_score + seg_len_w * len_similarity
+                            if bound_score <= best_match_score or bound_score < general_match_thresh: pruned = True; break
+                        sims[k] = self._pair_ratio(new_data_list, segment[k].i, old_data_list, start_idx + k)
+                    if pruned:
+                        self.counters['S2剪枝窗口'] += 1
+                        continue
+                    segment_similarity = 0
+                    for sim in sims:
+                        segment_similarity += sim
+                    segment_similarity /= len(segment)
+                    
+                    # 综合评分
+                    match_score = (
+                        seg_sim_w * segment_similarity +
+                        seg_coh_w * coherence_score +
+                        seg_len_w * len_similarity
+                    )
+                    
+                    if match_score > best_match_score:
+                        best_match_score = match_score
+                        best_match_start = start_idx
+                        best_match_indices = [start_idx + i for i in range(len(segment))]
+                
+                # 应用最佳匹配
+                if best_match_score >= general_match_thresh and best_match_start != -1:
+                    for i, new_item_to_match in enumerate(segment):
+                        old_idx = best_match_start + i
+                        if old_idx < len(old_data_list):
+                            old_item_match = old_data_list[old_idx]
+                            
+                            try:
+                                ws_copy.set(new_item_to_match['row'], speaker_col_f_idx, old_item_match['speaker'])
+                                new_item_to_match['speaker_after_match'] = old_item_match['speaker']
+                                new_item_to_match['matched'] = True
+                                old_item_match['used'] = True
+                                new_item_to_match['paragraph_id'] = processed_count
+                                new_item_to_match['paragraph_position'] = i
+                                matched_s2_lines += 1
+                                
+                                if self.log_enabled("DEBUG"): self.log_with_context(
+                                    f"S2 段落匹配: OldR {old_item_match['row']} (S:{old_item_match['speaker']}) -> " +
+                                    f"NewR {new_item_to_match['row']} (整体分数:{best_match_score:.2f})",
+                                    row=new_item_to_match['row'], level="DEBUG"
+                                )
+                            except Exception as e_s2w:
+                                self.log_with_context(f"S2写入失败:{e_s2w}", row=new_item_to_match['row'], level="WARNING")
+                    
+                    processed_count += 1
+            
+            self.log(f"说话人复制 - Stage 2: 分段匹配结束. 耗时 {time.time() - start_time_s2:.1f}秒, 匹配 {matched_s2_lines} 行.", "INFO")
+            if not self.running: self.log("中止于S2后"); return
+
+            timer.mark("S3"); self.log("说话人复制 - Stage 3: 有序模糊单行匹配开始...", "INFO")
+            unmatched_s3_count = 0
+            
+            # 重置位置跟踪
+            old_position = 0
+            for new_item_s3 in new_data_list:
+                if not self.running or new_data_list.matched[new_item_s3.i]: continue
+                
+                # 在附近范围内寻找最佳匹配
+                search_window = 15  # 搜索窗口大小
+                best_old_match_idx_s3, highest_ratio_s3 = -1, 0.0
+                
+                # 优先在时间顺序合理的范围内搜索
+                search_start = max(0, old_position - 5)
+                search_end = min(len(old_data_list), old_position + search_window)
+                
+                len_new_s3 = new_data_list.features[new_item_s3.i].length
+                for old_idx_s3 in range(search_start, search_end):
+                    old_dialog_s3 = old_data_list.dialogs[old_idx_s3]
+                    if old_data_list.used[old_idx_s3] or not old_dialog_s3: continue
+                    len_old_s3 = old_data_list.features[old_idx_s3].length
+                    if 2.0 * min(len_new_s3, len_old_s3) / (len_new_s3 + len_old_s3) <= highest_ratio_s3: continue # 长度上界已不可能更高
+                    
+                    current_ratio_s3 = self._pair_ratio(new_data_list, new_item_s3.i, old_data_list, old_idx_s3)
+                    if current_ratio_s3 > highest_ratio_s3:
+                        highest_ratio_s3, best_old_match_idx_s3 = current_ratio_s3, old_idx_s3
+                
+                row_s3 = new_item_s3['row']
+                if highest_ratio_s3 >= general_match_thresh and best_old_match_idx_s3 != -1:
+                    # 找到有效匹配，更新旧表位置
+                    old_match_s3 = old_data_list[best_old_match_idx_s3]
+                    old_position = best_old_match_idx_s3 + 1
+                    
+                    try:
+                        ws_copy.set(row_s3, speaker_col_f_idx, old_match_s3['speaker'])
+                        new_item_s3['speaker_after_match'] = old_match_s3['speaker']
+                        new_item_s3['matched'] = True
+                        old_match_s3['used'] = True
+                        matched_s3 += 1
+                        if self.log_enabled("DEBUG"): self.log_with_context(f"S3 有序匹配: OldR {old_match_s3['row']} -> NewR {row_s3} (R:{highest_ratio_s3:.2f})", row=row_s3, level="DEBUG")
+                    except Exception as e_s3w:
+                        self.log_with_context(f"S3写入失败:{e_s3w}", row=row_s3, level="WARNING")
+                else:
+                    # 只对内容猜测更有信心的情况进行标记，降低误标红率
+                    unmatched_s3_count += 1
+                    try:
+                        content_guess_threshold_final = self.config.get('content_guess_confidence_threshold', 0.7)
+                        content_guess_threshold_higher = content_guess_threshold_final + 0.1  # 提高阈值
+                        if new_item_s3.get('content_speaker_guess') and new_item_s3.get('content_confidence', 0) >= content_guess_threshold_higher:
+                            guessed_s_val = new_item_s3['content_speaker_guess']
+                            ws_copy.set(row_s3, speaker_col_f_idx, guessed_s_val)
+                            new_item_s3['speaker_after_match'] = guessed_s_val
+                            ws_copy.set_color(row_s3, speaker_col_f_idx, 6)
+                            self.log_with_context(f"S3 内容猜测填补: '{guessed_s_val}' (高可信度:{new_item_s3['content_confidence']:.2f})", row=row_s3, level="INFO")
+                        else:
+                            # 不再标红所有未匹配项，只标记那些特别可疑的
+                            suspicious = False
+                            for prev_idx in range(max(0, i-1), max(0, i-3), -1):
+                                if prev_idx >= 0 and prev_idx < len(new_data_list):
+                                    prev_item = new_data_list[prev_idx]
+                                    if prev_item.get('matched') and prev_item.get('speaker_after_match'):
+                                        # 如果前面几行台词与当前对话模式不符，标记为可疑
+                                        if new_data_list.features[prev_item.i].differs_from(new_data_list.features[new_item_s3.i]):
+                                            suspicious = True
+                                            break
+                        
+                        if suspicious:
+                            ws_copy.set_color(row_s3, speaker_col_f_idx, 3)
+                    except Exception as e_s3color:
+                        self.log_with_context(f"S3标色失败:{e_s3color}", row=row_s3, level="WARNING")
+            self.log(f"说话人复制 - Stage 3: 模糊单行匹配结束. 匹配 {matched_s3} 行. 未匹配 {unmatched_s3_count} 行.", "INFO")
+            if not self.running: 
+                self.log("中止于S3后")
+                return
+
+            # 这些行必须在try块内，不能在try块之外
+            timer.mark("段落标点"); self._process_paragraph_punctuation(ws_copy, new_data_list, dialog_col_g_idx)
+            if not self.running: 
+                self.log("中止于段落标点后处理后")
+                return
+                
+            timer.mark("特殊情况"); self._handle_special_cases(ws_copy, new_data_list, speaker_col_f_idx, dialog_col_g_idx, kept_rows)
+
+            total_matched = matched_s1 + matched_s2_lines + matched_s3
+            self.counters.update({'匹配行/S1': matched_s1, '匹配行/S2': matched_s2_lines, '匹配行/S3': matched_s3})
+            self.log(f"说话人复制总结: 总匹配行数 {total_matched} (精确:{matched_s1}, 分段行数:{matched_s2_lines}, 模糊:{matched_s3}).", "INFO")
+            
+        except Exception as e:
+            self.log(f"复制说话人主流程发生严重错误: {e}", "CRITICAL")
+            self.log(traceback.format_exc(), "DEBUG")
+        finally: 
+            timer.mark(None)
+            for key, secs in timer.times.items(): self.stage_times[key] = self.stage_times.get(key, 0.0) + secs
+
+    def _validate_speaker_assignments(self, ws, new_data_list, speaker_col_idx):
+        self.log("进行说话人匹配自检验证...", "INFO")
+        issues = 0
+        
+        # 检查同一角色连续说话行过多
+        consecutive_same_speaker = 0
+        last_speaker = None
+        
+        # 按行遍历检查
+        for item in sorted(new_data_list, key=lambda x: x['row']):
+            current_speaker = item.get('speaker_after_match')
+            if not current_speaker:
+                continue
+                
+            # 检查同一角色连续说话
+            if current_speaker == last_speaker:
+                consecutive_same_speaker += 1
+                if consecutive_same_speaker > 7:  # 超过7行同一角色连续说话
+                    row = item['row']
+                    self.log_with_context(f"自检警告: 角色 '{current_speaker}' 连续说话超过7行", row=row, level="WARNING")
+                    # 标记可能的问题
+                    try:
+                        ws.set_color(row, speaker_col_idx, 45)  # 使用不同的颜色标记
+                        issues += 1
+                    except:
+                        pass
+            else:
+                consecutive_same_speaker = 1
+                last_speaker = current_speaker
+        
+        # 检查其他可能的问题...
+        
+        if issues > 0:
+            self.log(f"自检发现 {issues} 处可能的说话人分配问题，已用特别颜色标记", "WARNING")
+        else:
+            self.log("说话人分配自检通过", "INFO")
+
+    def _col2idx(self, col_letter):
+        """将Excel列字母转换为列索引数字"""
+        if not col_letter or not isinstance(col_letter, str):
+            return 1  # 默认返回第一列
+        col_letter = col_letter.upper().strip()
+        idx = 0
+        for c in col_letter:
+            idx = idx * 26 + (ord(c) - ord('A') + 1)
+        return idx
+
+    def _idx2col(self, col_idx):
+        """将列索引数字转换为Excel列字母"""
+        if not isinstance(col_idx, int) or col_idx < 1:
+            return 'A'  # 默认返回A列
+        result = ""
+        while col_idx > 0:
+            col_idx, remainder = divmod(col_idx - 1, 26)
+            result = chr(65 + remainder) + result
+        return result
+
+    def adjust_images(self, ws_images):
+        """调整工作表中的图片尺寸"""
+        try:
+            # 获取工作表中所有图片和形状
+            shape_count = ws_images.shape_count()
+            if shape_count == 0:
+                self.log("图片调整: 未发现图片/形状", "INFO")
+                return
+            
+            # 明确设置为1.0，表示保持原尺寸
+            scale_factor = 1.0  # 保持原尺寸，不进行缩放
+            
+            self.log(f"开始处理工作表 '{ws_images.name}' 中的 {shape_count} 个图片/形状 (保持原尺寸)...", "INFO")
+            
+            success_count = 0
+            failure_count = 0
+            
+            # 遍历所有形状对象，但不进行缩放处理
+            for i in range(1, shape_count + 1):
+                if not self.running:
+                    break
+                    
+                try:
+                    # 只进行记录，不执行缩放操作
+                    original_width, original_height = ws_images.shape_size(i)
+                    if self.log_enabled("TRACE"): self.log(f"图片调整: 形状{i} - 保持原尺寸 {original_width:.1f}x{original_height:.1f}", "TRACE")
+                    success_count += 1
+                except Exception as e_shape:
+                    failure_count += 1
+                    self.log(f"图片调整: 形状{i}处理失败: {e_shape}", "WARNING")
+                    
+            self.log(f"图片调整:成功{success_count},失败{failure_count}", "INFO")
+        except Exception as e_all_images:
+            self.log(f"处理图片时发生错误: {e_all_images}", "ERROR")
+
+# --- 并行批处理子进程 ---
+# 每个子进程持有一个无界面的处理器实例, 由_pool_init创建, 之后各文件复用(COM模式下复用同一个Excel)
+_pool_app = None
+
+
+class _PoolWorkerApp(ExcelBatchProcessor):
+    """子进程内的处理器: running跟随主进程的取消事件, 日志写入队列"""
+    def __init__(self, cancel_event):
+        self._cancel_event = cancel_event
+        super().__init__()
+
+    @property
+    def running(self): return not self._cancel_event.is_set()
+
+    @running.setter
+    def running(self, value): pass
+
+
+def _pool_init(config, old_queue, old_matches, log_queue, cancel_event):
+    global _pool_app
+    _pool_app = _PoolWorkerApp(cancel_event)
+    _pool_app.config.update(config); _pool_app.old_queue = old_queue; _pool_app.old_matches = old_matches; _pool_app.log_queue = log_queue
+    _pool_app.old_cache = LRUCache(config.get('old_cache_size', 8)) # 每个子进程各自缓存
+    _pool_app._prepare_old_index(add_missing=False) # 主进程已把旧表加入索引, 子进程只读
+    if config.get('engine') == 'com': # 每个子进程一个单线程COM套间和独立的Excel实例
+        pythoncom.CoInitialize()
+        _pool_app.excel = win32.DispatchEx('Excel.Application')
+        _pool_app.excel.Visible = False; _pool_app.excel.DisplayAlerts = False
+        atexit.register(_pool_shutdown)
+
+
+def _pool_shutdown():
+    if _pool_app and _pool_app.excel:
+        try: _pool_app.excel.Quit()
+        except Exception: pass
+        _pool_app.excel = None
+        pythoncom.CoUninitialize()
+
+
+def _pool_proc_file(newp):
+    """子进程处理单个新表, 返回 {'file', 'output', 'seconds', 'error', 'stages', 'counters'}"""
+    start = time.perf_counter()
+    if not _pool_app.running: return {'file': newp, 'output': None, 'seconds': 0.0, 'error': "已取消"}
+    _pool_app.log(f"--- 子进程{os.getpid()}开始处理:{os.path.basename(newp)} ---", "INFO")
+    output = _pool_app._proc_file_profiled(newp)
+    return {'file': newp, 'output': output, 'seconds': time.perf_counter() - start, 'error': None if output else ("已中止" if not _pool_app.running else "失败"),
+            'stages': dict(_pool_app.stage_times), 'counters': dict(_pool_app.counters)}
+
+
+def _collect_xlsx(paths, list_folder=None):
+    """命令行的文件/文件夹参数展开为.xlsx文件列表 (文件夹内规则与"选择文件夹"一致); list_folder可换成旧表索引的列目录"""
+    files = []
+    for p in paths:
+        if not os.path.isdir(p): files.append(p)
+        elif list_folder: files.extend(list_folder(p))
+        else: files.extend(sorted(os.path.join(p, f) for f in os.listdir(p) if f.lower().endswith('.xlsx') and not f.startswith('~')))
+    return [os.path.abspath(f) for f in files]
+
+
+# 这些配置由专门的命令行参数给出或只在界面里有意义
+CLI_SKIP_CONFIG = ('last_folder', 'output_folder', 'engine', 'workers')
+CLI_CHOICES = {'speaker_matcher': SPEAKER_MATCHERS, 'log_level': tuple(LOG_LEVELS)}
+
+
+def run_cli(argv):
+    """命令行入口: 不创建任何界面控件, 用_proc_file同一条流水线处理新表; 日志写stderr, --report输出JSON运行报告"""
+    defaults = ExcelBatchProcessor().config
+    parser = argparse.ArgumentParser(description="台词表辅助脚本 (不带参数运行时启动图形界面)")
+    parser.add_argument('--new', nargs='+', required=True, help="新表文件或文件夹")
+    parser.add_argument('--old', nargs='*', default=[], help="旧表文件或文件夹")
+    parser.add_argument('--output', default=os.getcwd(), help="输出文件夹")
+    parser.add_argument('--engine', choices=ENGINES, default='com' if win32 else 'openpyxl', help="处理引擎")
+    parser.add_argument('--jobs', type=int, default=1, help="并行处理的子进程数")
+    parser.add_argument('--report', help="JSON运行报告写到该文件, '-'为标准输出")
+    cfg_group = parser.add_argument_group("处理配置", "与界面配置项一一对应, 默认值同界面")
+    for key, value in defaults.items(): # 其余配置项按默认值的类型自动生成参数, 如 --speaker-match-threshold 0.7, --no-merge-duplicates
+        if key in CLI_SKIP_CONFIG: continue
+        flag = '--' + key.replace('_', '-')
+        if isinstance(value, bool): cfg_group.add_argument(flag, dest=key, action=argparse.BooleanOptionalAction, default=value)
+        else: cfg_group.add_argument(flag, dest=key, type=type(value), default=value, choices=CLI_CHOICES.get(key), metavar=None if key in CLI_CHOICES else type(value).__name__.upper())
+    args = parser.parse_args(argv)
+    if args.engine == 'com' and win32 is None: parser.error("当前环境无win32com, 请使用 --engine openpyxl")
+    new_files = _collect_xlsx(args.new)
+    if not new_files: parser.error("--new 中没有找到.xlsx文件")
+
+    app = ExcelBatchProcessor()
+    app.config.update({key: getattr(args, key) for key in defaults if key not in CLI_SKIP_CONFIG})
+    app.config.update({'engine': args.engine, 'output_folder': os.path.abspath(args.output), 'workers': max(1, args.jobs),
+                       'col_e': args.col_e.upper(), 'col_g': args.col_g.upper(), 'col_f_speaker': args.col_f_speaker.upper()})
+    app.file_queue = new_files
+    idx = app._get_old_index()
+    app.old_queue = _collect_xlsx(args.old, idx.list_folder if idx else None)
+    os.makedirs(app.config['output_folder'], exist_ok=True)
+    started, start = datetime.now(), time.perf_counter()
+    fatal = None
+    app.running = True; app.log("===== 处理开始 =====", "INFO")
+    try: app.run_queue()
+    except Exception as e:
+        fatal = str(e); app.log(f"主流程严重错误:{e}", "CRITICAL"); app.log(traceback.format_exc(), "DEBUG")
+    finally:
+        app.running = False; app.log("===== 处理结束 =====", "INFO")
+    ok = sum(1 for r in app.results if r['output'])
+    if args.report:
+        report = {'started': started.isoformat(timespec='seconds'), 'seconds': round(time.perf_counter() - start, 3),
+                  'config': {k: v for k, v in app.config.items() if not k.startswith('_') and k != 'last_folder'},
+                  'old_files': app.old_queue, 'error': fatal,
+                  'files': [dict(r, seconds=round(r['seconds'], 3), stages={k: round(v, 3) for k, v in r.get('stages', {}).items()}) for r in app.results],
+                  'summary': {'total': len(app.file_queue), 'ok': ok, 'failed': len(app.file_queue) - ok}}
+        text = json.dumps(report, ensure_ascii=False, indent=2)
+        if args.report == '-': print(text)
+        else:
+            with open(args.report, 'w', encoding='utf-8') as f: f.write(text + "\n")
+    return 0 if fatal is None and ok == len(app.file_queue) else 1
+
+# 主程序入口
+if __name__ == "__main__":
+    if len(sys.argv) > 1: sys.exit(run_cli(sys.argv[1:]))
+    try:
+        root = tk.Tk()
+        app = ExcelBatchProcessor(root)
+        root.mainloop()
+    except Exception as e:
+        print(f"程序启动失败: {e}")
+        import traceback
+        traceback.print_exc()
+        input("按任意键退出...")  # 在控制台窗口关闭前暂停